@@ -93,3 +93,59 @@ LOGIN_URL = '/login'
 LOGIN_REDIRECT_URL = '/'
 
 FEEDBACK_EMAIL = 'support@example.com'
+
+# Recalculate only the cells affected by edits since the last recalc, as long
+# as the usercode is unchanged.  Assumes usercode and formulae are deterministic.
+INCREMENTAL_RECALCULATION = False
+
+# How evaluate_formulae runs cell formulae: 'threads'; 'levels' to evaluate the
+# dependency graph one topological level at a time in the calculating thread;
+# or 'processes' to spread independent parts of the dependency graph across a
+# pool of worker processes (RECALCULATION_PROCESSES of them, or one per CPU if
+# None).  Sheets can override the engine with Sheet.recalculation_engine.
+RECALCULATION_ENGINE = 'threads'
+RECALCULATION_PROCESSES = None
+
+# Reuse calculated results for sheets whose usercode has a
+# "# dirigible: deterministic" line and whose contents and usercode are
+# unchanged: None to disable; 'memory' for a per-process LRU cache of
+# RECALCULATION_CACHE_SIZE results; or 'django' to use the Django cache named
+# by RECALCULATION_CACHE_ALIAS (eg. a file-based cache on local disk).
+RECALCULATION_CACHE = None
+RECALCULATION_CACHE_SIZE = 100
+RECALCULATION_CACHE_ALIAS = 'default'
+
+# Record how long each cell and each part of the usercode takes on every
+# recalc, and report the PROFILE_TOP_CELLS slowest cells and the critical path
+# in the console.  API callers can ask for this per-recalc with a 'profile'
+# parameter.
+PROFILE_RECALCULATION = False
+PROFILE_TOP_CELLS = 10
+
+# Worker processes for parsing the formulae of big CSV and Excel imports;
+# None to parse them all in the importing process.
+IMPORT_PARSE_PROCESSES = None
+
+# Keep cells holding plain numbers in typed arrays, a column at a time, rather
+# than as a Cell object each, which cuts the memory big data sheets need and
+# speeds up recalcs and range reads, but makes loading sheets slower.
+COLUMNAR_WORKSHEETS = False
+
+# How sheets are saved: 'json', in Sheet.contents_json, or 'binary' for a
+# more compact format that's quicker to load and save, in
+# Sheet.contents_binary.  Either is read whatever this is, so sheets move over
+# to the binary format as they're next saved.  Binary sheets also have an
+# index the grid uses to read just the cells it shows.
+WORKSHEET_STORAGE_FORMAT = 'json'
+
+# Keep sheets' cells in the database a tile of 26 columns by 100 rows (the
+# grid's patch size) at a time, so that an edit only writes the tiles it
+# changes and the grid only reads the tiles it shows.  Sheets move over to or
+# away from tiles as they're next saved.
+TILED_SHEET_STORAGE = False
+
+# Save sheets' dependency indexes along with their cells, rather than
+# rebuilding them from the cells' dependencies on the first recalc after
+# loading.  Rebuilding takes about as long as loading the saved index, which
+# only makes the saved sheets bigger.
+PERSIST_DEPENDENCY_INDEX = False
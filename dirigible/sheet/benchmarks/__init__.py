@@ -0,0 +1,3 @@
+# Copyright (c) 2010 Resolver Systems Ltd, PythonAnywhere LLP
+# See LICENSE.md
+#
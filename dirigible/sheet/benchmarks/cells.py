@@ -0,0 +1,139 @@
+# Copyright (c) 2010 Resolver Systems Ltd, PythonAnywhere LLP
+# See LICENSE.md
+#
+# Memory per Cell, and the time to set values and to recalc a sheet full of
+# them, comparing the slotted Cell that formats values when asked with one
+# carrying an instance __dict__ and formatting every value as it's set (as
+# Cell used to).
+#
+#     python -m sheet.benchmarks.cells [--rows N] [--repeat N]
+
+from argparse import ArgumentParser
+import sys
+from time import time
+
+from django.conf import settings
+
+from sheet import worksheet as worksheet_module
+from sheet.cell import Cell, parse_formula, undefined
+
+
+class EagerCell(object):
+
+    def __init__(self):
+        self.clear()
+
+
+    def _set_formula(self, value, parsed=None):
+        self._python_formula = None
+        self._formula = value
+        if value is not None and value.startswith('='):
+            dependencies, self._python_formula = parsed or parse_formula(value)
+            self.dependencies = list(dependencies)
+
+    def _get_formula(self):
+        return self._formula
+
+    formula = property(_get_formula, _set_formula)
+
+
+    @property
+    def python_formula(self):
+        return self._python_formula
+
+
+    def _set_value(self, value):
+        self._value = value
+        self.formatted_value = u'' if value is undefined else unicode(value)
+
+    def _get_value(self):
+        return self._value
+
+    value = property(_get_value, _set_value)
+
+
+    def clear(self):
+        self._value = undefined
+        self._formula = None
+        self._python_formula = None
+        self.dependencies = []
+        self.formatted_value = u''
+        self.error = None
+
+
+def cell_bytes(cell_class):
+    cell = cell_class()
+    cell.formula = '=A1 + 1'
+    cell.value = 1.5
+    size = sys.getsizeof(cell)
+    if hasattr(cell, '__dict__'):
+        size += sys.getsizeof(cell.__dict__)
+    return size
+
+
+def time_set_values(cell_class, count, repeat):
+    # What clear_values and evaluate_cell do to every cell on each recalc
+    cells = [cell_class() for _ in xrange(count)]
+    best = None
+    for _ in xrange(repeat):
+        start = time()
+        for index, cell in enumerate(cells):
+            cell.value = index * 1.5
+        for cell in cells:
+            cell.value = undefined
+        seconds = time() - start
+        best = seconds if best is None else min(best, seconds)
+    return best
+
+
+def make_worksheet(rows):
+    worksheet = worksheet_module.Worksheet()
+    worksheet.set_cell_formulae(
+        [((1, row), unicode(row)) for row in range(1, rows + 1)] +
+        [((2, row), '=A%d * 1.5' % (row,)) for row in range(1, rows + 1)] +
+        [((3, row), '=B%d > 10' % (row,)) for row in range(1, rows + 1)]
+    )
+    return worksheet
+
+
+def time_recalc(cell_class, rows, repeat):
+    from mock import sentinel
+    from sheet.calculate import calculate
+    original_cell_class = worksheet_module.Cell
+    worksheet_module.Cell = cell_class
+    try:
+        worksheet = make_worksheet(rows)
+        best = None
+        for _ in xrange(repeat):
+            start = time()
+            calculate(
+                worksheet, 'load_constants(worksheet)\nevaluate_formulae(worksheet)\n',
+                sentinel.private_key, 'levels'
+            )
+            seconds = time() - start
+            best = seconds if best is None else min(best, seconds)
+        return best
+    finally:
+        worksheet_module.Cell = original_cell_class
+
+
+def main():
+    argument_parser = ArgumentParser(description='Cell memory and recalc time on value-heavy sheets')
+    argument_parser.add_argument('--rows', type=int, default=20000,
+                                 help='rows of values, each with two formulae')
+    argument_parser.add_argument('--repeat', type=int, default=3,
+                                 help='recalcs to time, of which the best is kept')
+    args = argument_parser.parse_args()
+    settings.configure()
+
+    print '%-16s %12s %16s %12s' % ('cell', 'bytes/cell', 'set values ms', 'recalc ms')
+    for name, cell_class in (('dict, eager', EagerCell), ('slots, lazy', Cell)):
+        print '%-16s %12d %16.0f %12.0f' % (
+            name, cell_bytes(cell_class),
+            time_set_values(cell_class, args.rows * 3, args.repeat) * 1000,
+            time_recalc(cell_class, args.rows, args.repeat) * 1000
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,299 @@
+# Copyright (c) 2010 Resolver Systems Ltd, PythonAnywhere LLP
+# See LICENSE.md
+#
+# Throughput of each stage formulae go through -- parsing, dependency
+# extraction, translation to python and rewriting for copy/paste -- over a
+# synthetic corpus, plus the peak memory taken by a category's parse trees.
+# Use --json to save results, and --compare to check a later run against
+# them, eg. before and after a grammar change (from the directory that
+# contains manage.py):
+#
+#     python -m sheet.benchmarks.formula_pipeline --json > before.json
+#     python -m sheet.benchmarks.formula_pipeline --compare before.json
+#
+# which exits with status 1 if any stage got slower than --tolerance allows.
+
+from argparse import ArgumentParser
+import json
+import platform
+import resource
+from random import Random
+import string
+import subprocess
+import sys
+from time import time
+
+from sheet.formula_interpreter import (
+    get_dependencies_from_parse_tree, get_python_formula_from_parse_tree,
+)
+from sheet.parser.parser import parse
+from sheet.rewrite_formula_offset_cell_references import (
+    formula_template_cache, rewrite_formula,
+)
+from sheet.utils.cell_name_utils import coordinates_to_cell_name
+
+
+def _cell(random, max_col=50, max_row=1000):
+    name = coordinates_to_cell_name(
+        random.randint(1, max_col), random.randint(1, max_row)
+    )
+    if random.random() < 0.1:
+        name = '$' + name
+    return name
+
+
+def _range(random, max_col=50, max_row=1000):
+    return '%s:%s' % (_cell(random, max_col, max_row), _cell(random, max_col, max_row))
+
+
+def short_arithmetic(random):
+    terms = [
+        _cell(random) if random.random() < 0.7 else str(random.randint(0, 100))
+        for _ in range(random.randint(2, 6))
+    ]
+    formula = terms[0]
+    for term in terms[1:]:
+        formula += ' %s %s' % (random.choice(['+', '-', '*', '/']), term)
+    return '=' + formula
+
+
+def wide_ranges(random):
+    return '=' + ' + '.join(
+        '%s(%s)' % (
+            random.choice(['SUM', 'AVERAGE', 'MAX', 'MIN']),
+            _range(random, max_col=700, max_row=100000),
+        )
+        for _ in range(random.randint(1, 4))
+    )
+
+
+def nested_lambdas_and_comprehensions(random):
+    formula = _cell(random)
+    for depth in range(random.randint(2, 5)):
+        variable = 'item' + 'abcde'[depth]
+        if random.random() < 0.5:
+            formula = '(lambda %s -> %s * %s + %s)(%s)' % (
+                variable, variable, _cell(random), formula, _cell(random)
+            )
+        else:
+            formula = 'sum([%s * %s for %s in %s if %s > %s])' % (
+                variable, formula, variable, _range(random), variable, _cell(random)
+            )
+    return '=' + formula
+
+
+def long_string_literals(random):
+    characters = string.ascii_letters + string.digits + ' ,.;:!?-'
+    literals = [
+        '"%s"' % (''.join(
+            random.choice(characters) for _ in range(random.randint(200, 2000))
+        ),)
+        for _ in range(random.randint(1, 3))
+    ]
+    return '=%s + str(%s)' % (' + '.join(literals), _cell(random))
+
+
+CATEGORIES = [
+    ('short arithmetic', short_arithmetic),
+    ('wide ranges', wide_ranges),
+    ('lambdas/comps', nested_lambdas_and_comprehensions),
+    ('long strings', long_string_literals),
+]
+STAGES = ['parse', 'dependencies', 'translate', 'rewrite cold', 'rewrite warm']
+
+
+def corpus(category, count, seed):
+    make_formula = dict(CATEGORIES)[category]
+    random = Random('%s %s' % (seed, category))
+    return [make_formula(random) for _ in xrange(count)]
+
+
+def time_stage(function, arguments, repeat):
+    # Best of repeat runs, to cut out noise from the rest of the machine.
+    best = None
+    for _ in xrange(repeat):
+        start = time()
+        for argument in arguments:
+            function(argument)
+        seconds = time() - start
+        best = seconds if best is None else min(best, seconds)
+    return best
+
+
+def time_translate(formulae, repeat):
+    # Translation rewrites the parse tree it's given, so needs new ones
+    # every time.
+    best = None
+    for _ in xrange(repeat):
+        parse_trees = map(parse, formulae)
+        start = time()
+        for parse_tree in parse_trees:
+            get_python_formula_from_parse_tree(parse_tree)
+        seconds = time() - start
+        best = seconds if best is None else min(best, seconds)
+    return best
+
+
+def time_rewrite(formulae, repeat, cold):
+    def rewrite(formula):
+        rewrite_formula(formula, 3, 7, False, (1, 1, 1, 1))
+    best = None
+    for _ in xrange(repeat):
+        formula_template_cache.clear()
+        if not cold:
+            map(rewrite, formulae)
+        start = time()
+        map(rewrite, formulae)
+        seconds = time() - start
+        best = seconds if best is None else min(best, seconds)
+    return best
+
+
+def _reset_peak_rss():
+    # Linux lets the high water mark be reset; elsewhere, building the
+    # parser may already have taken it past what the parse trees need.
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+    except IOError:
+        pass
+
+
+def _peak_rss_kb():
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except IOError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def parse_trees_peak_memory(category, count, seed):
+    formulae = corpus(category, count, seed)
+    parse('=1')  # build the parser first, so it's not counted
+    _reset_peak_rss()
+    before = _peak_rss_kb()
+    parse_trees = map(parse, formulae)
+    after = _peak_rss_kb()
+    del parse_trees
+    return after - before
+
+
+def peak_memory_kb(category, count, seed):
+    # In a new interpreter, as the high water mark of this one (or of a
+    # process forked from it) is already well above what's being measured.
+    return int(subprocess.check_output([
+        sys.executable, '-c',
+        'from sheet.benchmarks.formula_pipeline import parse_trees_peak_memory; '
+        'print parse_trees_peak_memory(%r, %d, %d)' % (category, count, seed)
+    ]))
+
+
+def run(count, repeat, seed, categories):
+    results = []
+    for category in categories:
+        formulae = corpus(category, count, seed)
+        parse_trees = map(parse, formulae)
+        for stage, seconds in zip(STAGES, [
+            time_stage(parse, formulae, repeat),
+            time_stage(get_dependencies_from_parse_tree, parse_trees, repeat),
+            time_translate(formulae, repeat),
+            time_rewrite(formulae, repeat, cold=True),
+            time_rewrite(formulae, repeat, cold=False),
+        ]):
+            results.append(dict(
+                category=category,
+                stage=stage,
+                formulae=count,
+                characters=sum(len(formula) for formula in formulae),
+                seconds=seconds,
+                formulae_per_second=count / seconds if seconds else None,
+            ))
+        results.append(dict(
+            category=category,
+            stage='parse trees peak memory',
+            formulae=count,
+            peak_memory_kb=peak_memory_kb(category, count, seed),
+        ))
+    return results
+
+
+def regressions(baseline, results, tolerance):
+    # (category, stage, baseline rate, new rate) for every stage whose
+    # throughput dropped by more than the tolerance.
+    baseline_rates = dict(
+        ((result['category'], result['stage']), result['formulae_per_second'])
+        for result in baseline['results']
+        if result.get('formulae_per_second')
+    )
+    slower = []
+    for result in results:
+        key = (result['category'], result['stage'])
+        rate = result.get('formulae_per_second')
+        if rate and key in baseline_rates:
+            if rate < baseline_rates[key] * (1 - tolerance):
+                slower.append(key + (baseline_rates[key], rate))
+    return slower
+
+
+def main():
+    argument_parser = ArgumentParser(description='Formula parsing and rewriting throughput')
+    argument_parser.add_argument('--count', type=int, default=2000,
+                                 help='formulae in each category')
+    argument_parser.add_argument('--repeat', type=int, default=3,
+                                 help='runs of each stage, of which the best is kept')
+    argument_parser.add_argument('--seed', type=int, default=0,
+                                 help='seed for generating the corpus')
+    argument_parser.add_argument('--categories',
+                                 default=','.join(name for name, _ in CATEGORIES),
+                                 help='comma-separated categories of formulae')
+    argument_parser.add_argument('--json', action='store_true',
+                                 help='print results as JSON')
+    argument_parser.add_argument('--compare', metavar='FILE',
+                                 help='JSON results of an earlier run to check against')
+    argument_parser.add_argument('--tolerance', type=float, default=0.1,
+                                 help='fraction of throughput a stage can lose before --compare fails')
+    args = argument_parser.parse_args()
+
+    results = run(args.count, args.repeat, args.seed, args.categories.split(','))
+
+    if args.json:
+        print json.dumps(dict(
+            python=platform.python_version(),
+            platform=platform.platform(),
+            count=args.count,
+            repeat=args.repeat,
+            seed=args.seed,
+            results=results,
+        ), indent=2, sort_keys=True)
+    else:
+        print '%-18s %-24s %12s %14s %10s' % (
+            'category', 'stage', 'ms', 'formulae/sec', 'peak KB'
+        )
+        for result in results:
+            if 'seconds' in result:
+                print '%-18s %-24s %12.1f %14.0f %10s' % (
+                    result['category'], result['stage'],
+                    result['seconds'] * 1000, result['formulae_per_second'], ''
+                )
+            else:
+                print '%-18s %-24s %12s %14s %10d' % (
+                    result['category'], result['stage'], '', '', result['peak_memory_kb']
+                )
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+        slower = regressions(baseline, results, args.tolerance)
+        for category, stage, baseline_rate, rate in slower:
+            print >> sys.stderr, '%s / %s: %.0f formulae/sec, down from %.0f' % (
+                category, stage, rate, baseline_rate
+            )
+        if slower:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+# Copyright (c) 2010 Resolver Systems Ltd, PythonAnywhere LLP
+# See LICENSE.md
+#
+# Wall-clock startup time for fresh interpreters: importing sheet.cell,
+# parsing a first formula after that (which is when the parser now gets
+# built), and running a manage.py command.  Run from the directory that
+# contains manage.py:
+#
+#     python -m sheet.benchmarks.import_time [--runs N] [--command help]
+
+from argparse import ArgumentParser
+import os
+import subprocess
+import sys
+from time import time
+
+
+def scenarios(command):
+    return [
+        ('python', [sys.executable, '-c', 'pass']),
+        ('import sheet.cell', [sys.executable, '-c', 'import sheet.cell']),
+        ('... and parse', [sys.executable, '-c',
+            'import sheet.cell; sheet.cell.parser.parse("=A1 + 1")']),
+        ('manage.py %s' % (command,), [sys.executable, 'manage.py', command]),
+    ]
+
+
+def time_run(arguments):
+    with open(os.devnull, 'w') as devnull:
+        start = time()
+        subprocess.check_call(arguments, stdout=devnull, stderr=devnull)
+        return time() - start
+
+
+def run(runs, command):
+    results = []
+    for name, arguments in scenarios(command):
+        times = sorted(time_run(arguments) for _ in range(runs))
+        results.append((name, times[0], times[len(times) // 2]))
+    return results
+
+
+def main():
+    argument_parser = ArgumentParser(description='Interpreter startup and import times')
+    argument_parser.add_argument('--runs', type=int, default=10,
+                                 help='runs of each scenario')
+    argument_parser.add_argument('--command', default='help',
+                                 help='manage.py command to time')
+    args = argument_parser.parse_args()
+
+    print '%-24s %10s %10s' % ('scenario', 'best ms', 'median ms')
+    for name, best, median in run(args.runs, args.command):
+        print '%-24s %10.0f %10.0f' % (name, best * 1000, median * 1000)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+# Copyright (c) 2010 Resolver Systems Ltd, PythonAnywhere LLP
+# See LICENSE.md
+#
+# Time and memory for parse trees of very long formulae, comparing the
+# join-based ParseNode.flatten with the reduce-based one it replaced, and
+# slotted parse nodes with ones carrying an instance __dict__.
+#
+#     python -m sheet.benchmarks.parse_trees [--size N] [--repeat N]
+
+from argparse import ArgumentParser
+import sys
+from time import time
+
+from sheet.parser.parse_node import ParseNode
+from sheet.parser.parser import parse
+
+
+def array_literal(size):
+    return '=[%s]' % (', '.join(str(index) for index in range(size)),)
+
+
+def sum_chain(size):
+    return '=' + ' + '.join('A%d' % (row,) for row in range(1, size + 1))
+
+
+def if_chain(size):
+    formula = '0'
+    for index in range(size):
+        formula = 'IF(A1 > %d, %d, %s)' % (index, index, formula)
+    return '=' + formula
+
+
+def reduce_flatten(node):
+    def append_child(string, child):
+        if isinstance(child, ParseNode):
+            return string + reduce_flatten(child)
+        return string + child if child is not None else string
+    return reduce(append_child, node.children, "")
+
+
+
+class DictParseNode(object):
+
+    def __init__(self, _type, children):
+        self.type = _type
+        self.children = children
+
+
+def tree_nodes(node):
+    nodes = [node]
+    for node in nodes:
+        nodes.extend(child for child in node.children if isinstance(child, ParseNode))
+    return nodes
+
+
+def time_repeatedly(function, argument, repeat):
+    start = time()
+    for _ in xrange(repeat):
+        function(argument)
+    return (time() - start) / repeat
+
+
+def run(size, repeat):
+    dict_node = DictParseNode(None, None)
+    dict_node_bytes = sys.getsizeof(dict_node) + sys.getsizeof(dict_node.__dict__)
+    results = []
+    for name, make_formula, chain_size in (
+        ('array literal', array_literal, size),
+        ('sum chain', sum_chain, size),
+        ('IF chain', if_chain, size // 20),
+    ):
+        formula = make_formula(chain_size)
+        tree = parse(formula)
+        nodes = tree_nodes(tree)
+        try:
+            reduce_seconds = time_repeatedly(reduce_flatten, tree, repeat)
+        except RuntimeError:
+            reduce_seconds = None
+        results.append(dict(
+            formula=name,
+            characters=len(formula),
+            nodes=len(nodes),
+            parse_seconds=time_repeatedly(parse, formula, repeat),
+            reduce_flatten_seconds=reduce_seconds,
+            join_flatten_seconds=time_repeatedly(ParseNode.flatten, tree, repeat),
+            dict_node_bytes=len(nodes) * dict_node_bytes,
+            slotted_node_bytes=sum(sys.getsizeof(node) for node in nodes),
+        ))
+    return results
+
+
+def main():
+    argument_parser = ArgumentParser(description='Parse tree time and memory for long formulae')
+    argument_parser.add_argument('--size', type=int, default=2000,
+                                 help='elements in the array literal and sum chain (IF chain gets a twentieth)')
+    argument_parser.add_argument('--repeat', type=int, default=5,
+                                 help='times to repeat each timing')
+    args = argument_parser.parse_args()
+
+    print '%-14s %8s %7s %9s %11s %11s %11s %11s' % (
+        'formula', 'chars', 'nodes', 'parse ms', 'reduce ms', 'join ms', 'dict KB', 'slots KB'
+    )
+    for result in run(args.size, args.repeat):
+        reduce_seconds = result['reduce_flatten_seconds']
+        print '%-14s %8d %7d %9.1f %11s %11.2f %11.0f %11.0f' % (
+            result['formula'], result['characters'], result['nodes'],
+            result['parse_seconds'] * 1000,
+            'recursion' if reduce_seconds is None else '%.2f' % (reduce_seconds * 1000,),
+            result['join_flatten_seconds'] * 1000,
+            result['dict_node_bytes'] / 1024.0,
+            result['slotted_node_bytes'] / 1024.0,
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+# Copyright (c) 2010 Resolver Systems Ltd, PythonAnywhere LLP
+# See LICENSE.md
+#
+# Parsing throughput with increasing numbers of threads, comparing the
+# per-thread parsers with a single parser behind a lock (as it used to be).
+#
+#     python -m sheet.benchmarks.parser_threads [--parses N] [--threads 1,2,4,8]
+
+from argparse import ArgumentParser
+from threading import Lock, Thread
+from time import time
+
+from sheet.parser import parser as parser_module
+
+
+FORMULAE = [
+    '=A1 + B1 * 2',
+    '=SUM(A1:A100) / COUNT(A1:A100)',
+    '=IF(A1 > 0, "positive", "not positive")',
+    '=[x * 2 for x in B1:B10 if x]',
+    '=<Sheet1>.A1 + Sheet1!B2',
+    '=lambda x -> x ** 2 + C3',
+]
+
+
+_lock = Lock()
+
+def locked_parse(formula):
+    with _lock:
+        parser, lexer = parser_module._get_base_parser_and_lexer()
+        return parser.parse(formula, lexer)
+
+
+def time_threads(parse, num_threads, parses_per_thread):
+    def parse_formulae():
+        for index in xrange(parses_per_thread):
+            parse(FORMULAE[index % len(FORMULAE)])
+
+    threads = [Thread(target=parse_formulae) for _ in range(num_threads)]
+    start = time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time() - start
+
+
+def run(thread_counts, parses_per_thread):
+    results = []
+    for num_threads in thread_counts:
+        for name, parse in (
+            ('locked', locked_parse), ('per-thread', parser_module.parse)
+        ):
+            seconds = time_threads(parse, num_threads, parses_per_thread)
+            results.append((name, num_threads, num_threads * parses_per_thread / seconds))
+    return results
+
+
+def main():
+    argument_parser = ArgumentParser(description='Parser throughput by thread count')
+    argument_parser.add_argument('--parses', type=int, default=2000,
+                                 help='parses per thread')
+    argument_parser.add_argument('--threads', default='1,2,4,8',
+                                 help='comma-separated thread counts')
+    args = argument_parser.parse_args()
+
+    print '%-12s %8s %14s' % ('parser', 'threads', 'parses/sec')
+    for name, num_threads, parses_per_second in run(
+        [int(count) for count in args.threads.split(',')], args.parses
+    ):
+        print '%-12s %8d %14.0f' % (name, num_threads, parses_per_second)
+
+
+if __name__ == '__main__':
+    main()
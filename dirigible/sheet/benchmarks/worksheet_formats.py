@@ -0,0 +1,94 @@
+# Copyright (c) 2010 Resolver Systems Ltd, PythonAnywhere LLP
+# See LICENSE.md
+#
+# Size and save/load speed of a calculated sheet in each storage format:
+# JSON as worksheet_to_json writes it, the binary format as it is kept in
+# Sheet.contents_binary, and the base64 text that binary sheets used to be
+# kept as in Sheet.contents_json.  Also how long the grid takes to read one
+# patch of cells from each.
+#
+#     python -m sheet.benchmarks.worksheet_formats [--rows N] [--repeat N]
+
+from argparse import ArgumentParser
+from time import time
+
+from django.conf import settings
+
+
+def make_worksheet(rows):
+    from mock import sentinel
+    from sheet.calculate import calculate
+    from sheet.dependency_graph import get_dependency_index
+    from sheet.worksheet import Worksheet
+
+    worksheet = Worksheet()
+    worksheet.set_cell_formulae(
+        [((1, row), unicode(row)) for row in range(1, rows + 1)] +
+        [((2, row), '=A%d * 1.5' % (row,)) for row in range(1, rows + 1)] +
+        [((3, row), '=sum(A%d:B%d)' % (row, row)) for row in range(1, rows + 1)] +
+        [((4, row), 'label %d' % (row % 10,)) for row in range(1, rows + 1)]
+    )
+    get_dependency_index(worksheet)
+    calculate(
+        worksheet, 'load_constants(worksheet)\nevaluate_formulae(worksheet)\n',
+        sentinel.private_key
+    )
+    return worksheet
+
+
+def best_time(function, repeat):
+    best = None
+    for _ in xrange(repeat):
+        start = time()
+        function()
+        seconds = time() - start
+        best = seconds if best is None else min(best, seconds)
+    return best
+
+
+def main():
+    argument_parser = ArgumentParser(description='Worksheet size and save/load time by storage format')
+    argument_parser.add_argument('--rows', type=int, default=5000,
+                                 help='rows of four cells: a number, two formulae and a label')
+    argument_parser.add_argument('--repeat', type=int, default=3,
+                                 help='saves and loads to time, of which the best is kept')
+    args = argument_parser.parse_args()
+    settings.configure()
+
+    from base64 import b64decode, b64encode
+    from sheet.worksheet import worksheet_from_json, worksheet_to_json
+    from sheet.worksheet_binary import (
+        CONTENTS_PREFIX, worksheet_from_binary, worksheet_range_from_binary,
+        worksheet_range_from_contents, worksheet_to_binary,
+    )
+
+    worksheet = make_worksheet(args.rows)
+    formats = [
+        ('json', worksheet_to_json, worksheet_from_json, worksheet_range_from_contents),
+        ('binary', worksheet_to_binary, worksheet_from_binary, worksheet_range_from_binary),
+        (
+            'old base64',
+            lambda worksheet: CONTENTS_PREFIX + b64encode(worksheet_to_binary(worksheet)),
+            lambda contents: worksheet_from_binary(b64decode(contents[len(CONTENTS_PREFIX):])),
+            worksheet_range_from_contents,
+        ),
+    ]
+    # A patch from the middle of the sheet, as the grid asks for them
+    middle = args.rows // 200 * 100
+    patch = (1, middle + 1, 26, middle + 100)
+
+    print '%-16s %10s %10s %10s %10s %10s' % (
+        'format', 'KB', 'bytes/cell', 'save ms', 'load ms', 'patch ms'
+    )
+    for name, save, load, load_patch in formats:
+        contents = save(worksheet)
+        print '%-16s %10.0f %10.0f %10.0f %10.0f %10.1f' % (
+            name, len(contents) / 1024.0, len(contents) / float(len(worksheet)),
+            best_time(lambda: save(worksheet), args.repeat) * 1000,
+            best_time(lambda: load(contents), args.repeat) * 1000,
+            best_time(lambda: load_patch(contents, patch), args.repeat) * 1000,
+        )
+
+
+if __name__ == '__main__':
+    main()
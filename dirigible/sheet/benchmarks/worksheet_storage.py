@@ -0,0 +1,103 @@
+# Copyright (c) 2010 Resolver Systems Ltd, PythonAnywhere LLP
+# See LICENSE.md
+#
+# Memory and speed of a big numeric sheet held in a Worksheet or a
+# ColumnarWorksheet: the RSS it takes, and how long it takes to load from
+# JSON, to recalculate, and to sum every column through a CellRange.  Each
+# storage is measured in a fresh interpreter.  Run from the directory that
+# contains manage.py:
+#
+#     python -m sheet.benchmarks.worksheet_storage [--cols N] [--rows N]
+
+from argparse import ArgumentParser
+import json
+import subprocess
+import sys
+from time import time
+
+STORAGES = ['Worksheet', 'ColumnarWorksheet']
+
+
+def _rss_kb():
+    with open('/proc/self/status') as status:
+        for line in status:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+
+
+def measure(storage, cols, rows):
+    from django.conf import settings
+    settings.configure()
+    from mock import sentinel
+    from sheet.calculate import calculate
+    from sheet.cell_range import CellRange
+    from sheet.columnar_worksheet import ColumnarWorksheet
+    from sheet.worksheet import Worksheet, worksheet_from_json, worksheet_to_json
+
+    formulae = [
+        ((col, row), unicode(row * col if col % 2 else row * 0.5))
+        for col in range(1, cols + 1) for row in range(1, rows + 1)
+    ]
+    worksheet = Worksheet()
+    worksheet.set_cell_formulae(formulae)
+    del formulae
+    contents_json = worksheet_to_json(worksheet)
+    del worksheet
+
+    before = _rss_kb()
+    start = time()
+    worksheet = worksheet_from_json(
+        contents_json, dict(Worksheet=Worksheet, ColumnarWorksheet=ColumnarWorksheet)[storage]
+    )
+    load_seconds = time() - start
+    worksheet_kb = _rss_kb() - before
+
+    start = time()
+    calculate(worksheet, 'load_constants(worksheet)\n', sentinel.private_key)
+    recalc_seconds = time() - start
+
+    start = time()
+    for col in range(1, cols + 1):
+        sum(CellRange(worksheet, (col, 1), (col, rows)))
+    sum_seconds = time() - start
+
+    return dict(
+        storage=storage, cells=cols * rows, worksheet_kb=worksheet_kb,
+        load_seconds=load_seconds, recalc_seconds=recalc_seconds,
+        sum_seconds=sum_seconds,
+    )
+
+
+def run(cols, rows):
+    return [
+        json.loads(subprocess.check_output([
+            sys.executable, '-c',
+            'import json; from sheet.benchmarks.worksheet_storage import measure; '
+            'print json.dumps(measure(%r, %d, %d))' % (storage, cols, rows)
+        ]))
+        for storage in STORAGES
+    ]
+
+
+def main():
+    argument_parser = ArgumentParser(description='Numeric sheet memory and speed by storage')
+    argument_parser.add_argument('--cols', type=int, default=10,
+                                 help='columns of numbers')
+    argument_parser.add_argument('--rows', type=int, default=20000,
+                                 help='rows of numbers')
+    args = argument_parser.parse_args()
+
+    print '%-18s %9s %8s %11s %10s %9s %7s' % (
+        'storage', 'cells', 'MB', 'bytes/cell', 'load ms', 'recalc ms', 'sum ms'
+    )
+    for result in run(args.cols, args.rows):
+        print '%-18s %9d %8.1f %11.0f %10.0f %9.0f %7.0f' % (
+            result['storage'], result['cells'], result['worksheet_kb'] / 1024.0,
+            result['worksheet_kb'] * 1024.0 / result['cells'],
+            result['load_seconds'] * 1000, result['recalc_seconds'] * 1000,
+            result['sum_seconds'] * 1000,
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -4,11 +4,12 @@
 
 from __future__ import division
 
-
+import cPickle
+from hashlib import md5
 import json
-from Queue import Queue
+from multiprocessing import cpu_count, Pool
 import sys
-from threading import Thread
+from threading import Lock
 from time import sleep, time
 import traceback
 from urllib import urlencode
@@ -16,19 +17,29 @@ import urllib2
 
 from django.conf import settings
 
-from .cell import undefined
+from .cell import reset_parse_locks, undefined
 from .dirigible_datetime import DateTime
-from .dependency_graph import build_dependency_graph
+from .dependency_graph import (
+    build_dependency_graph, find_dependents, get_dependency_index,
+    partition_dependency_graph, topological_levels
+)
 from .eval_constant import eval_constant
+from .formula_compiler import compile_formula
+from .location_index import is_range_dependency
 from .parser import FormulaError
+from .scheduler import DependencyGraphRun, SchedulerMetrics, WorkerPool
 from .worksheet import CellRange, Worksheet
 from .utils.cell_name_utils import coordinates_to_cell_name
 from .utils.interruptable_thread import InterruptableThread
+from .utils.lru_cache import LRUCache
 
 
 # API version used by internal calls
 CURRENT_API_VERSION = '0.1'
 NUM_THREADS = 10
+PYTHON_FORMULA_CACHE_SIZE = 10000
+MAX_PROCESS_POOL_WAIT_SECONDS = 24 * 60 * 60
+PROFILE_TOP_CELLS = 10
 INF = 1e9999
 NEG_INF = -INF
 
@@ -41,17 +52,22 @@ class MyStdout(object):
     def write(self, text):
         self.worksheet.add_console_text(text, log_type='output')
 
+    def flush(self):
+        # Forking worker processes flushes stdout
+        pass
+
     def __init__(self, worksheet):
         self.worksheet = worksheet
 
 
 def load_constants(worksheet):
-    for loc in worksheet.iterkeys():
-        formula = worksheet[loc].formula
+    for loc in worksheet._load_constants_in_bulk():
+        cell = worksheet[loc]
+        formula = cell.formula
         if formula:
             if not formula.startswith('='):
-                worksheet[loc].value = eval_constant(formula)
-                worksheet[loc].error = None
+                cell.value = eval_constant(formula)
+                cell.error = None
 
 
 def set_cell_error_and_add_to_console(worksheet, location, exception):
@@ -67,76 +83,406 @@ def set_cell_error_and_add_to_console(worksheet, location, exception):
     )
 
 
-def recalculate_cell(location, leaf_queue, graph, context):
-    cell = context['worksheet'][location]
+class RecalcProfiler(object):
+    # Only attached to the worksheet (as _profiler) while a profiled recalc
+    # runs; what it found is kept as a plain dict in worksheet._profile.
+
+    def __init__(self):
+        self.cell_times = {}
+        self.graph = None
+        self.usercode_start = None
+        self.usercode_end = None
+        self.evaluate_start = None
+        self.evaluate_end = None
+        self.evaluate_time = 0.0
+        self.scheduler = None
+
+
+    def record_cell(self, location, seconds):
+        self.cell_times[location] = seconds
+
+
+    def timed_evaluator(self, evaluate_formulae):
+        def timed_evaluate_formulae(worksheet, context):
+            start = time()
+            if self.evaluate_start is None:
+                self.evaluate_start = start
+            try:
+                result = evaluate_formulae(worksheet, context)
+                # Only the threaded engine's scheduler reports its metrics.
+                if isinstance(result, SchedulerMetrics):
+                    if self.scheduler is None:
+                        self.scheduler = SchedulerMetrics()
+                    self.scheduler.add(result)
+                return result
+            finally:
+                self.evaluate_end = time()
+                self.evaluate_time += self.evaluate_end - start
+        return timed_evaluate_formulae
+
+
+    def usercode_phases(self):
+        if self.usercode_start is None:
+            return 0.0, 0.0, 0.0
+        if self.evaluate_start is None:
+            return self.usercode_end - self.usercode_start, 0.0, 0.0
+        return (
+            self.evaluate_start - self.usercode_start,
+            self.evaluate_time,
+            self.usercode_end - self.evaluate_end,
+        )
+
+
+    def critical_path(self):
+        # The chain of dependent cells with the greatest total eval time,
+        # which no number of threads or processes can make faster.
+        if not self.graph:
+            return 0.0, []
+        finish_times = {}
+        slowest_child = {}
+        for level in topological_levels(self.graph):
+            for location in level:
+                children = self.graph[location].children
+                child = max(children, key=finish_times.get) if children else None
+                slowest_child[location] = child
+                finish_times[location] = self.cell_times.get(location, 0.0) + (
+                    finish_times[child] if child else 0.0
+                )
+        location = max(finish_times, key=finish_times.get)
+        seconds = finish_times[location]
+        path = []
+        while location is not None:
+            if not is_range_dependency(location):
+                path.append(location)
+            location = slowest_child[location]
+        path.reverse()
+        return seconds, path
+
+
+    def as_dict(self, top_cells):
+        before, evaluating, after = self.usercode_phases()
+        slowest_cells = sorted(
+            self.cell_times.iteritems(), key=lambda (_, seconds): -seconds
+        )[:top_cells]
+        critical_path_seconds, critical_path = self.critical_path()
+        profile = {
+            'cells_evaluated': len(self.cell_times),
+            'usercode': {
+                'before_evaluate_formulae': before,
+                'evaluate_formulae': evaluating,
+                'after_evaluate_formulae': after,
+            },
+            'slowest_cells': [
+                {'cell': coordinates_to_cell_name(*location), 'seconds': seconds}
+                for location, seconds in slowest_cells
+            ],
+            'critical_path': {
+                'seconds': critical_path_seconds,
+                'cells': [
+                    coordinates_to_cell_name(*location)
+                    for location in critical_path
+                ],
+            },
+        }
+        if self.scheduler is not None:
+            profile['scheduler'] = {
+                'nodes': self.scheduler.nodes,
+                'wall_time': self.scheduler.wall_time,
+                'eval_time': self.scheduler.eval_time,
+                'queue_wait_time': self.scheduler.queue_wait_time,
+                'max_queue_wait_time': self.scheduler.max_queue_wait_time,
+            }
+        return profile
+
+
+def format_profile(profile):
+    lines = [
+        'Usercode: %.2fs before evaluate_formulae, %.2fs in it, %.2fs after' % (
+            profile['usercode']['before_evaluate_formulae'],
+            profile['usercode']['evaluate_formulae'],
+            profile['usercode']['after_evaluate_formulae'],
+        ),
+        'Evaluated %d cells' % (profile['cells_evaluated'],),
+    ]
+    if profile['slowest_cells']:
+        lines.append('Slowest cells: %s' % (', '.join(
+            '%s %.3fs' % (slow_cell['cell'], slow_cell['seconds'])
+            for slow_cell in profile['slowest_cells']
+        ),))
+    if profile['critical_path']['cells']:
+        lines.append('Critical path: %.3fs through %d cells (%s)' % (
+            profile['critical_path']['seconds'],
+            len(profile['critical_path']['cells']),
+            ' -> '.join(profile['critical_path']['cells']),
+        ))
+    if 'scheduler' in profile:
+        lines.append(
+            'Scheduler: %d graph nodes in %.3fs, %.3fs evaluating, '
+            '%.3fs queued (longest wait %.3fs)' % (
+                profile['scheduler']['nodes'],
+                profile['scheduler']['wall_time'],
+                profile['scheduler']['eval_time'],
+                profile['scheduler']['queue_wait_time'],
+                profile['scheduler']['max_queue_wait_time'],
+            )
+        )
+    return '\n'.join(lines) + '\n'
+
+
+python_formula_cache = LRUCache(PYTHON_FORMULA_CACHE_SIZE)
+
+
+def compile_python_formula(python_formula):
+    compiled = python_formula_cache.get(python_formula)
+    if compiled is None:
+        compiled = compile_formula(python_formula)
+        python_formula_cache.put(python_formula, compiled)
+    return compiled
+
+
+def _cell_value(worksheet, location):
+    # Going straight to the dict skips Worksheet.__getitem__, which makes a
+    # new Cell each time just in case it's needed.
+    cell = dict.get(worksheet, location)
+    if cell is None:
+        cell = worksheet[location]
+    return cell.value
+
+
+def evaluate_cell(location, context):
+    worksheet = context['worksheet']
+    profiler = getattr(worksheet, '_profiler', None)
+    if profiler is not None:
+        start = time()
+    cell = worksheet[location]
     cell.error = None
     try:
-        cell.value = eval(cell.python_formula, context)
+        code, locations = compile_python_formula(cell.python_formula)
+        cell.value = eval(code, context)(
+            *[_cell_value(worksheet, reference) for reference in locations]
+        )
     except Exception, exc:
-        set_cell_error_and_add_to_console(context['worksheet'], location, exc)
+        set_cell_error_and_add_to_console(worksheet, location, exc)
+    if profiler is not None:
+        profiler.record_cell(location, time() - start)
 
-    graph[location].remove_from_parents(
-        [graph[parent_loc] for parent_loc in graph[location].parents],
-        leaf_queue
-    )
 
+worker_pool = WorkerPool()
 
-def create_cell_recalculator(leaf_queue, unrecalculated_queue, graph, context):
-    def cell_recalculator():
-        while not unrecalculated_queue.empty():
-            try:
-                leaf = leaf_queue.get(block=True, timeout=0.1)
-            except:
-                continue
-            try:
-                recalculate_cell(leaf, leaf_queue, graph, context)
-            finally:
-                leaf_queue.task_done()
-                unrecalculated_queue.get()
-                unrecalculated_queue.task_done()
-    return cell_recalculator
+
+def build_recalculation_graph(worksheet):
+    graph, leaves = build_dependency_graph(worksheet, worksheet._recalc_locations)
+    if worksheet._profiler is not None:
+        worksheet._profiler.graph = graph
+    return graph, leaves
+
+
+def evaluate_node(location, context):
+    # Range blocks in the graph only hold back the cells that refer to them
+    # until the cells in them are done, so have nothing to evaluate.
+    if not is_range_dependency(location):
+        evaluate_cell(location, context)
 
 
 def evaluate_formulae_in_context(worksheet, context):
-    graph, leaves = build_dependency_graph(worksheet)
-    leaf_queue = Queue()
-    unrecalculated_queue = Queue()
-    for _ in graph:
-        unrecalculated_queue.put(1)
+    graph, leaves = build_recalculation_graph(worksheet)
+    run = DependencyGraphRun(
+        graph, lambda location: evaluate_node(location, context), NUM_THREADS
+    )
+    return run.run(worker_pool, leaves)
+
+
+_worker_components = None
+_worker_context = None
+
+
+def _initialise_worker_process(components, context):
+    global _worker_components, _worker_context
+    _worker_components = components
+    _worker_context = context
+    # Only the forking thread carries on in the worker, so any lock that
+    # another thread (say the scheduler's, or another recalc's) held at the
+    # fork would stay locked for good.
+    python_formula_cache.reset_lock()
+    reset_parse_locks()
+    context['worksheet']._console_lock = Lock()
+
+
+def _evaluate_component_in_worker(index):
+    worksheet = _worker_context['worksheet']
+    console_text_start = len(worksheet._console_text)
+    cell_results = []
+    for location in _worker_components[index]:
+        evaluate_cell(location, _worker_context)
+        cell = worksheet[location]
+        if cell.value is undefined:
+            cell_results.append((location, False, None, cell.error))
+        else:
+            cell_results.append((location, True, cell.value, cell.error))
+    cell_times = None
+    if worksheet._profiler is not None:
+        cell_times = worksheet._profiler.cell_times
+    try:
+        return cPickle.dumps(
+            (cell_results, worksheet._console_text[console_text_start:], cell_times),
+            cPickle.HIGHEST_PROTOCOL
+        )
+    except Exception:
+        # Unpicklable values; the component is evaluated in the parent instead
+        return None
+
+
+def _merge_component_results(pickled_results, context):
+    worksheet = context['worksheet']
+    cell_results, console_text, cell_times = cPickle.loads(pickled_results)
+    for location, has_value, value, error in cell_results:
+        cell = worksheet[location]
+        cell.value = value if has_value else undefined
+        cell.error = error
+    with worksheet._console_lock:
+        worksheet._console_text += console_text
+    if cell_times and worksheet._profiler is not None:
+        worksheet._profiler.cell_times.update(cell_times)
+
+
+def evaluate_formulae_in_levels(worksheet, context):
+    graph, _ = build_recalculation_graph(worksheet)
+    for level in topological_levels(graph):
+        for location in level:
+            evaluate_node(location, context)
+
+
+def evaluate_formulae_in_processes(worksheet, context):
+    graph, _ = build_recalculation_graph(worksheet)
+    components = filter(None, [
+        [location for location in component if not is_range_dependency(location)]
+        for component in partition_dependency_graph(graph)
+    ])
+
+    num_processes = min(
+        getattr(settings, 'RECALCULATION_PROCESSES', None) or cpu_count(),
+        len(components)
+    )
+    if num_processes < 2:
+        for component in components:
+            for location in component:
+                evaluate_cell(location, context)
+        return
+
+    # Workers are forked, so they inherit the context -- including anything
+    # the usercode defined -- without it needing to be pickled.
+    pool = Pool(num_processes, _initialise_worker_process, (components, context))
+    try:
+        results = pool.map_async(
+            _evaluate_component_in_worker, range(len(components))
+        ).get(MAX_PROCESS_POOL_WAIT_SECONDS)
+    finally:
+        pool.terminate()
 
-    for _ in range(NUM_THREADS):
-        recalculator_thread = Thread(target=create_cell_recalculator(leaf_queue, unrecalculated_queue, graph, context))
-        recalculator_thread.setDaemon(True)
-        recalculator_thread.start()
+    for component, pickled_results in zip(components, results):
+        if pickled_results is not None:
+            try:
+                _merge_component_results(pickled_results, context)
+                continue
+            except Exception:
+                pass
+        for location in component:
+            evaluate_cell(location, context)
 
-    for leaf in leaves:
-        leaf_queue.put(leaf)
 
-    unrecalculated_queue.join()
+def get_formulae_evaluator(engine):
+    if engine is None:
+        engine = getattr(settings, 'RECALCULATION_ENGINE', 'threads')
+    if engine == 'processes':
+        return evaluate_formulae_in_processes
+    if engine == 'levels':
+        return evaluate_formulae_in_levels
+    return evaluate_formulae_in_context
 
 
 def execute_usercode(usercode, context):
     exec(usercode, context)
 
 
-def calculate_with_timeout(worksheet, usercode, timeout_seconds, private_key):
-    it = InterruptableThread(target=calculate, args=(worksheet, usercode, private_key))
+def calculate_with_timeout(
+    worksheet, usercode, timeout_seconds, private_key, engine=None, profile=False
+):
+    it = InterruptableThread(
+        target=calculate,
+        args=(worksheet, usercode, private_key, engine, profile)
+    )
     it.start()
     it.join(timeout_seconds)
+    finished = True
     while it.isAlive():
+        finished = False
         it.interrupt()
         sleep(0.1)
+    return finished
 
 
-def calculate(worksheet, usercode, private_key):
+def calculate(worksheet, usercode, private_key, engine=None, profile=False):
+    worksheet._profile = None
+    if profile or getattr(settings, 'PROFILE_RECALCULATION', False):
+        worksheet._profiler = RecalcProfiler()
     recalc_start = time()
-    _calculate(worksheet, usercode, private_key)
+    try:
+        _calculate(worksheet, usercode, private_key, engine)
+    finally:
+        profiler, worksheet._profiler = worksheet._profiler, None
     recalc_length = time() - recalc_start
     worksheet.add_console_text('Took %.2fs' % (recalc_length,), log_type='system')
+    if profiler is not None:
+        worksheet._profile = profiler.as_dict(
+            getattr(settings, 'PROFILE_TOP_CELLS', PROFILE_TOP_CELLS)
+        )
+        worksheet.add_console_text(
+            format_profile(worksheet._profile), log_type='system'
+        )
+
+
+def hash_usercode(usercode):
+    return md5(usercode.encode('utf-8')).hexdigest()
+
 
+def _prepare_recalc_locations(worksheet, usercode):
+    if not getattr(settings, 'INCREMENTAL_RECALCULATION', False):
+        worksheet._usercode_hash = None
+        return None
 
-def _calculate(worksheet, usercode, private_key):
-    worksheet.clear_values()
+    usercode_hash = hash_usercode(usercode)
+    can_recalc_incrementally = (
+        worksheet._dirty_locations is not None and
+        worksheet._usercode_hash == usercode_hash
+    )
+    worksheet._usercode_hash = usercode_hash
+    if can_recalc_incrementally:
+        return _add_values_lost_in_storage(
+            worksheet, find_dependents(worksheet, worksheet._dirty_locations)
+        )
+    return None
+
+
+def _add_values_lost_in_storage(worksheet, locations):
+    # Along with the cells whose values didn't survive being saved that the
+    # given ones use, and everything depending on those.
+    if not worksheet._values_lost_in_storage:
+        return locations
+    index = get_dependency_index(worksheet)
+    while True:
+        needed = set(
+            loc for loc in worksheet._values_lost_in_storage - locations
+            if index.dependents(loc) & locations
+        )
+        if not needed:
+            return locations
+        locations |= find_dependents(worksheet, needed)
+
+
+def _calculate(worksheet, usercode, private_key, engine=None):
+    worksheet._recalc_locations = _prepare_recalc_locations(worksheet, usercode)
+    worksheet._dirty_locations = None
+    worksheet.clear_values(worksheet._recalc_locations)
     worksheet._console_text = ''
     worksheet._usercode_error = None
 
@@ -152,12 +498,24 @@ def _calculate(worksheet, usercode, private_key):
         'sys': sys,
     }
     context['run_worksheet'] = lambda url, overrides=None: run_worksheet(url, overrides, private_key)
-    context['evaluate_formulae'] = lambda worksheet: evaluate_formulae_in_context(worksheet, context)
+    evaluate_formulae = get_formulae_evaluator(engine)
+    profiler = worksheet._profiler
+    if profiler is not None:
+        evaluate_formulae = profiler.timed_evaluator(evaluate_formulae)
+    context['evaluate_formulae'] = lambda worksheet: evaluate_formulae(worksheet, context)
     old_stdout = sys.stdout
     sys.stdout = MyStdout(worksheet)
 
     try:
+        if profiler is not None:
+            profiler.usercode_start = time()
         execute_usercode(usercode, context)
+        if worksheet._recalc_locations is None:
+            worksheet._values_lost_in_storage = set()
+        else:
+            worksheet._values_lost_in_storage -= worksheet._recalc_locations
+        if worksheet._usercode_hash is not None:
+            worksheet._dirty_locations = set()
     except Exception as e:
         if isinstance(e, SyntaxError):
             error = 'Syntax error at character %d' % (e.offset,)
@@ -170,7 +528,10 @@ def _calculate(worksheet, usercode, private_key):
             worksheet.add_console_text("%s\n%s\n" % (error, format_traceback(traceback.extract_tb(tb))))
         worksheet._usercode_error = {"message": error, "line": line_no}
     finally:
+        if profiler is not None:
+            profiler.usercode_end = time()
         sys.stdout = old_stdout
+        worksheet._recalc_locations = None
 
 
 def format_traceback(frames):
@@ -231,7 +592,8 @@ def api_json_to_worksheet(sheet_json):
     for key, value in sheet_values.iteritems():
         if key == "usercode_error":
             worksheet._usercode_error = value
-        elif isinstance(value, dict):
+        elif isinstance(value, dict) and key.isdigit():
+            # other dicts, like the "profile" of a profiled recalc, aren't columns
             rows = value
             col = int(key)
             for row, value in rows.iteritems():
@@ -2,11 +2,74 @@
 # See LICENSE.md
 #
 
+from multiprocessing import Pool
+
+from .formula_fast_path import parse_simple_formula
 from .formula_interpreter import (
         get_dependencies_from_parse_tree,
         get_python_formula_from_parse_tree
 )
 from .parser import FormulaError, parser
+from .utils.lru_cache import LRUCache
+
+
+FORMULA_PARSE_CACHE_SIZE = 10000
+# Below this many distinct formulae, starting worker processes costs more
+# than it saves.
+PARALLEL_PARSE_MINIMUM = 1000
+
+# Formula text -> (dependencies, python_formula), so that bulk operations on
+# filled-down formulae only run the parser once per distinct formula.
+formula_parse_cache = LRUCache(FORMULA_PARSE_CACHE_SIZE)
+
+
+def parse_formula(formula):
+    parsed = formula_parse_cache.get(formula)
+    if parsed is None:
+        simple = parse_simple_formula(formula)
+        if simple is not None:
+            dependencies, python_formula = simple
+        else:
+            try:
+                parse_tree = parser.parse(formula)
+                dependencies = get_dependencies_from_parse_tree(parse_tree)
+                python_formula = get_python_formula_from_parse_tree(parse_tree)
+            except FormulaError, e:
+                dependencies = []
+                python_formula = '_raise(FormulaError("{}"))'.format(e)
+        parsed = (tuple(dependencies), python_formula)
+        formula_parse_cache.put(formula, parsed)
+    return parsed
+
+
+def reset_parse_locks():
+    # For a forked worker process: only the forking thread carries on there,
+    # so a lock that another thread held at the fork would stay locked for
+    # good.
+    formula_parse_cache.reset_lock()
+    parser.reset_build_lock()
+
+
+def parse_formulae(formulae, processes=None):
+    # Parses each distinct formula among many just once, optionally spread
+    # across worker processes.  Returns a dict from formula to what
+    # parse_formula gives; constants aren't parsed, so aren't in it.
+    to_parse = list(set(
+        formula for formula in formulae
+        if isinstance(formula, basestring) and formula.startswith('=')
+    ))
+    if processes > 1 and len(to_parse) >= PARALLEL_PARSE_MINIMUM:
+        pool = Pool(processes, reset_parse_locks)
+        try:
+            parsed = pool.map(
+                parse_formula, to_parse, len(to_parse) // (processes * 4) + 1
+            )
+        finally:
+            pool.terminate()
+            pool.join()
+    else:
+        parsed = map(parse_formula, to_parse)
+    return dict(zip(to_parse, parsed))
 
 
 
@@ -18,38 +81,56 @@ class Undefined(object):
 
 undefined = Undefined()
 
+# Values whose formatted_value can wait until something asks for it: their
+# unicode() can't fail and won't change later.  Anything else is formatted
+# as it's set, so that errors doing so are the formula's.
+LAZILY_FORMATTED_TYPES = frozenset([
+    int, long, float, bool, unicode, type(None), Undefined
+])
+
 
 class Cell(object):
+    __slots__ = (
+        '_value', '_formula', '_python_formula', 'dependencies',
+        '_formatted_value', 'error',
+    )
+
+    # How many times a formula has been changed through a cell's public
+    # setters, which the worksheet doesn't hear about (eg. from usercode), so
+    # that the dependency index knows when it has to look at every cell.
+    # Worksheets change formulae with the private setters and tell the index
+    # themselves.
+    formula_changes = 0
 
     def __init__(self):
-        self.clear()
+        self._clear()
 
 
-    def _set_formula(self, value):
+    def _set_formula(self, value, parsed=None):
         self._python_formula = None
         if value is None:
             self._formula = None
         elif type(value) == str or type(value) == unicode:
             self._formula = value
             if value.startswith('='):
-                try:
-                    parsed_formula = parser.parse(value)
-                    self.dependencies = get_dependencies_from_parse_tree(parsed_formula)
-                    self._python_formula = get_python_formula_from_parse_tree(parsed_formula)
-                except FormulaError, e:
-                    self.dependencies = []
-                    self._python_formula = '_raise(FormulaError("{}"))'.format(e)
+                dependencies, self._python_formula = parsed or parse_formula(value)
+                self.dependencies = list(dependencies)
         else:
             raise TypeError('cell formula must be str or unicode')
 
     def _get_formula(self):
         return self._formula
 
-    formula = property(_get_formula, _set_formula)
+    def _change_formula(self, value):
+        Cell.formula_changes += 1
+        self._set_formula(value)
+
+    formula = property(_get_formula, _change_formula)
 
 
     def _set_python_formula(self, value):
         if type(value) == str or type(value) == unicode:
+            Cell.formula_changes += 1
             self._python_formula = value
         else:
             raise TypeError('cell python_formula must be str or unicode')
@@ -62,8 +143,8 @@ class Cell(object):
 
     def _set_value(self, value):
         self._value = value
-        if value is undefined:
-            self._set_formatted_value(u'')
+        if type(value) in LAZILY_FORMATTED_TYPES:
+            self._formatted_value = None
         else:
             self._set_formatted_value(unicode(value))
 
@@ -73,6 +154,8 @@ class Cell(object):
     value = property(_get_value, _set_value)
 
     def clear_value(self):
+        if self._formatted_value is None:
+            self._get_formatted_value()
         self._value = undefined
 
 
@@ -85,12 +168,21 @@ class Cell(object):
             raise TypeError('cell formatted_value must be str or unicode')
 
     def _get_formatted_value(self):
-        return self._formatted_value
+        formatted_value = self._formatted_value
+        if formatted_value is None:
+            value = self._value
+            formatted_value = u'' if value is undefined else unicode(value)
+            self._formatted_value = formatted_value
+        return formatted_value
 
     formatted_value = property(_get_formatted_value, _set_formatted_value)
 
 
     def clear(self):
+        Cell.formula_changes += 1
+        self._clear()
+
+    def _clear(self):
         self._value = undefined
         self._formula = None
         self._python_formula = None
@@ -112,7 +204,7 @@ class Cell(object):
             isinstance(other, Cell) and
             self._formula == other.formula and
             self._value == other.value and
-            self._formatted_value == other.formatted_value and
+            self.formatted_value == other.formatted_value and
             self.error == other.error
         )
 
@@ -49,8 +49,7 @@ class CellRange(object):
 
 
     def __iter__(self):
-        for location in self.locations:
-            yield self.worksheet[location].value
+        return self.worksheet._cell_values(self.locations)
 
 
     @property
@@ -88,5 +87,6 @@ class CellRange(object):
 
 
     def clear(self):
-        for cell in self.cells:
+        for location, cell in self.locations_and_cells:
             cell.clear()
+            self.worksheet.mark_dirty(location)
@@ -9,7 +9,7 @@ import StringIO
 from django.db import models
 from django.contrib.auth.models import User
 
-from .cell import Cell
+from .cell import Cell, parse_formulae
 from .rewrite_formula_offset_cell_references import (
     rewrite_formula, rewrite_source_sheet_formulae_for_cut
 )
@@ -99,23 +99,32 @@ class Clipboard(models.Model):
 
         strings_dict = json.loads(self.contents_json)
 
+        pasted = []
         for col in xrange(0, end_col - start_col + 1):
             for row in xrange(0, end_row - start_row + 1):
 
                 clip_loc = col % self.width, row % self.height
 
                 clip_cell = strings_dict['%s,%s' % clip_loc]
-                dest_cell = Cell()
+                formula = None
                 if clip_cell['formula']:
                     column_offset, row_offset = self._get_offset(col, row, start_col, start_row)
-                    dest_cell.formula = rewrite_formula(
+                    formula = rewrite_formula(
                         clip_cell['formula'], column_offset, row_offset,
                         self.is_cut, self.source_range
                     )
-
-                dest_cell.formatted_value = clip_cell['formatted_value']
                 dest_loc = col + start_col, row + start_row
-                yield (dest_loc, dest_cell)
+                pasted.append((dest_loc, formula, clip_cell['formatted_value']))
+
+        # Constants and absolute references repeat across a big paste, so
+        # parse each distinct formula just once.
+        parsed = parse_formulae(formula for _, formula, _ in pasted)
+        for dest_loc, formula, formatted_value in pasted:
+            dest_cell = Cell()
+            if formula is not None:
+                dest_cell._set_formula(formula, parsed.get(formula))
+            dest_cell.formatted_value = formatted_value
+            yield (dest_loc, dest_cell)
 
 
     def paste_to(self, to_sheet, start, end):
@@ -0,0 +1,483 @@
+# Copyright (c) 2010 Resolver Systems Ltd, PythonAnywhere LLP
+# See LICENSE.md
+#
+
+from array import array
+
+from django.conf import settings
+
+from .cell import Cell, undefined
+from .eval_constant import eval_constant
+from .worksheet import InvalidKeyError, Worksheet
+
+
+# A Worksheet keeps a Cell, with its own __dict__, for every location, which
+# for big data sheets -- mostly numeric constants -- runs to hundreds of
+# bytes a cell.  A ColumnarWorksheet keeps those numbers in a typed array per
+# column instead, with a byte per row saying what's there, and only the
+# other cells (formulae, text, errors) in the dict.  Indexing it gives a
+# _NumberCell, a view onto the arrays which turns into an ordinary Cell in
+# the dict as soon as it's changed into something the arrays can't hold.
+#
+# dict() and dict.copy() on a dict subclass only see what's in the dict
+# itself, so code wanting every cell of any worksheet uses
+# dict(worksheet.iteritems()).
+
+PRESENT = 1
+FLOAT = 2
+LOADED = 4  # the value is set, as it is once load_constants has run
+
+# Beyond 2**53, doubles can't hold every int.
+MAX_EXACT_INT = 2 ** 53
+
+# Rows further than this past the end of a column's arrays go in the dict
+# instead, so a stray number a million rows down doesn't cost megabytes.
+ARRAY_GROWTH_MINIMUM = 4096
+
+_UNLOAD = bytearray(
+    kind & ~LOADED for kind in range(256)
+)
+_LOAD = bytearray(
+    kind | LOADED if kind else 0 for kind in range(256)
+)
+
+
+def worksheet_class():
+    if getattr(settings, 'COLUMNAR_WORKSHEETS', False):
+        return ColumnarWorksheet
+    return Worksheet
+
+
+def number_from_formula(formula):
+    # The number a constant formula evaluates to, if that's all there is to
+    # it -- ie. the formula is how the number would be written anyway.
+    if not isinstance(formula, basestring) or formula.startswith('='):
+        return None
+    number = eval_constant(formula)
+    if type(number) is int:
+        if not -MAX_EXACT_INT <= number <= MAX_EXACT_INT:
+            return None
+    elif type(number) is not float:
+        return None
+    if unicode(number) != formula:
+        return None
+    return number
+
+
+
+class _NumberColumn(object):
+    __slots__ = ('values', 'kinds')
+
+    def __init__(self):
+        self.values = array('d')
+        self.kinds = bytearray()
+
+
+    def grow(self, length):
+        extra = length - len(self.kinds)
+        self.kinds.extend(bytearray(extra))
+        self.values.extend(array('d', [0.0]) * extra)
+
+
+
+class _NumberCell(Cell):
+    __slots__ = ('_worksheet', '_location', '_cell')
+
+    def __init__(self, worksheet, location):
+        self._worksheet = worksheet
+        self._location = location
+        self._cell = None
+
+
+    def _number(self):
+        # (kind, number), or None once this is an ordinary Cell
+        if self._cell is not None:
+            return None
+        kind, number = self._worksheet._number_at(self._location)
+        if not kind:
+            # Taken out of the arrays behind our back
+            self._cell = Cell()
+            return None
+        return kind, number
+
+
+    def _promote(self):
+        if self._cell is None:
+            self._cell = self._worksheet._promote_number(self._location)
+        return self._cell
+
+
+    def _get_formula(self):
+        number = self._number()
+        if number is None:
+            return self._cell.formula
+        return unicode(number[1])
+
+    def _set_formula(self, value, parsed=None):
+        number = self._number()
+        if number is not None:
+            kind, old_number = number
+            if value == unicode(old_number):
+                return
+            new_number = number_from_formula(value)
+            if new_number is not None and not kind & LOADED:
+                self._worksheet._store_number(self._location, new_number, False)
+                return
+        self._promote()._set_formula(value, parsed)
+
+    def _change_formula(self, value):
+        Cell.formula_changes += 1
+        self._set_formula(value)
+
+    formula = property(_get_formula, _change_formula)
+
+
+    def _get_python_formula(self):
+        if self._number() is None:
+            return self._cell.python_formula
+        return None
+
+    def _set_python_formula(self, value):
+        self._promote().python_formula = value
+
+    python_formula = property(_get_python_formula, _set_python_formula)
+
+
+    def _get_dependencies(self):
+        if self._number() is None:
+            return self._cell.dependencies
+        return []
+
+    def _set_dependencies(self, value):
+        if value or self._number() is None:
+            self._promote().dependencies = value
+
+    dependencies = property(_get_dependencies, _set_dependencies)
+
+
+    def _get_value(self):
+        number = self._number()
+        if number is None:
+            return self._cell.value
+        kind, value = number
+        if not kind & LOADED:
+            return undefined
+        return value
+
+    def _set_value(self, value):
+        number = self._number()
+        if number is not None:
+            kind, old_value = number
+            if value is undefined:
+                self._worksheet._store_number(self._location, old_value, False)
+                return
+            if type(value) is type(old_value) and value == old_value:
+                self._worksheet._store_number(self._location, old_value, True)
+                return
+        self._promote().value = value
+
+    value = property(_get_value, _set_value)
+
+
+    def clear_value(self):
+        self.value = undefined
+
+
+    def _get_formatted_value(self):
+        number = self._number()
+        if number is None:
+            return self._cell.formatted_value
+        kind, value = number
+        return unicode(value) if kind & LOADED else u''
+
+    def _set_formatted_value(self, value):
+        if (value or u'') != self.formatted_value or self._number() is None:
+            self._promote().formatted_value = value
+
+    formatted_value = property(_get_formatted_value, _set_formatted_value)
+
+
+    def _get_error(self):
+        if self._number() is None:
+            return self._cell.error
+        return None
+
+    def _set_error(self, value):
+        if value is not None or self._number() is None:
+            self._promote().error = value
+
+    error = property(_get_error, _set_error)
+
+
+    def clear(self):
+        self._promote().clear()
+
+
+    def __repr__(self):
+        if self._number() is None:
+            return repr(self._cell)
+        return '<Cell formula=%s value=%r formatted_value=%r>' % (
+            self.formula, self.value, self.formatted_value
+        )
+
+
+    def __eq__(self, other):
+        return (
+            isinstance(other, Cell) and
+            self.formula == other.formula and
+            self.value == other.value and
+            self.formatted_value == other.formatted_value and
+            self.error == other.error
+        )
+
+
+
+class ColumnarWorksheet(Worksheet):
+
+    def __init__(self):
+        Worksheet.__init__(self)
+        self._columns = {}
+        self._number_count = 0
+
+
+    def _number_at(self, (col, row)):
+        column = self._columns.get(col)
+        if column is None or not 0 < row <= len(column.kinds):
+            return 0, None
+        kind = column.kinds[row - 1]
+        if not kind:
+            return 0, None
+        number = column.values[row - 1]
+        if not kind & FLOAT:
+            number = int(number)
+        return kind, number
+
+
+    def _store_number(self, (col, row), number, loaded):
+        # False if the location is too far out to go in the arrays.
+        if col < 1 or row < 1:
+            return False
+        column = self._columns.get(col)
+        if column is None:
+            if row > ARRAY_GROWTH_MINIMUM:
+                return False
+            column = self._columns[col] = _NumberColumn()
+        length = len(column.kinds)
+        if row > length:
+            if row > 2 * length + ARRAY_GROWTH_MINIMUM:
+                return False
+            column.grow(row)
+        if not column.kinds[row - 1]:
+            self._number_count += 1
+        column.values[row - 1] = number
+        column.kinds[row - 1] = (
+            PRESENT | (FLOAT if type(number) is float else 0) |
+            (LOADED if loaded else 0)
+        )
+        return True
+
+
+    def _remove_number(self, (col, row)):
+        column = self._columns.get(col)
+        if column is None or not 0 < row <= len(column.kinds):
+            return False
+        if not column.kinds[row - 1]:
+            return False
+        column.kinds[row - 1] = 0
+        self._number_count -= 1
+        return True
+
+
+    def _promote_number(self, location):
+        # Moves a number out of the arrays and into the dict as a Cell.
+        kind, number = self._number_at(location)
+        cell = Cell()
+        cell._set_formula(unicode(number))
+        if kind & LOADED:
+            cell.value = number
+        self._remove_number(location)
+        dict.__setitem__(self, location, cell)
+        return cell
+
+
+    def _number_locations(self):
+        for col, column in self._columns.iteritems():
+            for index, kind in enumerate(column.kinds):
+                if kind:
+                    yield col, index + 1
+
+
+    def _adopt_cell(self, location, cell):
+        if not (
+            cell.python_formula or cell.dependencies or cell.error or
+            dict.__contains__(self, location)
+        ):
+            number = number_from_formula(cell.formula)
+            if number is not None:
+                if cell.value is undefined and not cell.formatted_value:
+                    if self._store_number(location, number, False):
+                        return
+                elif (
+                    type(cell.value) is type(number) and
+                    cell.value == number and cell.formatted_value == cell.formula
+                ):
+                    if self._store_number(location, number, True):
+                        return
+        Worksheet._adopt_cell(self, location, cell)
+
+
+    def __getitem__(self, key):
+        location = self.to_location(key)
+        if not location:
+            raise InvalidKeyError("%r is not a valid cell location" % (key,))
+
+        cell = dict.get(self, location)
+        if cell is not None:
+            return cell
+        if self._number_at(location)[0]:
+            return _NumberCell(self, location)
+        return self.setdefault(location, Cell())
+
+
+    def __setitem__(self, key, item):
+        location = self.to_location(key)
+        if location:
+            self._remove_number(location)
+        Worksheet.__setitem__(self, key, item)
+
+
+    def __delitem__(self, key):
+        location = self.to_location(key)
+        if location and self._remove_number(location):
+            self.mark_dirty(location)
+        else:
+            Worksheet.__delitem__(self, key)
+
+
+    def __contains__(self, location):
+        return (
+            dict.__contains__(self, location) or
+            (isinstance(location, tuple) and len(location) == 2 and
+             bool(self._number_at(location)[0]))
+        )
+
+    has_key = __contains__
+
+
+    def __len__(self):
+        return dict.__len__(self) + self._number_count
+
+
+    def __iter__(self):
+        for location in dict.__iter__(self):
+            yield location
+        for location in self._number_locations():
+            yield location
+
+    iterkeys = __iter__
+
+
+    def keys(self):
+        return list(self.iterkeys())
+
+
+    def iteritems(self):
+        for item in dict.iteritems(self):
+            yield item
+        for location in self._number_locations():
+            yield location, _NumberCell(self, location)
+
+
+    def items(self):
+        return list(self.iteritems())
+
+
+    def itervalues(self):
+        for _, cell in self.iteritems():
+            yield cell
+
+
+    def values(self):
+        return list(self.itervalues())
+
+
+    def get(self, location, default=None):
+        if location in self:
+            return self[location]
+        return default
+
+
+    def _load_constants_in_bulk(self):
+        # The numbers in the arrays are the values of their own formulae
+        for column in self._columns.itervalues():
+            column.kinds = column.kinds.translate(_LOAD)
+        return dict.keys(self)
+
+
+    def _cell_values(self, locations):
+        columns = self._columns
+        for location in locations:
+            cell = dict.get(self, location)
+            if cell is not None:
+                yield cell.value
+                continue
+            col, row = location
+            column = columns.get(col)
+            if column is not None and 0 < row <= len(column.kinds):
+                kind = column.kinds[row - 1]
+                if kind:
+                    if not kind & LOADED:
+                        yield undefined
+                    elif kind & FLOAT:
+                        yield column.values[row - 1]
+                    else:
+                        yield int(column.values[row - 1])
+                    continue
+            yield self[location].value
+
+
+    def set_cell_formula(self, col, row, formula):
+        if formula:
+            self.set_cell_formulae([((col, row), formula)])
+        else:
+            Worksheet.set_cell_formula(self, col, row, formula)
+
+
+    def set_cell_formulae(self, formulae, processes=None):
+        by_location = {}
+        for key, formula in formulae:
+            location = self.to_location(key)
+            if not location:
+                raise InvalidKeyError("%r is not a valid cell location" % (key,))
+            by_location[location] = formula
+        others = []
+        for location, formula in by_location.iteritems():
+            number = number_from_formula(formula)
+            kind = self._number_at(location)[0]
+            if (
+                number is not None and not kind & LOADED and
+                not dict.__contains__(self, location) and
+                self._store_number(location, number, False)
+            ):
+                self.mark_dirty(location)
+            else:
+                if kind:
+                    self._promote_number(location)
+                others.append((location, formula))
+        Worksheet.set_cell_formulae(self, others, processes)
+
+
+    def clear_values(self, locations=None):
+        if locations is None:
+            for column in self._columns.itervalues():
+                column.kinds = column.kinds.translate(_UNLOAD)
+            Worksheet.clear_values(self, dict.keys(self))
+            return
+        in_dict = []
+        for location in locations:
+            kind, number = self._number_at(location)
+            if kind:
+                self._store_number(location, number, False)
+            else:
+                in_dict.append(location)
+        Worksheet.clear_values(self, in_dict)
@@ -2,9 +2,14 @@
 # See LICENSE.md
 #
 
-from threading import Lock
+from collections import deque
+from itertools import chain
 
+from django.conf import settings
+
+from .cell import Cell
 from .errors import report_cell_error, CycleError
+from .location_index import is_range_dependency, LocationIndex
 
 
 class Node(object):
@@ -12,7 +17,6 @@ class Node(object):
         self.location = location
         self.children = children if children else set()
         self.parents = parents if parents else set()
-        self.lock = Lock()
 
     def __eq__(self, other):
         return (
@@ -25,30 +29,309 @@ class Node(object):
         return not self.__eq__(other)
 
     def __repr__(self):
-        return "<Node %d,%d children={%s} parents={%s}>" % (
-            self.location[0], self.location[1],
+        return "<Node %s children={%s} parents={%s}>" % (
+            ','.join(map(str, self.location)),
             ', '.join(str(i) for i in self.children),
             ', '.join(str(i) for i in self.parents))
 
-    def remove_from_parents(self, parent_nodes, leaf_queue):
-        for parent in parent_nodes:
-            parent.lock.acquire()
-            parent.children.remove(self.location)
-            if len(parent.children) == 0:
-                leaf_queue.put(parent.location)
-            parent.lock.release()
 
 
+class DependencyIndex(object):
+    # The formula cells each formula cell refers to directly, and where its
+    # ranges are, kept with the worksheet between recalcs and patched as cells
+    # change.
+    #
+    # Ranges aren't expanded into an edge to every formula cell inside them.
+    # Instead each column of a range is split into blocks of rows whose sizes
+    # are powers of two, starting at a multiple of their size, and each block
+    # is a node in the graph whose children are its two halves (or the
+    # formula cell in a half, if there's only one).  Blocks are shared between
+    # overlapping ranges, so a column of N running totals over N formula cells
+    # makes O(N log N) edges rather than O(N * N).  Blocks are keyed like
+    # single-column ranges, (col, top, col, bottom).
+
+    def __init__(self):
+        self.children = {}
+        self._dependencies = {}
+        self._formula_locations = LocationIndex()
+        self._references = {}
+        self._range_references = {}
+        self._block_references = {}
+        self._max_block_size = 1
+        self._formula_changes_seen = Cell.formula_changes
+
+
+    @classmethod
+    def from_worksheet(cls, worksheet):
+        index = cls()
+        formula_cells = [
+            (loc, cell) for loc, cell in worksheet.iteritems()
+            if cell.python_formula
+        ]
+        index._formula_locations = LocationIndex(loc for loc, _ in formula_cells)
+        for loc, cell in formula_cells:
+            index._add_references(loc, cell.dependencies)
+            index.children[loc] = index._formula_dependencies(cell.dependencies)
+        return index
+
+
+    @classmethod
+    def from_children(cls, worksheet, children):
+        # Trusts the saved edges; the cells' dependencies they were built
+        # from were saved alongside them.
+        index = cls()
+        index._formula_locations = LocationIndex(children)
+        for loc, dependencies in children.iteritems():
+            cell = dict.get(worksheet, loc)
+            index._add_references(loc, cell.dependencies if cell else [])
+            index.children[loc] = set(dependencies)
+        return index
+
+
+    def update(self, location, cell):
+        was_formula = location in self.children
+        is_formula = cell is not None and bool(cell.python_formula)
+        if was_formula:
+            self._remove_references(location, self._dependencies[location])
+            del self.children[location]
+            if not is_formula:
+                self._formula_locations.discard(location)
+        if is_formula:
+            self._formula_locations.add(location)
+            self._add_references(location, cell.dependencies)
+            self.children[location] = self._formula_dependencies(cell.dependencies)
+
+        if was_formula != is_formula:
+            # Ranges find the formula cells in them as they're needed
+            for dependent in self._references.get(location, ()):
+                if is_formula:
+                    self.children[dependent].add(location)
+                else:
+                    self.children[dependent].discard(location)
+
+
+    def refresh(self, worksheet):
+        # Catches changes made without going through the worksheet, for
+        # example usercode setting a Cell's formula directly.  Cells count
+        # those, so every cell only needs checking if there have been some
+        # since the last check; otherwise only the worksheet's dirty
+        # locations, if it's tracking them, can have changed.
+        if Cell.formula_changes == self._formula_changes_seen:
+            if worksheet._dirty_locations is not None:
+                for loc in worksheet._dirty_locations:
+                    self._refresh_location(loc, dict.get(worksheet, loc))
+            return
+        self._formula_changes_seen = Cell.formula_changes
+        for loc, cell in worksheet.iteritems():
+            self._refresh_location(loc, cell)
+        for loc in [loc for loc in self.children if loc not in worksheet]:
+            self.update(loc, None)
+
+
+    def _refresh_location(self, loc, cell):
+        if cell is not None and cell.python_formula:
+            if self._dependencies.get(loc) != cell.dependencies:
+                self.update(loc, cell)
+        elif loc in self.children:
+            self.update(loc, cell)
+
+
+    def dependents(self, location):
+        dependents = set(self._references.get(location, ()))
+        col, row = location
+        size = 1
+        while size <= self._max_block_size:
+            top = (row - 1) // size * size + 1
+            dependents |= self._block_references.get((col, top, top + size - 1), set())
+            size *= 2
+        return dependents
+
+
+    def node_children(self, node):
+        # A formula cell's children in the graph are the formula cells it
+        # refers to directly and the blocks its ranges split into; a block's
+        # are its halves.
+        if is_range_dependency(node):
+            col, top, _, bottom = node
+            middle = (top + bottom) // 2
+            halves = [
+                self._block_node(col, top, middle),
+                self._block_node(col, middle + 1, bottom),
+            ]
+            return set(half for half in halves if half is not None)
+        children = set(self.children[node])
+        for dependency in self._dependencies[node]:
+            if is_range_dependency(dependency):
+                left, top, right, bottom = dependency
+                for col in self._formula_locations.columns_in(left, right):
+                    for block_top, block_bottom in _aligned_blocks(top, bottom):
+                        block = self._block_node(col, block_top, block_bottom)
+                        if block is not None:
+                            children.add(block)
+        return children
+
+
+    def _block_node(self, col, top, bottom):
+        # None for a block with no formula cells, and just the cell for one
+        # with a single formula cell.
+        count, first_row = self._formula_locations.count_in_column(col, top, bottom)
+        if count == 0:
+            return None
+        if count == 1:
+            return col, first_row
+        return col, top, col, bottom
+
+
+    def references_within(self, (left, top, right, bottom)):
+        # The formula cells that refer to a location inside the given bounds,
+        # or to a range entirely inside them -- ie. the ones whose formulae
+        # change when the cells in the bounds are cut and pasted elsewhere.
+        referencing = set()
+        area = (right - left + 1) * (bottom - top + 1)
+        if area <= len(self._references):
+            for col in xrange(left, right + 1):
+                for row in xrange(top, bottom + 1):
+                    referencing |= self._references.get((col, row), set())
+        else:
+            for (col, row), locations in self._references.iteritems():
+                if left <= col <= right and top <= row <= bottom:
+                    referencing |= locations
+        for col in xrange(left, right + 1):
+            for (range_left, range_top, range_right, range_bottom), locations in (
+                self._range_references.get(col, {}).iteritems()
+            ):
+                if (
+                    range_left >= left and range_right <= right and
+                    range_top >= top and range_bottom <= bottom
+                ):
+                    referencing |= locations
+        return referencing
+
+
+    def _formula_dependencies(self, dependencies):
+        return set(
+            dependency for dependency in dependencies
+            if not is_range_dependency(dependency) and
+            dependency in self._formula_locations
+        )
+
+
+    def _add_references(self, location, dependencies):
+        self._dependencies[location] = list(dependencies)
+        for dependency in dependencies:
+            if is_range_dependency(dependency):
+                left, top, right, bottom = dependency
+                for col in xrange(left, right + 1):
+                    self._range_references.setdefault(col, {}).setdefault(
+                        dependency, set()
+                    ).add(location)
+                    for block_top, block_bottom in _aligned_blocks(top, bottom):
+                        self._block_references.setdefault(
+                            (col, block_top, block_bottom), set()
+                        ).add(location)
+                        self._max_block_size = max(
+                            self._max_block_size, block_bottom - block_top + 1
+                        )
+            else:
+                self._references.setdefault(dependency, set()).add(location)
+
 
+    def _remove_references(self, location, dependencies):
+        del self._dependencies[location]
+        for dependency in dependencies:
+            if is_range_dependency(dependency):
+                left, top, right, bottom = dependency
+                for col in xrange(left, right + 1):
+                    ranges = self._range_references[col]
+                    _discard_from(ranges, dependency, location)
+                    if not ranges:
+                        del self._range_references[col]
+                    for block_top, block_bottom in _aligned_blocks(top, bottom):
+                        _discard_from(
+                            self._block_references, (col, block_top, block_bottom), location
+                        )
+            else:
+                _discard_from(self._references, dependency, location)
+
+
+
+def _aligned_blocks(top, bottom):
+    # Rows top to bottom as the fewest blocks whose sizes are powers of two,
+    # each starting (counting rows from zero) at a multiple of its size.
+    start, end = top - 1, bottom
+    while start < end:
+        size = start & -start if start else 1 << end.bit_length()
+        while size > end - start:
+            size //= 2
+        yield start + 1, start + size
+        start += size
+
+
+def _discard_from(sets_by_key, key, value):
+    values = sets_by_key.get(key)
+    if values is not None:
+        values.discard(value)
+        if not values:
+            del sets_by_key[key]
+
+
+def persist_dependency_index():
+    # The index is rebuilt from the cells' saved dependencies when it's next
+    # needed, which takes about as long as loading its saved edges would, so
+    # saving it with the worksheet is optional.
+    return getattr(settings, 'PERSIST_DEPENDENCY_INDEX', False)
+
+
+def get_dependency_index(worksheet):
+    if worksheet._dependency_index is None:
+        worksheet._dependency_index = DependencyIndex.from_worksheet(worksheet)
+    else:
+        worksheet._dependency_index.refresh(worksheet)
+    return worksheet._dependency_index
+
+
+class _NodeChildren(dict):
+    # The children of each node of the graph, worked out from the index as
+    # they're needed; only those among the given locations (and the range
+    # blocks that might lead to them) if there are any.
+
+    def __init__(self, index, locations=None):
+        self._index = index
+        self._locations = locations
+
+
+    def __missing__(self, node):
+        children = self._index.node_children(node)
+        if self._locations is not None:
+            children = set(
+                child for child in children
+                if child in self._locations or is_range_dependency(child)
+            )
+        self[node] = children
+        return children
+
+
+def build_dependency_graph(worksheet, locations=None):
+    # Just for the given locations, if there are any, leaving out whatever
+    # they depend on outside them.
+    index = get_dependency_index(worksheet)
+    dependencies = _NodeChildren(index, locations)
+    if locations is None:
+        locations = worksheet.iterkeys()
+    formula_cells = [loc for loc in locations if loc in index.children]
 
-def build_dependency_graph(worksheet):
     graph = {}
-    visited = set()
-    for loc in worksheet.keys():
-        try:
-            _generate_cell_subgraph(worksheet, graph, loc, visited, [])
-        except CycleError:
-            pass # Deal with escapees
+    # Components come out with everything they depend on already handled, so
+    # any dependency that isn't in the graph by the time we see a node is in
+    # a cycle, and has its error already.
+    for component in _strongly_connected_components(formula_cells, dependencies):
+        loc = component[0]
+        if len(component) > 1 or loc in dependencies[loc]:
+            _report_cycle(worksheet, component, dependencies)
+            continue
+        _add_location_dependencies(graph, loc, set(
+            dep_loc for dep_loc in dependencies[loc] if dep_loc in graph
+        ))
 
     leaves = []
     for loc, deps in graph.iteritems():
@@ -58,42 +341,146 @@ def build_dependency_graph(worksheet):
     return graph, leaves
 
 
-def _generate_cell_subgraph(worksheet, graph, loc, completed, path):
-    if loc not in worksheet:
-        return
-    cell = worksheet[loc]
-    if loc in completed:
-        if type(cell.error) == CycleError:
-            raise cell.error
-        else:
-            return
+def find_dependents(worksheet, locations):
+    index = get_dependency_index(worksheet)
+    result = set(locations)
+    to_visit = list(locations)
+    while to_visit:
+        loc = to_visit.pop()
+        for dependent in index.dependents(loc):
+            if dependent not in result:
+                result.add(dependent)
+                to_visit.append(dependent)
+    return result
+
+
+def partition_dependency_graph(graph):
+    components = []
+    partitioned = set()
+    for start in graph:
+        if start in partitioned:
+            continue
+        component = set([start])
+        to_visit = [start]
+        while to_visit:
+            node = graph[to_visit.pop()]
+            for neighbour in chain(node.children, node.parents):
+                if neighbour not in component:
+                    component.add(neighbour)
+                    to_visit.append(neighbour)
+        partitioned |= component
+        components.append(topologically_sorted(graph, component))
+    return components
+
+
+def topologically_sorted(graph, locations):
+    return list(chain.from_iterable(topological_levels(graph, locations)))
+
+
+def topological_levels(graph, locations=None):
+    if locations is None:
+        locations = graph
+    unsorted_children = dict(
+        (loc, len(graph[loc].children)) for loc in locations
+    )
+    level = [loc for loc, count in unsorted_children.iteritems() if count == 0]
+    levels = []
+    while level:
+        levels.append(level)
+        next_level = []
+        for loc in level:
+            for parent in graph[loc].parents:
+                unsorted_children[parent] -= 1
+                if unsorted_children[parent] == 0:
+                    next_level.append(parent)
+        level = next_level
+    return levels
+
+
+def _strongly_connected_components(locations, dependencies):
+    # Tarjan's algorithm, with an explicit stack of (location, iterator over
+    # its dependencies) instead of recursion, so long chains of references
+    # can't hit the recursion limit.  Components are yielded with their
+    # first-visited location first, after every component they depend on.
+    index = {}
+    lowlink = {}
+    stack = []
+    on_stack = set()
+    for root in locations:
+        if root in index:
+            continue
+        index[root] = lowlink[root] = len(index)
+        stack.append(root)
+        on_stack.add(root)
+        work = [(root, iter(dependencies[root]))]
+        while work:
+            loc, deps = work[-1]
+            for dep_loc in deps:
+                if dep_loc not in index:
+                    index[dep_loc] = lowlink[dep_loc] = len(index)
+                    stack.append(dep_loc)
+                    on_stack.add(dep_loc)
+                    work.append((dep_loc, iter(dependencies[dep_loc])))
+                    break
+                elif dep_loc in on_stack:
+                    lowlink[loc] = min(lowlink[loc], index[dep_loc])
+            else:
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    lowlink[parent] = min(lowlink[parent], lowlink[loc])
+                if lowlink[loc] == index[loc]:
+                    component = []
+                    while True:
+                        member = stack.pop()
+                        on_stack.remove(member)
+                        component.append(member)
+                        if member == loc:
+                            break
+                    component.reverse()
+                    yield component
+
+
+def _find_cycle(component, dependencies):
+    # Shortest path from the component's first location back to itself.
+    root = component[0]
+    members = set(component)
+    came_from = {}
+    to_visit = deque([root])
+    while to_visit:
+        loc = to_visit.popleft()
+        for dep_loc in dependencies[loc]:
+            if dep_loc == root:
+                path = [root]
+                while loc != root:
+                    path.append(loc)
+                    loc = came_from[loc]
+                path.append(root)
+                path.reverse()
+                return path
+            if dep_loc in members and dep_loc not in came_from:
+                came_from[dep_loc] = loc
+                to_visit.append(dep_loc)
+
 
-    if loc in path:
-        cycle_error = CycleError(path[path.index(loc):] + [loc])
+def _report_cycle(worksheet, component, dependencies):
+    # Only cells get errors, and appear in the cycle; not the range blocks
+    # between them.
+    cells = [loc for loc in component if not is_range_dependency(loc)]
+    blocks = [loc for loc in component if is_range_dependency(loc)]
+    path = [
+        loc for loc in _find_cycle(cells + blocks, dependencies)
+        if not is_range_dependency(loc)
+    ]
+    cycle_error = CycleError(path)
+    # Same order as the cells would be reached unwinding a depth-first
+    # search round the cycle, then the rest of the component.
+    in_path = set(path)
+    for loc in (
+        [path[0]] + path[-2:0:-1] +
+        [loc for loc in cells if loc not in in_path]
+    ):
         report_cell_error(worksheet, loc, cycle_error)
-        completed.add(loc)
-        raise cycle_error
-
-    if cell.python_formula:
-        valid_dependencies = set()
-        for dep_loc in cell.dependencies:
-            dep_cell = worksheet[dep_loc]
-            try:
-                _generate_cell_subgraph(worksheet, graph, dep_loc, completed, path + [loc])
-
-                if dep_cell.error:
-                    continue
-                if not dep_cell.python_formula:
-                    continue
-                valid_dependencies.add(dep_loc)
-            except CycleError as cycle_error:
-                if not loc in completed:
-                    report_cell_error(worksheet, loc, cycle_error)
-                if loc in cycle_error.path:
-                    completed.add(loc)
-                    raise cycle_error
-        _add_location_dependencies(graph, loc, valid_dependencies)
-    completed.add(loc)
 
 
 def _add_location_dependencies(graph, location, dependencies):
@@ -0,0 +1,78 @@
+# Copyright (c) 2010 Resolver Systems Ltd, PythonAnywhere LLP
+# See LICENSE.md
+#
+
+import __future__
+import ast
+
+
+# formula_interpreter turns every cell reference into
+#     worksheet[(col, row)].value
+# which costs a Worksheet.__getitem__ call (and a throwaway Cell) each time
+# it's evaluated.  Instead we compile python formulae into a lambda taking
+# the referenced cells' values as arguments, so that inside the formula
+# they're plain local variable lookups and the caller can fetch them
+# straight out of the worksheet's dict.
+
+CELL_ARGUMENT_NAME = '_cell_%d_%d'
+
+
+def _cell_reference_location(node):
+    if not (
+        isinstance(node, ast.Attribute) and node.attr == 'value' and
+        isinstance(node.value, ast.Subscript) and
+        isinstance(node.value.value, ast.Name) and
+        node.value.value.id == 'worksheet' and
+        isinstance(node.value.slice, ast.Index) and
+        isinstance(node.value.slice.value, ast.Tuple)
+    ):
+        return None
+    coords = node.value.slice.value.elts
+    if len(coords) != 2 or not all(
+        isinstance(coord, ast.Num) and type(coord.n) in (int, long)
+        for coord in coords
+    ):
+        return None
+    return coords[0].n, coords[1].n
+
+
+
+class _CellReferencesToArguments(ast.NodeTransformer):
+
+    def __init__(self):
+        self.locations = []
+
+
+    def visit_Attribute(self, node):
+        location = _cell_reference_location(node)
+        if location is None or not isinstance(node.ctx, ast.Load):
+            return self.generic_visit(node)
+        if location not in self.locations:
+            self.locations.append(location)
+        return ast.copy_location(
+            ast.Name(id=CELL_ARGUMENT_NAME % location, ctx=ast.Load()), node
+        )
+
+
+
+def compile_formula(python_formula):
+    # Returns a code object that evals to a function, and the locations of
+    # the cells whose values should be passed to it, in order.
+    expression = ast.parse(python_formula, '<string>', 'eval')
+    transformer = _CellReferencesToArguments()
+    body = transformer.visit(expression.body)
+    function = ast.Lambda(
+        args=ast.arguments(
+            args=[
+                ast.Name(id=CELL_ARGUMENT_NAME % location, ctx=ast.Param())
+                for location in transformer.locations
+            ],
+            vararg=None, kwarg=None, defaults=[]
+        ),
+        body=body
+    )
+    code = compile(
+        ast.fix_missing_locations(ast.Expression(body=function)),
+        '<string>', 'eval', __future__.division.compiler_flag, True
+    )
+    return code, tuple(transformer.locations)
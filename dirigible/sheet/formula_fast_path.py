@@ -0,0 +1,146 @@
+# Copyright (c) 2010 Resolver Systems Ltd, PythonAnywhere LLP
+# See LICENSE.md
+#
+
+import re
+
+from .parser.tokens import (
+    FLOATNUMBER, FLCELLREFLIKENAME_RE, WHITESPACE,
+    case_insensitive_reserved, reserved, unimplemented_python_keywords,
+)
+from .utils.cell_name_utils import cell_name_to_coordinates
+
+
+# Most formulae are things like =A1+B1*2 or =SUM(A1:A10).  Those can be
+# translated with a regex tokenizer and a little state machine, giving the
+# same dependencies and python formula as the full parser followed by
+# formula_interpreter.  Anything outside that subset gets None, and the
+# caller falls back to the full parser -- which is also what reports errors.
+
+NUMBER, CELL, NAME, OPERATOR = range(4)
+
+TOKEN_RE = re.compile(
+    r'(?:(?P<number>(?:%s|0|[1-9][0-9]*)(?![A-Za-z0-9_$.]))'
+    r'|(?P<name>\$?[A-Za-z_][A-Za-z_0-9$]*)'
+    r'|(?P<operator>\*\*|[-+*/(),:]))'
+    r'%s' % (FLOATNUMBER, WHITESPACE)
+)
+LEADING_WHITESPACE_RE = re.compile(WHITESPACE)
+
+BINARY_OPERATORS = frozenset(['+', '-', '*', '/', '**'])
+UNARY_OPERATORS = frozenset(['+', '-'])
+
+KEYWORDS = frozenset(
+    list(reserved) + list(case_insensitive_reserved) +
+    list(unimplemented_python_keywords)
+)
+
+
+def _tokenize(formula, pos):
+    # (kind, value, source) tuples, where source includes the trailing
+    # whitespace and value is the coordinates for a cell reference or the
+    # operator itself.  None if there's anything outside the subset.
+    tokens = []
+    match = TOKEN_RE.match
+    end = len(formula)
+    while pos < end:
+        token = match(formula, pos)
+        if token is None:
+            return None
+        pos = token.end()
+        operator = token.group('operator')
+        name = token.group('name')
+        if operator is not None:
+            tokens.append((OPERATOR, operator, token.group()))
+        elif name is None:
+            tokens.append((NUMBER, None, token.group()))
+        elif FLCELLREFLIKENAME_RE.match(name):
+            coords = cell_name_to_coordinates(name.replace('$', ''))
+            if coords is None:
+                return None
+            tokens.append((CELL, coords, token.group()))
+        elif (
+            '$' in name or name.startswith('_') or name.endswith('_') or
+            name.lower() in KEYWORDS
+        ):
+            # row and column references, reserved words
+            return None
+        else:
+            tokens.append((NAME, None, token.group()))
+    return tokens
+
+
+def parse_simple_formula(formula):
+    if not formula.startswith('='):
+        return None
+    leading = LEADING_WHITESPACE_RE.match(formula, 1).end()
+    tokens = _tokenize(formula, leading)
+    if tokens is None:
+        return None
+    tokens.append((None, None, ''))
+
+    dependencies = []
+    python_formula = [formula[1:leading]]
+    append = python_formula.append
+    calls = []
+    expect_operand = True
+    index = 0
+    while True:
+        kind, value, source = tokens[index]
+        index += 1
+        if expect_operand:
+            if kind == NUMBER:
+                append(source)
+                expect_operand = False
+            elif kind == CELL:
+                if tokens[index][1] == ':':
+                    second_kind, second, _ = tokens[index + 1]
+                    if second_kind != CELL:
+                        return None
+                    index += 2
+                    append('CellRange(worksheet,(%d,%d),(%d,%d)) ' % (value + second))
+                    (left, right), (top, bottom) = (
+                        sorted((value[0], second[0])), sorted((value[1], second[1]))
+                    )
+                    dependencies.append((left, top, right, bottom))
+                else:
+                    append('worksheet[(%d,%d)].value ' % value)
+                    dependencies.append(value)
+                expect_operand = False
+            elif kind == NAME:
+                append(source)
+                if tokens[index][1] == '(':
+                    append(tokens[index][2])
+                    index += 1
+                    if tokens[index][1] == ')':
+                        append(tokens[index][2])
+                        index += 1
+                        expect_operand = False
+                    else:
+                        calls.append(True)
+                else:
+                    expect_operand = False
+            elif value == '(':
+                append(source)
+                calls.append(False)
+            elif value in UNARY_OPERATORS:
+                append(source)
+            else:
+                return None
+        elif kind is None:
+            break
+        elif value in BINARY_OPERATORS:
+            append(source)
+            expect_operand = True
+        elif value == ',' and calls and calls[-1]:
+            append(source)
+            expect_operand = True
+        elif value == ')' and calls:
+            append(source)
+            calls.pop()
+        else:
+            return None
+
+    if calls:
+        return None
+    return dependencies, ''.join(python_formula)
@@ -121,11 +121,9 @@ def get_dependencies_from_parse_tree(parse_node):
         bottomright = parse_node.second_cell_reference.coords
         left, right = sorted([topleft[0], bottomright[0]])
         top, bottom = sorted([topleft[1], bottomright[1]])
-        return [
-            (c,r)
-            for c in xrange(left, right + 1)
-            for r in xrange(top, bottom + 1)
-        ]
+        # Ranges stay as a single (left, top, right, bottom) dependency, so
+        # their size doesn't matter until the graph is built.
+        return [(left, top, right, bottom)]
 
     elif parse_node.children:
         return sum((get_dependencies_from_parse_tree(child) for child in parse_node.children), [])
@@ -5,10 +5,11 @@
 from chardet.universaldetector import UniversalDetector
 from codecs import getreader
 import csv
+from django.conf import settings
 from xlrd import (
     error_text_from_code, xldate_as_tuple, XL_CELL_DATE, XL_CELL_ERROR,
 )
-from worksheet import Worksheet
+from columnar_worksheet import worksheet_class
 
 class DirigibleImportError(Exception):
     pass
@@ -52,13 +53,17 @@ def worksheet_from_csv(
     unicode_translated_csv_file = getreader(encoding)(csv_file)
 
     row = start_row
+    formulae = []
     try:
         for csv_row in unicode_csv_reader(unicode_translated_csv_file):
             column = start_column
             for csv_cell in csv_row:
-                worksheet[column, row].formula = unicode(csv_cell)
+                formulae.append(((column, row), unicode(csv_cell)))
                 column += 1
             row += 1
+        worksheet.set_cell_formulae(
+            formulae, getattr(settings, 'IMPORT_PARSE_PROCESSES', None)
+        )
     except Exception, e:
         raise DirigibleImportError(unicode(e))
 
@@ -66,7 +71,8 @@ def worksheet_from_csv(
 
 
 def worksheet_from_excel(excel_sheet):
-    worksheet = Worksheet()
+    worksheet = worksheet_class()()
+    formulae = []
     for col in range(excel_sheet.ncols):
         for row in range(excel_sheet.nrows):
             cell = excel_sheet.cell(row, col)
@@ -77,6 +83,9 @@ def worksheet_from_excel(excel_sheet):
                     cell.value, excel_sheet.book.datemode)
             else:
                 formula = unicode(excel_sheet.cell(row, col).value)
-            worksheet[col + 1, row + 1].formula = formula
+            formulae.append(((col + 1, row + 1), formula))
+    worksheet.set_cell_formulae(
+        formulae, getattr(settings, 'IMPORT_PARSE_PROCESSES', None)
+    )
     return worksheet
 
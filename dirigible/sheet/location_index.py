@@ -0,0 +1,89 @@
+# Copyright (c) 2010 Resolver Systems Ltd, PythonAnywhere LLP
+# See LICENSE.md
+#
+
+from bisect import bisect_left, bisect_right, insort
+
+
+def is_range_dependency(dependency):
+    return len(dependency) == 4
+
+
+class LocationIndex(object):
+    # Sorted rows for each column, so that finding the indexed locations
+    # inside a range costs time proportional to the number of columns and
+    # matches rather than to the area of the range.
+
+    def __init__(self, locations=()):
+        self._locations = set(locations)
+        rows_by_column = {}
+        for col, row in self._locations:
+            rows_by_column.setdefault(col, []).append(row)
+        for rows in rows_by_column.itervalues():
+            rows.sort()
+        self._rows_by_column = rows_by_column
+        self._columns = sorted(rows_by_column)
+
+
+    def __len__(self):
+        return len(self._locations)
+
+
+    def __contains__(self, location):
+        return location in self._locations
+
+
+    def add(self, location):
+        if location in self._locations:
+            return
+        self._locations.add(location)
+        col, row = location
+        if col not in self._rows_by_column:
+            self._rows_by_column[col] = []
+            insort(self._columns, col)
+        insort(self._rows_by_column[col], row)
+
+
+    def discard(self, location):
+        if location not in self._locations:
+            return
+        self._locations.remove(location)
+        col, row = location
+        rows = self._rows_by_column[col]
+        del rows[bisect_left(rows, row)]
+        if not rows:
+            del self._rows_by_column[col]
+            del self._columns[bisect_left(self._columns, col)]
+
+
+    def columns_in(self, left, right):
+        columns = self._columns
+        return columns[bisect_left(columns, left):bisect_right(columns, right)]
+
+
+    def count_in_column(self, col, top, bottom):
+        # How many indexed locations there are in the column between top and
+        # bottom, and the row of the first of them (None if there are none).
+        rows = self._rows_by_column.get(col)
+        if not rows:
+            return 0, None
+        start = bisect_left(rows, top)
+        count = bisect_right(rows, bottom) - start
+        return count, rows[start] if count else None
+
+
+    def locations_in(self, (left, top, right, bottom)):
+        columns = self._columns
+        for col in columns[bisect_left(columns, left):bisect_right(columns, right)]:
+            rows = self._rows_by_column[col]
+            for row in rows[bisect_left(rows, top):bisect_right(rows, bottom)]:
+                yield col, row
+
+
+    def expand(self, dependencies):
+        for dependency in dependencies:
+            if is_range_dependency(dependency):
+                for location in self.locations_in(dependency):
+                    yield location
+            else:
+                yield dependency
@@ -0,0 +1,16 @@
+# Copyright (c) 2010 Resolver Systems Ltd, PythonAnywhere LLP
+# See LICENSE.md
+#
+
+from django.core.management.base import NoArgsCommand
+
+from sheet.parser.parser import PARSER_TABLES_PICKLE, pickle_parser_tables
+
+
+class Command(NoArgsCommand):
+    help = "Write the formula parser's tables to %s so that they load faster" % (
+        PARSER_TABLES_PICKLE,
+    )
+
+    def handle_noargs(self, **options):
+        pickle_parser_tables()
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sheet', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='sheet',
+            name='recalculation_engine',
+            field=models.CharField(default=b'', max_length=16, blank=True, choices=[(b'', b'Default'), (b'threads', b'Threads'), (b'levels', b'Topological levels'), (b'processes', b'Processes')]),
+            preserve_default=True,
+        ),
+    ]
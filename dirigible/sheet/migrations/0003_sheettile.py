@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sheet', '0002_sheet_recalculation_engine'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SheetTile',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('tile_col', models.IntegerField()),
+                ('tile_row', models.IntegerField()),
+                ('contents', models.TextField()),
+                ('sheet', models.ForeignKey(related_name=b'tiles', to='sheet.Sheet')),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AlterUniqueTogether(
+            name='sheettile',
+            unique_together=set([('sheet', 'tile_col', 'tile_row')]),
+        ),
+        migrations.AddField(
+            model_name='sheet',
+            name='is_tiled',
+            field=models.BooleanField(default=False),
+            preserve_default=True,
+        ),
+    ]
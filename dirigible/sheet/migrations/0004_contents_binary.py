@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sheet', '0003_sheettile'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='sheet',
+            name='contents_binary',
+            field=models.BinaryField(null=True),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='sheettile',
+            name='contents_binary',
+            field=models.BinaryField(null=True),
+            preserve_default=True,
+        ),
+    ]
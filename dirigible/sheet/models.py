@@ -4,11 +4,13 @@
 
 from .clipboard import Clipboard
 from .sheet import Sheet
+from .tiled_storage import SheetTile
 from django.contrib.auth.models import User
 
 
 
 def copy_sheet_to_user(sheet, user):
+    sheet.load_tiles()
     sheet.id = None
     sheet.owner = user
     sheet.is_public = False
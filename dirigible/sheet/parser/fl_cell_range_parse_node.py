@@ -6,6 +6,8 @@ from sheet.parser.parse_node import ParseNode
 
 class FLCellRangeParseNode(ParseNode):
 
+    __slots__ = ()
+
     def __init__(self, children):
         assert len(children) == 3
         ParseNode.__init__(self, ParseNode.FL_CELL_RANGE, children)
@@ -8,6 +8,8 @@ from sheet.utils.cell_name_utils import cell_name_to_coordinates, coordinates_to
 
 class FLCellReferenceParseNode(FLReferenceParseNode):
 
+    __slots__ = ()
+
     def __init__(self, children):
         FLReferenceParseNode.__init__(self, ParseNode.FL_CELL_REFERENCE, children)
 
@@ -9,6 +9,8 @@ from sheet.utils.cell_name_utils import column_name_to_index, column_index_to_na
 
 class FLColumnReferenceParseNode(FLReferenceParseNode):
 
+    __slots__ = ()
+
     def __init__(self, children):
         FLReferenceParseNode.__init__(self, ParseNode.FL_COLUMN_REFERENCE, children)
 
@@ -8,6 +8,8 @@ from sheet.parser.fl_reference_parse_node import FLReferenceParseNode
 
 class FLNamedRowReferenceParseNode(FLReferenceParseNode):
 
+    __slots__ = ()
+
     def __init__(self, children):
         FLReferenceParseNode.__init__(self, ParseNode.FL_NAMED_ROW_REFERENCE, children)
 
@@ -23,6 +23,8 @@ def unquote_fl_worksheet_name(name):
 
 class FLReferenceParseNode(ParseNode):
 
+    __slots__ = ()
+
     def __init__(self, nodeType, children):
         assert len(children) in (1, 3)
         ParseNode.__init__(self, nodeType, children)
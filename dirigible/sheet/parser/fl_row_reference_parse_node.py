@@ -7,6 +7,8 @@ from sheet.parser.fl_reference_parse_node import FLReferenceParseNode
 
 class FLRowReferenceParseNode(FLReferenceParseNode):
 
+    __slots__ = ()
+
     def __init__(self, children):
         ParseNode.__init__(self, ParseNode.FL_ROW_REFERENCE, children)
 
@@ -58,6 +58,10 @@ class ParseNode(object):
     TRAILER                         = "TRAILER"
     VAR_ARGS_LIST                   = "VAR_ARGS_LIST"
 
+    # There's one of these for every token and grammar rule in a formula, so
+    # no per-instance __dict__.  Subclasses should say __slots__ = () too.
+    __slots__ = ('type', 'children')
+
 
     def __init__(self, _type, children):
         self.type = _type
@@ -100,11 +104,21 @@ class ParseNode(object):
 
 
     def flatten(self):
-        def AppendChild(string, child):
-            if isinstance(child, ParseNode):
-                return string + child.flatten()
-            return string + child if child is not None else string
-        return reduce(AppendChild, self.children, "")
+        # Depth-first with an explicit stack and a single join at the end, so
+        # it's linear in the length of the formula and deeply nested trees
+        # don't hit the recursion limit.
+        parts = []
+        stack = [iter(self.children)]
+        while stack:
+            for child in stack[-1]:
+                if isinstance(child, ParseNode):
+                    stack.append(iter(child.children))
+                    break
+                if child is not None:
+                    parts.append(child)
+            else:
+                stack.pop()
+        return "".join(parts)
 
 
     classRegistry = {}
@@ -2,30 +2,88 @@
 # See LICENSE.md
 #
 
+from copy import copy
 import os
 from ply import lex
 from ply import yacc
-from threading import Lock
+from threading import local, Lock
 
 from . import grammar, tokens
 
 
-_parser = yacc.yacc(
-    module=grammar,
-    outputdir=os.path.dirname(__file__),
-    method="LALR",
-    debug=0,
-    tabmodule='sheet.parser.parsetab'
-)
-_lexer = lex.lex(tokens)
+# Building the parser means checking the grammar against parsetab and
+# expanding its tables, and building the lexer compiles all of the token
+# regexes -- together most of the cost of importing sheet.cell -- so it's
+# left until the first formula is parsed.  Running the
+# pickle_parser_tables management command makes the tables load faster
+# still; a pickle that's out of date with the grammar gets rebuilt.
+PARSER_TABLES_PICKLE = os.path.join(os.path.dirname(__file__), 'parsetab.pickle')
 
-_parser_lock = Lock()
+_parser = None
+_lexer = None
+_build_lock = Lock()
 
 
-def parse(string):
-    _parser_lock.acquire()
+def _build_parser(picklefile=None):
+    options = dict(
+        module=grammar,
+        outputdir=os.path.dirname(__file__),
+        method="LALR",
+        debug=0,
+        tabmodule='sheet.parser.parsetab'
+    )
+    if picklefile is not None:
+        options['picklefile'] = picklefile
+    return yacc.yacc(**options)
+
+
+def pickle_parser_tables(picklefile=PARSER_TABLES_PICKLE):
+    if os.path.exists(picklefile):
+        os.remove(picklefile)
+    _build_parser(picklefile)
+
+
+def reset_build_lock():
+    # For a forked child: a lock another thread held at the fork would never
+    # be released there.
+    global _build_lock
+    _build_lock = Lock()
+
+
+def _get_base_parser_and_lexer():
+    global _parser, _lexer
+    with _build_lock:
+        if _parser is None:
+            parser = None
+            if os.path.exists(PARSER_TABLES_PICKLE):
+                try:
+                    parser = _build_parser(PARSER_TABLES_PICKLE)
+                except EnvironmentError:
+                    pass
+            if parser is None:
+                parser = _build_parser()
+            _lexer = lex.lex(tokens)
+            _parser = parser
+    return _parser, _lexer
+
+
+# PLY parsers and lexers keep the state of the current parse on themselves,
+# so each thread gets its own.  The copies share the (read-only) tables built
+# from parsetab, so they're cheap to make.
+_thread_local = local()
+
+
+def _get_parser_and_lexer():
     try:
-        return _parser.parse(string, _lexer)
-    finally:
-        _parser_lock.release()
+        return _thread_local.parser, _thread_local.lexer
+    except AttributeError:
+        parser, lexer = _get_base_parser_and_lexer()
+        _thread_local.parser = copy(parser)
+        _thread_local.lexer = lexer.clone()
+        return _thread_local.parser, _thread_local.lexer
+
+
+def parse(string):
+    parser, lexer = _get_parser_and_lexer()
+    return parser.parse(string, lexer)
 
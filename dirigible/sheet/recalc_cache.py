@@ -0,0 +1,95 @@
+# Copyright (c) 2010 Resolver Systems Ltd, PythonAnywhere LLP
+# See LICENSE.md
+#
+
+from hashlib import md5
+import re
+
+from django.conf import settings
+
+from .utils.lru_cache import LRUCache
+
+
+RECALCULATION_CACHE_SIZE = 100
+
+# Usercode opts in to having its results reused with a line like
+#     # dirigible: deterministic
+# Anything that reads the clock, random numbers or other sheets shouldn't.
+DETERMINISTIC_USERCODE_RE = re.compile(
+    r'^\s*#\s*dirigible:\s*deterministic\s*$', re.MULTILINE | re.IGNORECASE
+)
+
+
+def usercode_is_deterministic(usercode):
+    return bool(DETERMINISTIC_USERCODE_RE.search(usercode))
+
+
+def recalc_cache_key(worksheet, usercode, engine=None):
+    # Only what goes into a recalc: the cells' formulae, the usercode and the
+    # settings that change its output.  Everything else in a sheet's contents,
+    # like values and console text, is what the last recalc left behind.
+    hasher = md5()
+    for (col, row), cell in sorted(worksheet.iteritems()):
+        if cell.formula:
+            hasher.update('%d,%d\0' % (col, row))
+            hasher.update(cell.formula.encode('utf-8'))
+            hasher.update('\0')
+    hasher.update('\0')
+    hasher.update(usercode.encode('utf-8'))
+    hasher.update('\0%s\0%s' % (
+        engine or getattr(settings, 'RECALCULATION_ENGINE', 'threads'),
+        getattr(settings, 'PROFILE_RECALCULATION', False),
+    ))
+    return 'recalc:%s' % (hasher.hexdigest(),)
+
+
+
+class MemoryRecalcCache(object):
+
+    def __init__(self, maxsize):
+        self._results = LRUCache(maxsize)
+
+
+    def get(self, key):
+        return self._results.get(key)
+
+
+    def put(self, key, contents_json):
+        self._results.put(key, contents_json)
+
+
+
+class DjangoRecalcCache(object):
+    # Size limits and eviction are whatever the configured backend does, eg.
+    # MAX_ENTRIES for the locmem and file-based (local disk) backends.
+
+    def __init__(self, alias):
+        from django.core.cache import caches
+        self._cache = caches[alias]
+
+
+    def get(self, key):
+        return self._cache.get(key)
+
+
+    def put(self, key, contents_json):
+        self._cache.set(key, contents_json)
+
+
+
+_memory_recalc_cache = None
+
+def get_recalc_cache():
+    global _memory_recalc_cache
+    backend = getattr(settings, 'RECALCULATION_CACHE', None)
+    if backend == 'memory':
+        if _memory_recalc_cache is None:
+            _memory_recalc_cache = MemoryRecalcCache(
+                getattr(settings, 'RECALCULATION_CACHE_SIZE', RECALCULATION_CACHE_SIZE)
+            )
+        return _memory_recalc_cache
+    if backend == 'django':
+        return DjangoRecalcCache(
+            getattr(settings, 'RECALCULATION_CACHE_ALIAS', 'default')
+        )
+    return None
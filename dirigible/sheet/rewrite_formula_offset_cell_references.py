@@ -4,18 +4,101 @@
 
 from __future__ import division
 
+from .dependency_graph import get_dependency_index
 from .parser import FormulaError
 from .parser.parse_node import ParseNode
 from .parser.parse_node_constructors import FLCellReference, FLCellRange
 from .parser.parser import parse
+from .utils.cell_name_utils import coordinates_to_cell_name
+from .utils.lru_cache import LRUCache
 
 
 def rewrite_source_sheet_formulae_for_cut(worksheet, source_range, dest_col, dest_row):
     column_offset = dest_col - source_range[0]
     row_offset = dest_row - source_range[1]
-    for location, cell in worksheet.iteritems():
-        worksheet[location].formula = rewrite_formula(
+    # Only formulae referring to the cut cells can change, and the dependency
+    # index knows which those are.  Building it for a sheet that hasn't been
+    # recalculated since it was loaded looks at every cell, but the next
+    # recalc would need it anyway.
+    index = get_dependency_index(worksheet)
+    for location in index.references_within(source_range):
+        cell = worksheet[location]
+        new_formula = rewrite_formula(
             cell.formula, column_offset, row_offset, True, source_range)
+        if new_formula != cell.formula:
+            cell._set_formula(new_formula)
+            worksheet.mark_dirty(location)
+
+
+# Pasting a formula over a big area rewrites it with lots of different
+# offsets, so each formula is parsed just once into a template: the text of
+# its parse tree, with a slot for each cell reference and cell range that
+# just needs the offsets applying.
+FORMULA_TEMPLATE_CACHE_SIZE = 10000
+
+formula_template_cache = LRUCache(FORMULA_TEMPLATE_CACHE_SIZE)
+
+CELL_REFERENCE, CELL_RANGE = range(2)
+
+
+def _cell_reference_slot(node):
+    column, row = node.coords
+    text = node.flatten()
+    prefix = text[:len(text) - len(node.localReference)]
+    return (
+        text, prefix, column, row,
+        node.colAbsolute, node.rowAbsolute, node.whitespace
+    )
+
+
+def _formula_template(formula):
+    try:
+        parse_tree = parse(formula)
+    except FormulaError:
+        return ()
+
+    template = []
+    text = []
+    def add_slot(slot):
+        template.append(''.join(text))
+        del text[:]
+        template.append(slot)
+
+    stack = [iter([parse_tree])]
+    while stack:
+        for node in stack[-1]:
+            if isinstance(node, FLCellRange):
+                first = _cell_reference_slot(node.first_cell_reference)
+                second = _cell_reference_slot(node.second_cell_reference)
+                colon = node.colon
+                if isinstance(colon, ParseNode):
+                    colon = colon.flatten()
+                add_slot((CELL_RANGE, node.flatten(), first, colon, second))
+            elif isinstance(node, FLCellReference):
+                add_slot((CELL_REFERENCE, node.flatten(), _cell_reference_slot(node)))
+            elif isinstance(node, ParseNode):
+                stack.append(iter(node.children))
+                break
+            elif node is not None:
+                text.append(node)
+        else:
+            stack.pop()
+    template.append(''.join(text))
+    return tuple(template)
+
+
+def _offset_cell_reference(slot, column_offset, row_offset, move_absolute):
+    _, prefix, column, row, column_absolute, row_absolute, whitespace = slot
+    if move_absolute or not column_absolute:
+        column += column_offset
+    if move_absolute or not row_absolute:
+        row += row_offset
+    name = coordinates_to_cell_name(
+        column, row, colAbsolute=column_absolute, rowAbsolute=row_absolute
+    )
+    if name is None:
+        name = "#Invalid!"
+    return prefix + name + whitespace
 
 
 def rewrite_formula(
@@ -24,56 +107,42 @@ def rewrite_formula(
     if formula is None or not formula.startswith('='):
         return formula
 
+    template = formula_template_cache.get(formula)
+    if template is None:
+        template = _formula_template(formula)
+        formula_template_cache.put(formula, template)
+    if not template:
+        return formula
+
     def cell_in_original_bounds(column, row):
         return (
             orig_bounds[0] <= column <= orig_bounds[2] and
             orig_bounds[1] <= row <= orig_bounds[3]
         )
 
-    def range_in_original_bounds(left, top, right, bottom):
-        return (
-            cell_in_original_bounds(left, top) and
-            cell_in_original_bounds(right, bottom)
-        )
-
-    def offset_cell_reference(node):
-        orig_column, orig_row = node.coords
-
-        if is_cut and not cell_in_original_bounds(orig_column, orig_row):
-            return node
-        node.offset(column_offset, row_offset, move_absolute=is_cut)
-        return node
-
-
-    def offset_cell_range(node):
-        corner1_col, corner1_row = node.first_cell_reference.coords
-        corner2_col, corner2_row = node.second_cell_reference.coords
-
-        if is_cut and not range_in_original_bounds(
-            corner1_col, corner1_row, corner2_col, corner2_row
-        ):
-            return node
-
-        node.first_cell_reference.offset(column_offset, row_offset, move_absolute=is_cut)
-        node.second_cell_reference.offset(column_offset, row_offset, move_absolute=is_cut)
-        return node
-
-
-    def rewrite(node):
-        if isinstance(node, ParseNode):
-            if isinstance(node, FLCellRange):
-                return offset_cell_range(node)
-            if isinstance(node, FLCellReference):
-                return offset_cell_reference(node)
+    pieces = []
+    for piece in template:
+        if isinstance(piece, basestring):
+            pieces.append(piece)
+        elif piece[0] == CELL_REFERENCE:
+            _, text, cell = piece
+            if is_cut and not cell_in_original_bounds(cell[2], cell[3]):
+                pieces.append(text)
             else:
-                node.children = [
-                    rewrite(child)
-                    for child in node.children
-                ]
-        return node
-
-    try:
-        return rewrite(parse(formula)).flatten()
-    except FormulaError:
-        return formula
-
+                pieces.append(
+                    _offset_cell_reference(cell, column_offset, row_offset, is_cut)
+                )
+        else:
+            _, text, first, colon, second = piece
+            if is_cut and not (
+                cell_in_original_bounds(first[2], first[3]) and
+                cell_in_original_bounds(second[2], second[3])
+            ):
+                pieces.append(text)
+            else:
+                pieces.append(
+                    _offset_cell_reference(first, column_offset, row_offset, is_cut) +
+                    colon +
+                    _offset_cell_reference(second, column_offset, row_offset, is_cut)
+                )
+    return ''.join(pieces)
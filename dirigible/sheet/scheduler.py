@@ -0,0 +1,171 @@
+# Copyright (c) 2010 Resolver Systems Ltd, PythonAnywhere LLP
+# See LICENSE.md
+#
+
+from collections import deque
+from Queue import Queue
+from threading import Lock, Thread
+from time import time
+
+
+class WorkerPool(object):
+    # Threads are persistent, and a new one is only started when every
+    # existing thread is busy, so concurrent recalcs can't starve each other.
+
+    def __init__(self):
+        self._tasks = Queue()
+        self._threads = []
+        self._spare_threads = 0
+        self._lock = Lock()
+
+
+    @property
+    def num_threads(self):
+        return len(self._threads)
+
+
+    def submit(self, function, *args):
+        with self._lock:
+            if self._spare_threads == 0:
+                thread = Thread(target=self._work)
+                thread.setDaemon(True)
+                self._threads.append(thread)
+                self._spare_threads += 1
+                thread.start()
+            self._spare_threads -= 1
+        self._tasks.put((function, args))
+
+
+    def _work(self):
+        while True:
+            function, args = self._tasks.get()
+            try:
+                function(*args)
+            except Exception:
+                pass
+            finally:
+                with self._lock:
+                    self._spare_threads += 1
+
+
+
+class SchedulerMetrics(object):
+    # Nodes are whatever is in the graph, so for a recalc they include the
+    # range blocks as well as the cells.
+
+    def __init__(self):
+        self.nodes = 0
+        self.wall_time = 0.0
+        self.eval_time = 0.0
+        self.queue_wait_time = 0.0
+        self.max_queue_wait_time = 0.0
+
+
+    def add(self, other):
+        self.nodes += other.nodes
+        self.wall_time += other.wall_time
+        self.eval_time += other.eval_time
+        self.queue_wait_time += other.queue_wait_time
+        self.max_queue_wait_time = max(
+            self.max_queue_wait_time, other.max_queue_wait_time
+        )
+
+
+    def __repr__(self):
+        return (
+            '<SchedulerMetrics nodes=%d wall=%.3fs eval=%.3fs '
+            'queue_wait=%.3fs max_queue_wait=%.3fs>' % (
+                self.nodes, self.wall_time, self.eval_time,
+                self.queue_wait_time, self.max_queue_wait_time
+            )
+        )
+
+
+
+class DependencyGraphRun(object):
+    # Each node goes to the pool as soon as its last child has been
+    # evaluated, with at most max_in_flight nodes in the pool at once.
+
+    def __init__(self, graph, evaluate, max_in_flight):
+        self.graph = graph
+        self.evaluate = evaluate
+        self.max_in_flight = max_in_flight
+        self.metrics = SchedulerMetrics()
+        self._unevaluated_children = dict(
+            (loc, len(node.children)) for loc, node in graph.iteritems()
+        )
+        self._remaining = len(graph)
+        self._ready = deque()
+        self._in_flight = 0
+        self._lock = Lock()
+        self._finished = Lock()
+
+
+    def run(self, pool, leaves):
+        start = time()
+        if self._remaining and leaves:
+            self._pool = pool
+            self._finished.acquire()
+            with self._lock:
+                now = time()
+                self._ready.extend((leaf, now) for leaf in leaves)
+                to_submit = self._take_submittable()
+            self._submit(to_submit)
+            # Released by whichever worker evaluates the last node.
+            self._finished.acquire()
+            self._finished.release()
+        self.metrics.wall_time = time() - start
+        return self.metrics
+
+
+    def _take_submittable(self):
+        to_submit = []
+        while self._ready and self._in_flight < self.max_in_flight:
+            to_submit.append(self._ready.popleft())
+            self._in_flight += 1
+        return to_submit
+
+
+    def _submit(self, ready_locations):
+        for location, ready_time in ready_locations:
+            self._pool.submit(self._evaluate, location, ready_time)
+
+
+    def _evaluate(self, location, ready_time):
+        # Carries on with one of the newly-ready parents itself, so chains of
+        # dependencies don't go through the pool's queue at every step.
+        while location is not None:
+            location, ready_time = self._evaluate_location(location, ready_time)
+
+
+    def _evaluate_location(self, location, ready_time):
+        eval_start = time()
+        try:
+            self.evaluate(location)
+        except Exception:
+            pass
+        eval_end = time()
+
+        with self._lock:
+            queue_wait_time = eval_start - ready_time
+            self.metrics.nodes += 1
+            self.metrics.eval_time += eval_end - eval_start
+            self.metrics.queue_wait_time += queue_wait_time
+            if queue_wait_time > self.metrics.max_queue_wait_time:
+                self.metrics.max_queue_wait_time = queue_wait_time
+
+            for parent in self.graph[location].parents:
+                self._unevaluated_children[parent] -= 1
+                if self._unevaluated_children[parent] == 0:
+                    self._ready.append((parent, eval_end))
+            self._in_flight -= 1
+            self._remaining -= 1
+            finished = self._remaining == 0
+            to_submit = self._take_submittable()
+
+        if finished:
+            self._finished.release()
+        if not to_submit:
+            return None, None
+        self._submit(to_submit[1:])
+        return to_submit[0]
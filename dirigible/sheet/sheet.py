@@ -11,8 +11,26 @@ from django.contrib.auth.models import User
 
 from user.models import OneTimePad
 from .calculate import calculate_with_timeout
-from .worksheet import (
-    Worksheet, worksheet_from_json, worksheet_to_json
+from .columnar_worksheet import worksheet_class
+from .recalc_cache import (
+    get_recalc_cache, recalc_cache_key, usercode_is_deterministic
+)
+from .tiled_storage import (
+    SheetTile, tiled_storage_enabled, worksheet_from_tiles,
+    worksheet_range_from_tiles, worksheet_to_tiles,
+)
+from .worksheet import Worksheet, worksheet_to_json
+from .worksheet_binary import (
+    contents_columns, stored_contents, tile_bounds, worksheet_from_contents,
+    worksheet_range_from_contents, worksheet_to_contents,
+)
+
+
+RECALCULATION_ENGINE_CHOICES = (
+    ('', 'Default'),
+    ('threads', 'Threads'),
+    ('levels', 'Topological levels'),
+    ('processes', 'Processes'),
 )
 
 
@@ -28,8 +46,16 @@ class Sheet(models.Model):
     height = models.IntegerField(default=1000)
 
     contents_json = models.TextField(default=worksheet_to_json(Worksheet()))
+    # Sheets saved in the binary format have it here, and contents_json empty
+    contents_binary = models.BinaryField(null=True)
+    # If so, the cells are in tiles, and contents_json has everything else
+    is_tiled = models.BooleanField(default=False)
 
     timeout_seconds = models.IntegerField(default=55)
+    recalculation_engine = models.CharField(
+        max_length=16, blank=True, default='',
+        choices=RECALCULATION_ENGINE_CHOICES
+    )
 
     is_public = models.BooleanField(default=False)
     allow_json_api_access = models.BooleanField(default=False)
@@ -57,11 +83,23 @@ class Sheet(models.Model):
         self.column_widths = json.loads(self.column_widths_json)
         if not self.api_key:
             self.api_key = str(uuid4())
+        # Each a dict of (tile_col, tile_row) to tile contents, or None until
+        # the tiles are loaded: the tiles as they are here, and in the db.
+        self._tile_contents = self._saved_tile_contents = None if self.is_tiled else {}
 
     def __unicode__(self):
         return 'Sheet %d: %s' % (self.id, self.name)
 
 
+    def _get_contents(self):
+        return stored_contents(self.contents_json, self.contents_binary)
+
+    def _set_contents(self, contents):
+        self.contents_json, self.contents_binary = contents_columns(contents)
+
+    contents = property(_get_contents, _set_contents)
+
+
     def create_private_key(self):
         self.otp = OneTimePad(user=self.owner)
         self.otp.save()
@@ -73,19 +111,97 @@ class Sheet(models.Model):
 
 
     def save(self, *args, **kwargs):
+        if self.id is None:
+            # A new sheet, or a copy of one, has no tiles in the db yet
+            self._saved_tile_contents = {}
         if self.name == 'Untitled':
             models.Model.save(self, *args, **kwargs) # save to set self.id
             self.name = 'Sheet %d' % (self.id,)
         self.column_widths_json = json.dumps(self.column_widths)
         models.Model.save(self, *args, **kwargs)
+        self.save_tiles()
+
+
+    def load_tiles(self):
+        if self._tile_contents is None:
+            self._tile_contents = dict(
+                (
+                    (tile.tile_col, tile.tile_row),
+                    stored_contents(tile.contents, tile.contents_binary)
+                )
+                for tile in self.tiles.all()
+            )
+            self._saved_tile_contents = dict(self._tile_contents)
+
+
+    def save_tiles(self):
+        # Writes the tiles that have changed since they were loaded or last
+        # saved; call it whenever contents_json is written.
+        if self._tile_contents is None or self._tile_contents == self._saved_tile_contents:
+            return
+        if self._saved_tile_contents is None:
+            self.tiles.all().delete()
+            self._saved_tile_contents = {}
+        for (tile_col, tile_row) in self._saved_tile_contents:
+            if (tile_col, tile_row) not in self._tile_contents:
+                self.tiles.filter(tile_col=tile_col, tile_row=tile_row).delete()
+        for (tile_col, tile_row), contents in self._tile_contents.iteritems():
+            if self._saved_tile_contents.get((tile_col, tile_row)) != contents:
+                text, binary = contents_columns(contents)
+                updated = self.tiles.filter(
+                    tile_col=tile_col, tile_row=tile_row
+                ).update(contents=text, contents_binary=binary)
+                if not updated:
+                    SheetTile.objects.create(
+                        sheet=self, tile_col=tile_col, tile_row=tile_row,
+                        contents=text, contents_binary=binary
+                    )
+        self._saved_tile_contents = dict(self._tile_contents)
 
 
     def unjsonify_worksheet(self):
-        return worksheet_from_json(self.contents_json)
+        if self.is_tiled:
+            self.load_tiles()
+            return worksheet_from_tiles(
+                self.contents_json, self._tile_contents.itervalues(), worksheet_class()
+            )
+        return worksheet_from_contents(self.contents, worksheet_class())
+
+
+    def unjsonify_worksheet_range(self, rnge):
+        # Reads only the cells in rnge, where the storage format allows it:
+        # tiled and binary sheets.  Sheets still saved as JSON are read whole
+        # until they're next saved in one of those.
+        if self.is_tiled:
+            left_tile, top_tile, right_tile, bottom_tile = tile_bounds(rnge)
+            if self._tile_contents is None:
+                tile_contents = [
+                    stored_contents(text, binary)
+                    for text, binary in self.tiles.filter(
+                        tile_col__range=(left_tile, right_tile),
+                        tile_row__range=(top_tile, bottom_tile),
+                    ).values_list('contents', 'contents_binary')
+                ]
+            else:
+                tile_contents = [
+                    contents
+                    for (tile_col, tile_row), contents in self._tile_contents.iteritems()
+                    if left_tile <= tile_col <= right_tile and top_tile <= tile_row <= bottom_tile
+                ]
+            return worksheet_range_from_tiles(tile_contents, rnge)
+        return worksheet_range_from_contents(self.contents, rnge)
 
 
     def jsonify_worksheet(self, worksheet):
-        self.contents_json = worksheet_to_json(worksheet)
+        # Tiles are written by save or save_tiles, with contents_json.
+        if tiled_storage_enabled():
+            self.contents_json, self._tile_contents = worksheet_to_tiles(worksheet)
+            self.contents_binary = None
+            self.is_tiled = True
+        else:
+            self.contents = worksheet_to_contents(worksheet)
+            self._tile_contents = {}
+            self.is_tiled = False
 
 
     def merge_non_calc_attrs(self, sheet_in_db):
@@ -93,14 +209,35 @@ class Sheet(models.Model):
         self.column_widths = sheet_in_db.column_widths
 
 
-    def calculate(self):
-        private_key = self.create_private_key()
+    def calculate(self, profile=False):
         worksheet = self.unjsonify_worksheet()
+        recalc_cache = get_recalc_cache()
+        cache_key = None
+        if (
+            recalc_cache is not None and not profile and
+            usercode_is_deterministic(self.usercode) and
+            # the cached contents wouldn't have the cells of tiled sheets
+            not self.is_tiled and not tiled_storage_enabled()
+        ):
+            cache_key = recalc_cache_key(
+                worksheet, self.usercode, self.recalculation_engine or None
+            )
+            cached_contents = recalc_cache.get(cache_key)
+            if cached_contents is not None:
+                self.contents = cached_contents
+                return
+
+        private_key = self.create_private_key()
         transaction.commit()
         try:
-            calculate_with_timeout(worksheet, self.usercode, self.timeout_seconds, private_key)
+            finished = calculate_with_timeout(
+                worksheet, self.usercode, self.timeout_seconds, private_key,
+                self.recalculation_engine or None, profile
+            )
         finally:
             self._delete_private_key()
         self.jsonify_worksheet(worksheet)
+        if cache_key is not None and finished:
+            recalc_cache.put(cache_key, self.contents)
 
 
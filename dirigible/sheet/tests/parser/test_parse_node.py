@@ -59,6 +59,24 @@ class ParseNodeTest(unittest.TestCase):
         self.assertEquals(node.flatten(), u"\u20ac", "unexpected flattening")
 
 
+    def testFlattenHandlesDeeplyNestedTrees(self):
+        node = Name(["x"])
+        for _ in range(10000):
+            node = Expr(["(", node, ")"])
+        self.assertEquals(node.flatten(), "(" * 10000 + "x" + ")" * 10000)
+
+
+    def testParseNodesHaveNoInstanceDict(self):
+        from sheet.parser.parse_node_constructors import FLCellRange, FLCellReference
+        for node in [
+            Name(["a"]),
+            FLCellReference(["A1"]),
+            FLCellRange([FLCellReference(["A1"]), ":", FLCellReference(["B2"])]),
+        ]:
+            self.assertFalse(hasattr(node, "__dict__"), "%r has a __dict__" % (node,))
+            self.assertRaises(AttributeError, setattr, node, "something", 1)
+
+
     def testFlattenHandlesSubclassed(self):
         "test flatten handles subclassed parse nodes"
 
@@ -9,9 +9,12 @@ except ImportError:
 
 from itertools import takewhile
 import os
+from tempfile import mkdtemp
 from threading import Lock, Thread
 import time
 
+from mock import patch
+
 from sheet.parser import FormulaError
 from sheet.parser.parser import parse
 from sheet.parser.parse_node import ParseNode
@@ -3391,3 +3394,87 @@ class ParserModuleTest(unittest.TestCase):
                 first_error = thread.errors[1]
         if first_error:
             raise first_error
+
+
+    def test_each_thread_gets_its_own_parser_and_lexer_sharing_the_tables(self):
+        import sheet.parser.parser as ParserModule
+        parsers_and_lexers = []
+        def get_parser_and_lexer():
+            parsers_and_lexers.append(ParserModule._get_parser_and_lexer())
+            parsers_and_lexers.append(ParserModule._get_parser_and_lexer())
+        threads = [Thread(target=get_parser_and_lexer) for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        (parser1, lexer1), (parser1_again, lexer1_again), (parser2, lexer2), _ = parsers_and_lexers
+        self.assertTrue(parser1 is parser1_again)
+        self.assertTrue(lexer1 is lexer1_again)
+        self.assertFalse(parser1 is parser2)
+        self.assertFalse(lexer1 is lexer2)
+        self.assertTrue(parser1.action is parser2.action)
+        self.assertTrue(parser1.goto is parser2.goto)
+
+
+    def test_concurrent_parses_give_the_same_results_as_serial_ones(self):
+        formulae = ['=a1 + a2 + a3', '=SUM(B1:B10) * 2', '=[x for x in A1:A3]', '=1 +']
+        def parse_or_error(formula):
+            try:
+                return parse(formula).flatten()
+            except FormulaError, e:
+                return str(e)
+        expected = [parse_or_error(formula) for formula in formulae] * 200
+        results = {}
+        def parse_all(index):
+            results[index] = [
+                parse_or_error(formula) for _ in range(200) for formula in formulae
+            ]
+        threads = [Thread(target=parse_all, args=(index,)) for index in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        for index in range(4):
+            self.assertEquals(results[index], expected)
+
+
+
+    def test_importing_module_does_not_build_parser_until_first_parse(self):
+        import sheet.parser.parser as ParserModule
+        reload(ParserModule)
+        self.assertIsNone(ParserModule._parser)
+        self.assertIsNone(ParserModule._lexer)
+
+        ParserModule.parse('=1')
+        base_parser, base_lexer = ParserModule._parser, ParserModule._lexer
+        self.assertIsNotNone(base_parser)
+        self.assertIsNotNone(base_lexer)
+
+        self.assertEquals(
+            ParserModule._get_base_parser_and_lexer(), (base_parser, base_lexer)
+        )
+
+
+    def test_uses_pickled_parser_tables_if_present(self):
+        import sheet.parser.parser as ParserModule
+        picklefile = os.path.join(mkdtemp(), 'parsetab.pickle')
+        try:
+            ParserModule.pickle_parser_tables(picklefile)
+            self.assertTrue(os.path.exists(picklefile))
+
+            with patch('sheet.parser.parser.PARSER_TABLES_PICKLE', picklefile):
+                with patch('sheet.parser.parser._parser', None):
+                    with patch('sheet.parser.parser._build_parser', wraps=ParserModule._build_parser) as mock_build:
+                        parser, lexer = ParserModule._get_base_parser_and_lexer()
+
+            mock_build.assert_called_once_with(picklefile)
+            self.assertEquals(
+                parser.parse('=SUM(A1:A3) + b4', lexer.clone()).flatten(),
+                parse('=SUM(A1:A3) + b4').flatten()
+            )
+        finally:
+            if os.path.exists(picklefile):
+                os.remove(picklefile)
+            os.rmdir(os.path.dirname(picklefile))
@@ -5,7 +5,7 @@
 from __future__ import with_statement
 
 from datetime import datetime
-from Queue import Queue
+import os
 import sys
 from textwrap import dedent
 from unittest import SkipTest
@@ -19,15 +19,19 @@ from dirigible.test_utils import die, ResolverTestCase
 import sheet.calculate as calculate_module
 from sheet.calculate import (
     api_json_to_worksheet, calculate, calculate_with_timeout,
-    create_cell_recalculator, CURRENT_API_VERSION, evaluate_formulae_in_context,
-    execute_usercode, format_traceback, is_nan, load_constants, _raise, recalculate_cell,
-    run_worksheet, MyStdout)
-from sheet.cell import Cell, undefined
+    compile_python_formula, CURRENT_API_VERSION, evaluate_cell, evaluate_formulae_in_context,
+    evaluate_formulae_in_levels, evaluate_formulae_in_processes, execute_usercode, format_profile,
+    format_traceback, get_formulae_evaluator, is_nan, load_constants, _raise,
+    RecalcProfiler, run_worksheet, MyStdout)
+from sheet.cell import Cell, formula_parse_cache, undefined
+from sheet.dependency_graph import build_dependency_graph, Node
 from sheet.dirigible_datetime import DateTime
 from sheet.models import Sheet, User
-from sheet.parser import FormulaError
+from sheet.parser import FormulaError, parser
+from sheet.scheduler import SchedulerMetrics
 from sheet.views_api_0_1 import _sheet_to_value_only_json
 from sheet.worksheet import CellRange, Worksheet, worksheet_from_json, worksheet_to_json
+from sheet.worksheet_binary import worksheet_from_binary, worksheet_to_binary
 
 
 
@@ -79,56 +83,253 @@ class TestLoadConstants(ResolverTestCase):
 
 
 
-class TestRecalculateCell(ResolverTestCase):
+class TestCompilePythonFormula(ResolverTestCase):
 
-    def test_recalculate_cell_evals_python_formula_in_context_and_puts_results_in_worksheet(self):
+    def setUp(self):
+        calculate_module.python_formula_cache.clear()
+
+
+    def test_returns_compiled_formula_that_evaluates_with_true_division(self):
+        code, locations = compile_python_formula('1/4 + x')
+        self.assertEquals(eval(code, {'x': 1})(), 1.25)
+        self.assertEquals(locations, ())
+
+
+    def test_caches_compiled_formulae_by_python_formula(self):
+        compiled = compile_python_formula('1 + 2')
+        self.assertIs(compile_python_formula('1 + 2'), compiled)
+        self.assertIsNot(compile_python_formula('1 + 3'), compiled)
+        self.assertEquals(calculate_module.python_formula_cache.hits, 1)
+        self.assertEquals(calculate_module.python_formula_cache.misses, 2)
+
+
+    def test_does_not_cache_syntax_errors(self):
+        self.assertRaises(SyntaxError, compile_python_formula, '1 +')
+        self.assertFalse('1 +' in calculate_module.python_formula_cache)
+
+
+
+class TestRecalcProfiler(ResolverTestCase):
+
+    def test_critical_path_is_chain_of_dependencies_with_greatest_total_time(self):
+        profiler = RecalcProfiler()
+        profiler.graph = {
+            (1, 1): Node((1, 1), parents=set([(1, 3)])),
+            (1, 2): Node((1, 2), parents=set([(1, 3)])),
+            (1, 3): Node((1, 3), children=set([(1, 1), (1, 2)]), parents=set([(1, 4)])),
+            (1, 4): Node((1, 4), children=set([(1, 3)])),
+            (2, 1): Node((2, 1)),
+        }
+        profiler.cell_times = {
+            (1, 1): 0.5, (1, 2): 2.0, (1, 3): 0.25, (1, 4): 0.125, (2, 1): 1.0,
+        }
+
+        self.assertEquals(
+            profiler.critical_path(),
+            (2.375, [(1, 2), (1, 3), (1, 4)])
+        )
+
+
+    def test_critical_path_of_no_graph_is_empty(self):
+        self.assertEquals(RecalcProfiler().critical_path(), (0.0, []))
+
+
+    @patch('sheet.calculate.time')
+    def test_timed_evaluator_records_usercode_phases(self, mock_time):
+        profiler = RecalcProfiler()
+        mock_evaluate_formulae = Mock()
+        evaluate_formulae = profiler.timed_evaluator(mock_evaluate_formulae)
+
+        profiler.usercode_start = 10.0
+        mock_time.side_effect = [11.0, 13.0, 14.0, 14.5]
+        evaluate_formulae(sentinel.worksheet, sentinel.context)
+        evaluate_formulae(sentinel.worksheet, sentinel.context)
+        profiler.usercode_end = 17.0
+
+        self.assertEquals(
+            mock_evaluate_formulae.call_args_list,
+            [call(sentinel.worksheet, sentinel.context)] * 2
+        )
+        self.assertEquals(profiler.usercode_phases(), (1.0, 2.5, 2.5))
+
+
+    def test_timed_evaluator_adds_up_scheduler_metrics(self):
+        profiler = RecalcProfiler()
+        first, second = SchedulerMetrics(), SchedulerMetrics()
+        first.nodes, first.queue_wait_time = 2, 0.5
+        second.nodes, second.queue_wait_time = 3, 0.25
+        evaluate_formulae = profiler.timed_evaluator(Mock(side_effect=[first, second]))
+
+        self.assertEquals(evaluate_formulae(sentinel.worksheet, sentinel.context), first)
+        evaluate_formulae(sentinel.worksheet, sentinel.context)
+
+        self.assertEquals(profiler.scheduler.nodes, 5)
+        self.assertEquals(profiler.scheduler.queue_wait_time, 0.75)
+
+
+    def test_timed_evaluator_ignores_results_that_are_not_scheduler_metrics(self):
+        profiler = RecalcProfiler()
+        evaluate_formulae = profiler.timed_evaluator(Mock(return_value=None))
+        evaluate_formulae(sentinel.worksheet, sentinel.context)
+        self.assertEquals(profiler.scheduler, None)
+        self.assertNotIn('scheduler', profiler.as_dict(1))
+
+
+    def test_usercode_phases_when_evaluate_formulae_not_called(self):
+        profiler = RecalcProfiler()
+        profiler.usercode_start = 10.0
+        profiler.usercode_end = 12.5
+        self.assertEquals(profiler.usercode_phases(), (2.5, 0.0, 0.0))
+
+
+    def test_as_dict_reports_slowest_cells_and_critical_path_by_name(self):
+        profiler = RecalcProfiler()
+        profiler.usercode_start = profiler.usercode_end = 10.0
+        profiler.graph = {
+            (1, 1): Node((1, 1), parents=set([(1, 2)])),
+            (1, 2): Node((1, 2), children=set([(1, 1)])),
+            (2, 1): Node((2, 1)),
+        }
+        profiler.cell_times = {(1, 1): 0.5, (1, 2): 0.25, (2, 1): 1.0}
+
+        self.assertEquals(
+            profiler.as_dict(2),
+            {
+                'cells_evaluated': 3,
+                'usercode': {
+                    'before_evaluate_formulae': 0.0,
+                    'evaluate_formulae': 0.0,
+                    'after_evaluate_formulae': 0.0,
+                },
+                'slowest_cells': [
+                    {'cell': 'B1', 'seconds': 1.0},
+                    {'cell': 'A1', 'seconds': 0.5},
+                ],
+                'critical_path': {'seconds': 1.0, 'cells': ['B1']},
+            }
+        )
+
+
+    def test_format_profile(self):
+        profile = {
+            'cells_evaluated': 3,
+            'usercode': {
+                'before_evaluate_formulae': 0.5,
+                'evaluate_formulae': 2.0,
+                'after_evaluate_formulae': 0.25,
+            },
+            'slowest_cells': [
+                {'cell': 'B1', 'seconds': 1.0},
+                {'cell': 'A1', 'seconds': 0.5},
+            ],
+            'critical_path': {'seconds': 0.75, 'cells': ['A1', 'A2']},
+        }
+
+        self.assertEquals(
+            format_profile(profile),
+            'Usercode: 0.50s before evaluate_formulae, 2.00s in it, 0.25s after\n'
+            'Evaluated 3 cells\n'
+            'Slowest cells: B1 1.000s, A1 0.500s\n'
+            'Critical path: 0.750s through 2 cells (A1 -> A2)\n'
+        )
+
+
+    def test_format_profile_includes_scheduler_metrics(self):
+        profile = {
+            'cells_evaluated': 0,
+            'usercode': {
+                'before_evaluate_formulae': 0.0,
+                'evaluate_formulae': 0.0,
+                'after_evaluate_formulae': 0.0,
+            },
+            'slowest_cells': [],
+            'critical_path': {'seconds': 0.0, 'cells': []},
+            'scheduler': {
+                'nodes': 4,
+                'wall_time': 1.5,
+                'eval_time': 2.0,
+                'queue_wait_time': 0.5,
+                'max_queue_wait_time': 0.25,
+            },
+        }
+
+        self.assertEquals(
+            format_profile(profile).splitlines()[-1],
+            'Scheduler: 4 graph nodes in 1.500s, 2.000s evaluating, '
+            '0.500s queued (longest wait 0.250s)'
+        )
+
+
+
+class TestEvaluateCell(ResolverTestCase):
+
+    def test_evaluate_cell_evals_python_formula_in_context_and_puts_results_in_worksheet(self):
         location = (1, 2)
         cell = Cell()
         cell.python_formula = '100 + fred'
         context = { 'fred': 23, "worksheet": { location: cell } }
 
-        # Mocked out to avoid explosion -- tested in another unit test.
-        node = Mock()
-        node.parents = []
-
-        recalculate_cell(location, None, { location: node }, context)
+        evaluate_cell(location, context)
 
         self.assertEquals(cell.value, 123)
 
 
-    def test_recalculate_cell_should_perform_true_division(self):
+    def test_evaluate_cell_should_perform_true_division(self):
         location = (1, 2)
         cell = Cell()
         cell.python_formula = '1/4'
         context = { "worksheet": { location: cell } }
 
-        # Mocked out to avoid explosion -- tested in another unit test.
-        node = Mock()
-        node.parents = []
-
-        recalculate_cell(location, None, { location: node }, context)
+        evaluate_cell(location, context)
 
         self.assertEquals(cell.value, 0.25)
 
 
-    def test_recalculate_cell_should_remove_nodes_from_dependency_graph(self):
+    @patch('sheet.calculate.compile_python_formula')
+    def test_evaluate_cell_evals_compiled_python_formula(self, mock_compile_python_formula):
         location = (1, 2)
         cell = Cell()
-        cell.formula = '=123'
-        leaf_queue = Queue()
-        parent = Mock()
-        parent_loc = (2, 3)
-        node = Mock()
-        node.parents = set([(parent_loc)])
-        graph = { location: node, parent_loc: parent }
-        context = { 'worksheet': { location: cell, } }
+        cell.python_formula = '100 + fred'
+        mock_compile_python_formula.return_value = (
+            compile('lambda x: fred + x', '<string>', 'eval'), ((2, 3),)
+        )
+        other = Cell()
+        other.value = 4
+        context = { 'fred': 23, "worksheet": { location: cell, (2, 3): other } }
+
+        evaluate_cell(location, context)
 
-        recalculate_cell(location, leaf_queue, graph, context)
+        self.assertCalledOnce(mock_compile_python_formula, '100 + fred')
+        self.assertEquals(cell.value, 27)
 
-        self.assertEquals( node.remove_from_parents.call_args, (([parent], leaf_queue,), {}) )
 
+    def test_evaluate_cell_fetches_each_referenced_cell_value_once(self):
+        worksheet = Worksheet()
+        worksheet[1, 1].value = 2
+        worksheet[1, 2].python_formula = (
+            'worksheet[(1,1)].value * 3 + worksheet[(1,1)].value'
+        )
+        context = { 'worksheet': worksheet }
+
+        with patch('sheet.calculate._cell_value', wraps=calculate_module._cell_value) as mock_cell_value:
+            evaluate_cell((1, 2), context)
+
+        self.assertCalledOnce(mock_cell_value, worksheet, (1, 1))
+        self.assertEquals(worksheet[1, 2].value, 8)
+
+
+    def test_evaluate_cell_creates_missing_referenced_cells_like_worksheet_getitem(self):
+        worksheet = Worksheet()
+        worksheet[1, 2].python_formula = 'worksheet[(3,4)].value'
+        context = { 'worksheet': worksheet }
 
-    def test_recalc_cell_catches_cell_errors_and_adds_them_to_console(self):
+        evaluate_cell((1, 2), context)
+
+        self.assertEquals(worksheet[1, 2].value, undefined)
+        self.assertTrue((3, 4) in worksheet)
+
+
+    def test_evaluate_cell_catches_cell_errors_and_adds_them_to_console(self):
         cell = Cell()
         cell.formula = "=123"
         cell.python_formula = '_raise(Exception("OMGWTFBBQ"))'
@@ -137,15 +338,10 @@ class TestRecalculateCell(ResolverTestCase):
         location = (1, 11)
         worksheet[location] = cell
 
-        # Mocked out to avoid explosion -- tested in another unit test.
-        node = Mock()
-        node.parents = []
-        graph = {location: node }
-
         context = { 'worksheet': worksheet, "_raise": _raise }
         worksheet.add_console_text = Mock()
 
-        recalculate_cell(location, Mock(), graph, context)
+        evaluate_cell(location, context)
 
         self.assertEqual(
             worksheet[location].error,
@@ -160,7 +356,7 @@ class TestRecalculateCell(ResolverTestCase):
         self.assertEquals(worksheet[location].value, undefined)
 
 
-    def test_recalc_cell_should_clear_cell_error_and_not_add_to_console_text_on_eval_succeeding(self):
+    def test_evaluate_cell_should_clear_cell_error_and_not_add_to_console_text_on_eval_succeeding(self):
         cell = Cell()
         cell.formula = '=123'
         cell.error = 'old error, just hanging around...'
@@ -168,13 +364,9 @@ class TestRecalculateCell(ResolverTestCase):
         location = (1, 11)
         worksheet[location] = cell
 
-        node = Mock()
-        node.parents = []
-        graph = {location: node }
-
         context = { 'worksheet': { location: cell, } }
 
-        recalculate_cell(location, Mock(), graph, context)
+        evaluate_cell(location, context)
 
         self.assertEqual(
             worksheet[location].error,
@@ -189,132 +381,201 @@ class TestRecalculateCell(ResolverTestCase):
         )
 
 
-class TestCreateCellRecalculator(ResolverTestCase):
 
-    @patch('sheet.calculate.recalculate_cell')
-    def test_create_cell_recalculator_should(self, mock_recalculate):
-        unrecalculated_queue = Queue()
-        unrecalculated_queue.put(1)
-        unrecalculated_queue.put(1)
-        unrecalculated_queue.task_done = Mock()
+class TestEvaluateFormulaeInContext(ResolverTestCase):
+
+    @patch('sheet.calculate.NUM_THREADS', 2)
+    @patch('sheet.calculate.worker_pool')
+    @patch('sheet.calculate.build_dependency_graph')
+    @patch('sheet.calculate.DependencyGraphRun')
+    def test_evaluate_formulae_in_context_builds_dependency_graph_and_runs_it_on_worker_pool(
+        self, mock_run_class, mock_build_dependency_graph, mock_worker_pool
+    ):
+        mock_build_dependency_graph.return_value = (sentinel.graph, sentinel.leaves)
+        worksheet = Worksheet()
+        worksheet[1, 1].python_formula = '1 + 2'
+        context = {'worksheet': worksheet}
 
-        leaf_queue = Queue()
-        leaf_queue.put(sentinel.one)
-        leaf_queue.put(sentinel.two)
-        leaf_queue.task_done = Mock()
+        result = evaluate_formulae_in_context(worksheet, context)
 
-        target = create_cell_recalculator(leaf_queue, unrecalculated_queue, sentinel.graph, sentinel.context)
-        target()
+        self.assertCalledOnce(mock_build_dependency_graph, worksheet, None)
+        graph, evaluate, max_in_flight = mock_run_class.call_args[0]
+        self.assertEquals(graph, sentinel.graph)
+        self.assertEquals(max_in_flight, 2)
+        evaluate((1, 1))
+        self.assertEquals(worksheet[1, 1].value, 3)
 
-        self.assertTrue(unrecalculated_queue.empty())
-        self.assertEquals(
-            unrecalculated_queue.task_done.call_args_list,
-            [ ((), {}), ((), {}), ]
-        )
+        self.assertCalledOnce(mock_run_class.return_value.run, mock_worker_pool, sentinel.leaves)
+        self.assertEquals(result, mock_run_class.return_value.run.return_value)
 
-        self.assertTrue(leaf_queue.empty())
 
-        self.assertEquals(
-            mock_recalculate.call_args_list,
-            [
-                ((sentinel.one, leaf_queue, sentinel.graph, sentinel.context), {}),
-                ((sentinel.two, leaf_queue, sentinel.graph, sentinel.context), {})
-            ]
-        )
+    def test_evaluate_formulae_in_context_evaluates_children_before_parents(self):
+        worksheet = Worksheet()
+        worksheet[1, 1].formula = '=A2 + A3'
+        worksheet[1, 2].formula = '=A3 * 2'
+        worksheet[1, 3].formula = '=1'
+        worksheet[2, 1].formula = '=3'
+
+        metrics = evaluate_formulae_in_context(worksheet, {'worksheet': worksheet})
+
+        self.assertEquals(worksheet[1, 1].value, 3)
+        self.assertEquals(worksheet[2, 1].value, 3)
+        self.assertEquals(metrics.nodes, 4)
+
+
+class TestEvaluateFormulaeInLevels(ResolverTestCase):
+
+    @patch('sheet.calculate.evaluate_cell')
+    def test_evaluates_graph_one_topological_level_at_a_time(self, mock_evaluate_cell):
+        worksheet = Worksheet()
+        worksheet[1, 1].formula = '=A2 + B2'
+        worksheet[1, 2].formula = '=B2'
+        worksheet[2, 2].formula = '=1'
+        context = {'worksheet': worksheet}
+
+        evaluate_formulae_in_levels(worksheet, context)
 
         self.assertEquals(
-            leaf_queue.task_done.call_args_list,
-            [ ((), {}), ((), {}), ]
+            mock_evaluate_cell.call_args_list,
+            [call((2, 2), context), call((1, 2), context), call((1, 1), context)]
         )
 
-    @patch('sheet.calculate.recalculate_cell')
-    def test_create_cell_recalculator_should_handle_exceptions_from_recalc_cell(self, mock_recalculate):
-        mock_recalculate.side_effect = die()
-        unrecalculated_queue = Queue()
-        unrecalculated_queue.put(1)
-        unrecalculated_queue.task_done = Mock()
-
-        leaf_queue = Queue()
-        leaf_queue.put(sentinel.one)
-        leaf_queue.task_done = Mock()
 
-        target = create_cell_recalculator(leaf_queue, unrecalculated_queue, sentinel.graph, sentinel.context)
-        self.assertRaises(AssertionError, target)
+    def test_only_evaluates_locations_being_recalculated(self):
+        worksheet = Worksheet()
+        worksheet[1, 1].formula = '=A2 + 1'
+        worksheet[1, 2].formula = '=1'
+        worksheet[1, 2].value = 10
+        worksheet._recalc_locations = set([(1, 1)])
 
-        self.assertTrue(unrecalculated_queue.empty())
-        self.assertCalledOnce(unrecalculated_queue.task_done)
-        self.assertTrue(leaf_queue.empty())
-        self.assertCalledOnce(mock_recalculate, sentinel.one, leaf_queue, sentinel.graph, sentinel.context)
-        self.assertCalledOnce(leaf_queue.task_done)
+        evaluate_formulae_in_levels(worksheet, {'worksheet': worksheet})
 
+        self.assertEquals(worksheet[1, 1].value, 11)
+        self.assertEquals(worksheet[1, 2].value, 10)
 
-class TestEvaluateFormulaeInContext(ResolverTestCase):
 
-    @patch('sheet.calculate.NUM_THREADS', 2)
-    @patch('sheet.calculate.build_dependency_graph')
-    @patch('sheet.calculate.Thread')
-    @patch('sheet.calculate.Queue')
-    @patch('sheet.calculate.create_cell_recalculator')
-    def test_evaluate_formulae_in_context_builds_dependency_graph_and_recalculates_it_on_threads(
-        self, mock_create_cell_recalculator, mock_queue_class, mock_thread_class,
-        mock_build_dependency_graph
-    ):
-        mock_thread = mock_thread_class.return_value
-        mock_queue_class.side_effect = lambda: Mock()
-        mock_create_cell_recalculator.return_value = sentinel.create_cell_recalculator
-        graph = {
-            (1, 1): set([(1, 2), (1, 3)]),
-            (1, 3): set([(2, 2), (2, 3)]),
-            (2, 2): set(),
-            (1, 2): set(),
-            (2, 3): set()
-        }
-        leaves = [(2, 2), (1, 2), (2, 3)]
-        mock_build_dependency_graph.return_value = ( graph, leaves )
 
-        evaluate_formulae_in_context(Mock(), Mock())
+class TestEvaluateFormulaeInProcesses(ResolverTestCase):
 
-        arg_ids = [map(id, x[0]) for x in mock_create_cell_recalculator.call_args_list]
-        self.assertEquals(arg_ids[0][0], arg_ids[1][0], 'leaf queues passed into threads not the same')
-        self.assertEquals(arg_ids[0][1], arg_ids[1][1], 'completed queues passed into threads not the same')
+    @patch('sheet.calculate.settings.RECALCULATION_PROCESSES', 2)
+    def test_evaluates_independent_parts_of_graph_in_worker_processes(self):
+        worksheet = Worksheet()
+        worksheet[1, 1].formula = '=os.getpid()'
+        worksheet[1, 2].formula = '=A1 + offset'
+        worksheet[2, 1].formula = '=os.getpid()'
+        worksheet[2, 2].formula = '=1/0'
+        worksheet[3, 1].python_formula = 'lambda: 3'
+        context = {'worksheet': worksheet, 'offset': 1}
+        exec 'import os' in context
+
+        evaluate_formulae_in_processes(worksheet, context)
+
+        self.assertNotEqual(worksheet[1, 1].value, os.getpid())
+        self.assertEquals(worksheet[1, 2].value, worksheet[1, 1].value + 1)
+        self.assertEquals(worksheet[2, 2].value, undefined)
         self.assertEquals(
-            [args[0][2] for args in mock_create_cell_recalculator.call_args_list],
-            [graph, graph]
+            worksheet[2, 2].error,
+            'ZeroDivisionError: division by zero'
         )
-        mock_leaf_queue = mock_create_cell_recalculator.call_args_list[0][0][0]
-        self.assertEquals(
-            mock_leaf_queue.put.call_args_list,
-            [
-               ((leaves[0],), {}),
-               ((leaves[1],), {}),
-               ((leaves[2],), {})
-            ])
-
-        unrecalculated_cell_queue = mock_create_cell_recalculator.call_args_list[0][0][1]
-        self.assertEquals(len(unrecalculated_cell_queue.put.call_args_list), len(graph), 'unrecalculated queue not correctly populated')
-
-        self.assertEquals(mock_thread_class.call_args_list,
-            [
-                ((), {'target': sentinel.create_cell_recalculator}),
-                ((), {'target': sentinel.create_cell_recalculator}),
-            ]
+        self.assertIn(
+            'ZeroDivisionError: division by zero\n    Formula \'=1/0\' in B2',
+            worksheet._console_text
         )
+        self.assertEquals(worksheet[3, 1].value(), 3)
 
-        self.assertEquals(mock_thread.setDaemon.call_args_list,
-            [
-                ((True, ), {}),
-                ((True, ), {}),
-            ]
-        )
 
-        self.assertEquals(mock_thread.start.call_args_list,
-            [
-                ((), {}),
-                ((), {}),
-            ]
-        )
+    @patch('sheet.calculate.settings.RECALCULATION_PROCESSES', 2)
+    def test_merges_cell_times_from_worker_processes_when_profiling(self):
+        worksheet = Worksheet()
+        worksheet[1, 1].formula = '=1'
+        worksheet[2, 1].formula = '=2'
+        worksheet._profiler = RecalcProfiler()
+        context = {'worksheet': worksheet}
+
+        evaluate_formulae_in_processes(worksheet, context)
+
+        self.assertEquals(set(worksheet._profiler.cell_times), set([(1, 1), (2, 1)]))
+
+
+    @patch('sheet.calculate.settings.RECALCULATION_PROCESSES', 3)
+    def test_runs_end_to_end_through_calculate(self):
+        worksheet = Worksheet()
+        worksheet[1, 1].formula = '=os.getpid()'
+        worksheet[1, 2].formula = '=A1 + 1'
+        worksheet[2, 1].formula = '=os.getpid()'
+        worksheet[3, 1].formula = '=2 * 21'
+        usercode = dedent('''
+            import os
+            print 'before'
+            load_constants(worksheet)
+            evaluate_formulae(worksheet)
+            print 'after'
+        ''')
+
+        calculate(worksheet, usercode, sentinel.private_key, 'processes')
+
+        self.assertIsNone(worksheet._usercode_error)
+        self.assertNotEqual(worksheet[1, 1].value, os.getpid())
+        self.assertEquals(worksheet[1, 2].value, worksheet[1, 1].value + 1)
+        self.assertNotEqual(worksheet[2, 1].value, os.getpid())
+        self.assertEquals(worksheet[3, 1].value, 42)
+        self.assertIn('before', worksheet._console_text)
+        self.assertIn('after', worksheet._console_text)
+
+
+    @patch('sheet.calculate.settings.RECALCULATION_PROCESSES', 2)
+    @patch('sheet.calculate.MAX_PROCESS_POOL_WAIT_SECONDS', 60)
+    def test_workers_are_not_blocked_by_locks_held_in_the_parent_at_the_fork(self):
+        worksheet = Worksheet()
+        worksheet[1, 1].formula = '=1'
+        worksheet[2, 1].formula = '=2'
+        context = {'worksheet': worksheet}
+
+        locks = [
+            calculate_module.python_formula_cache._lock,
+            formula_parse_cache._lock,
+            parser._build_lock,
+        ]
+        for lock in locks:
+            lock.acquire()
+        try:
+            evaluate_formulae_in_processes(worksheet, context)
+        finally:
+            for lock in locks:
+                lock.release()
+
+        self.assertEquals(worksheet[1, 1].value, 1)
+        self.assertEquals(worksheet[2, 1].value, 2)
+
+
+    @patch('sheet.calculate.settings.RECALCULATION_PROCESSES', 2)
+    @patch('sheet.calculate.Pool')
+    def test_evaluates_in_process_when_graph_has_only_one_component(self, mock_pool):
+        worksheet = Worksheet()
+        worksheet[1, 1].formula = '=1'
+        worksheet[1, 2].formula = '=A1 + 1'
+        context = {'worksheet': worksheet}
+
+        evaluate_formulae_in_processes(worksheet, context)
+
+        self.assertFalse(mock_pool.called)
+        self.assertEquals(worksheet[1, 2].value, 2)
+
+
+
+class TestGetFormulaeEvaluator(ResolverTestCase):
+
+    @patch('sheet.calculate.settings.RECALCULATION_ENGINE', 'processes')
+    def test_uses_engine_from_settings_by_default(self):
+        self.assertEquals(get_formulae_evaluator(None), evaluate_formulae_in_processes)
+
+
+    @patch('sheet.calculate.settings.RECALCULATION_ENGINE', 'processes')
+    def test_uses_explicitly_selected_engine(self):
+        self.assertEquals(get_formulae_evaluator('threads'), evaluate_formulae_in_context)
+        self.assertEquals(get_formulae_evaluator('processes'), evaluate_formulae_in_processes)
+        self.assertEquals(get_formulae_evaluator('levels'), evaluate_formulae_in_levels)
 
-        self.assertCalledOnce(unrecalculated_cell_queue.join)
 
 
 class TestExecuteUsercode(ResolverTestCase):
@@ -389,6 +650,12 @@ class TestCalculate(ResolverTestCase):
         self.assertEquals(ws._console_text, ws2._console_text)
 
 
+    def test_mystdout_can_be_flushed(self):
+        ws = Worksheet()
+        MyStdout(ws).flush()
+        self.assertEquals(ws._console_text, '')
+
+
     @patch('sheet.calculate.execute_usercode')
     @patch('sheet.calculate.run_worksheet')
     def test_calculate_puts_curried_run_worksheet_into_context(self, mock_run_worksheet, mock_execute_usercode):
@@ -618,7 +885,18 @@ class TestCalculateWithTimeout(ResolverTestCase):
 
         self.assertEquals(
             mock_calculate.call_args,
-            ((sentinel.worksheet, sentinel.usercode, sentinel.private_key), {})
+            ((sentinel.worksheet, sentinel.usercode, sentinel.private_key, None, False), {})
+        )
+
+        calculate_with_timeout(
+            sentinel.worksheet, sentinel.usercode,
+            long_timeout_seconds, sentinel.private_key, sentinel.engine,
+            sentinel.profile
+        )
+
+        self.assertEquals(
+            mock_calculate.call_args,
+            ((sentinel.worksheet, sentinel.usercode, sentinel.private_key, sentinel.engine, sentinel.profile), {})
         )
 
 
@@ -628,10 +906,11 @@ class TestCalculateWithTimeout(ResolverTestCase):
     ):
         mock_ithread_class.return_value = mock_ithread = Mock()
         mock_ithread.isAlive.return_value = False
-        calculate_with_timeout(
+        finished = calculate_with_timeout(
             sentinel.worksheet, sentinel.usercode,
             sentinel.timeout_seconds, sentinel.private_key
         )
+        self.assertTrue(finished)
         self.assertEquals(mock_ithread.method_calls,
                           [
                               ('start', (), {}),
@@ -656,10 +935,11 @@ class TestCalculateWithTimeout(ResolverTestCase):
             return not mock_ithread.alive
         mock_ithread.isAlive.side_effect = set_is_alive
 
-        calculate_with_timeout(
+        finished = calculate_with_timeout(
             sentinel.worksheet, sentinel.usercode,
             sentinel.timeout_seconds, sentinel.private_key
         )
+        self.assertFalse(finished)
         self.assertEquals(mock_ithread.method_calls,
                           [
                               ('start', (), {}),
@@ -813,6 +1093,64 @@ class TestJsonToWorksheet(ResolverTestCase):
 
 class TestCalculateSemiFunctional(ResolverTestCase):
 
+    def test_profiling_reports_to_console_and_worksheet(self):
+        worksheet = Worksheet()
+        worksheet.A1.formula = '=1'
+        worksheet.A2.formula = '=A1 + 1'
+        worksheet.B1.formula = '=2'
+
+        calculate(worksheet, SANITY_CHECK_USERCODE % ('', ''), sentinel.private_key, None, True)
+
+        self.assertEquals(worksheet._profiler, None)
+        self.assertEquals(worksheet._profile['cells_evaluated'], 3)
+        self.assertEquals(worksheet._profile['critical_path']['cells'], ['A1', 'A2'])
+        self.assertEquals(
+            set(slow_cell['cell'] for slow_cell in worksheet._profile['slowest_cells']),
+            set(['A1', 'A2', 'B1'])
+        )
+        self.assertIn('Critical path: ', worksheet._console_text)
+        self.assertEquals(worksheet._profile['scheduler']['nodes'], 3)
+        self.assertIn('Scheduler: 3 graph nodes', worksheet._console_text)
+        self.assertEquals(
+            worksheet_from_json(worksheet_to_json(worksheet))._profile,
+            worksheet._profile
+        )
+
+        calculate(worksheet, SANITY_CHECK_USERCODE % ('', ''), sentinel.private_key)
+        self.assertEquals(worksheet._profile, None)
+        self.assertNotIn('Critical path: ', worksheet._console_text)
+
+
+    @patch('sheet.calculate.settings.PROFILE_RECALCULATION', True)
+    def test_profiling_can_be_switched_on_in_settings(self):
+        worksheet = Worksheet()
+        calculate(worksheet, SANITY_CHECK_USERCODE % ('', ''), sentinel.private_key)
+        self.assertEquals(worksheet._profile['cells_evaluated'], 0)
+
+
+    def test_ranges_over_formula_cells_with_each_engine(self):
+        for engine in ['threads', 'levels', 'processes']:
+            worksheet = Worksheet()
+            worksheet.set_cell_formulae(
+                [((1, row), '=%d' % (row,)) for row in range(1, 41)] +
+                [((2, row), '=sum(A1:A%d)' % (row,)) for row in range(1, 41)] +
+                [((3, 1), '=sum(B1:B40)'), ((3, 2), '=sum(C1:C3)'), ((3, 3), '=1')]
+            )
+
+            with patch('sheet.calculate.settings.RECALCULATION_PROCESSES', 2):
+                calculate(
+                    worksheet, SANITY_CHECK_USERCODE % ('', ''), sentinel.private_key, engine
+                )
+
+            self.assertEquals(
+                [worksheet[2, row].value for row in range(1, 41)],
+                [row * (row + 1) // 2 for row in range(1, 41)]
+            )
+            self.assertEquals(worksheet.C1.value, sum(row * (row + 1) // 2 for row in range(1, 41)))
+            self.assertEquals(worksheet.C2.error, 'CycleError: C2 -> C2')
+            self.assertEquals(worksheet.C3.value, 1)
+
+
     def test_totally_empty(self):
         worksheet = Worksheet()
         calculate(worksheet, '', sentinel.private_key)
@@ -951,6 +1289,109 @@ class TestCalculateSemiFunctional(ResolverTestCase):
         self.assertEquals(worksheet[1, 2].formula, '=foo(3)')
 
 
+    @patch('sheet.calculate.settings.INCREMENTAL_RECALCULATION', True)
+    def test_incremental_recalc_only_recalculates_edited_cells_and_their_dependents(self):
+        worksheet = Worksheet()
+        worksheet[1, 1].formula = '1'
+        worksheet[1, 2].formula = '=A1 + 1'
+        worksheet[2, 1].formula = '=10'
+        worksheet[2, 2].formula = '=B1 + A2'
+        calculate(worksheet, SANITY_CHECK_USERCODE % ('', ''), sentinel.private_key)
+        self.assertEquals(worksheet._dirty_locations, set())
+        self.assertEquals(worksheet[2, 2].value, 12)
+
+        worksheet.set_cell_formula(1, 1, '5')
+        # would raise if B1 were re-evaluated
+        worksheet[2, 1].python_formula = 'die'
+        calculate(worksheet, SANITY_CHECK_USERCODE % ('', ''), sentinel.private_key)
+
+        self.assertEquals(worksheet[1, 2].value, 6)
+        self.assertEquals(worksheet[2, 1].value, 10)
+        self.assertEquals(worksheet[2, 1].error, None)
+        self.assertEquals(worksheet[2, 2].value, 16)
+
+
+    @patch('sheet.calculate.settings.INCREMENTAL_RECALCULATION', True)
+    def test_incremental_recalc_only_looks_at_edited_cells_and_their_dependents(self):
+        worksheet = Worksheet()
+        for row in range(1, 11):
+            worksheet[1, row].formula = '=%d' % (row,)
+            worksheet[2, row].formula = '=A%d * 2' % (row,)
+        calculate(worksheet, SANITY_CHECK_USERCODE % ('', ''), sentinel.private_key)
+
+        worksheet.set_cell_formula(1, 3, '=30')
+        with patch(
+            'sheet.dependency_graph.DependencyIndex._refresh_location', autospec=True
+        ) as mock_refresh_location:
+            with patch(
+                'sheet.calculate.build_dependency_graph', wraps=build_dependency_graph
+            ) as mock_build_dependency_graph:
+                calculate(worksheet, SANITY_CHECK_USERCODE % ('', ''), sentinel.private_key)
+
+        self.assertEquals(
+            [args[1] for args, _ in mock_refresh_location.call_args_list],
+            [(1, 3)]
+        )
+        self.assertCalledOnce(
+            mock_build_dependency_graph, worksheet, set([(1, 3), (2, 3)])
+        )
+        self.assertEquals(worksheet[2, 3].value, 60)
+        self.assertEquals(worksheet[2, 4].value, 8)
+
+
+    @patch('sheet.calculate.settings.INCREMENTAL_RECALCULATION', True)
+    def test_incremental_recalc_after_loading_recalculates_values_lost_in_storage(self):
+        for to_storage, from_storage in [
+            (worksheet_to_json, worksheet_from_json),
+            (worksheet_to_binary, worksheet_from_binary),
+        ]:
+            worksheet = Worksheet()
+            worksheet.A1.formula = '=DateTime(2010, 5, 1)'
+            worksheet.A2.formula = '=1'
+            worksheet.A3.formula = '=A1.month + A2'
+            worksheet.B1.formula = '=tuple([1, 2])'
+            worksheet.B2.formula = '=B1 + (A2,)'
+            worksheet.C1.formula = '=DateTime(2011, 6, 2)'
+            calculate(worksheet, SANITY_CHECK_USERCODE % ('', ''), sentinel.private_key)
+
+            worksheet = from_storage(to_storage(worksheet))
+            self.assertEquals(
+                worksheet._values_lost_in_storage,
+                set([(1, 1), (2, 1), (2, 2), (3, 1)])
+            )
+
+            worksheet.set_cell_formula(1, 2, '=2')
+            calculate(worksheet, SANITY_CHECK_USERCODE % ('', ''), sentinel.private_key)
+
+            self.assertEquals(worksheet.A3.error, None)
+            self.assertEquals(worksheet.A3.value, 7)
+            self.assertEquals(worksheet.B2.error, None)
+            self.assertEquals(worksheet.B2.value, (1, 2, 2))
+            self.assertEquals(worksheet.C1.value, undefined)
+            self.assertEquals(worksheet._values_lost_in_storage, set([(3, 1)]))
+
+
+    @patch('sheet.calculate.settings.INCREMENTAL_RECALCULATION', True)
+    def test_incremental_recalc_falls_back_to_full_recalc_when_usercode_changes(self):
+        worksheet = Worksheet()
+        worksheet[1, 1].formula = '=1'
+        calculate(worksheet, SANITY_CHECK_USERCODE % ('', ''), sentinel.private_key)
+
+        worksheet[1, 1].python_formula = '2'
+        calculate(worksheet, SANITY_CHECK_USERCODE % ('', ''), sentinel.private_key)
+        self.assertEquals(worksheet[1, 1].value, 1)
+
+        calculate(worksheet, SANITY_CHECK_USERCODE % ('x = 1', ''), sentinel.private_key)
+        self.assertEquals(worksheet[1, 1].value, 2)
+
+
+    @patch('sheet.calculate.settings.INCREMENTAL_RECALCULATION', True)
+    def test_incremental_recalc_does_full_recalc_after_usercode_error(self):
+        worksheet = Worksheet()
+        calculate(worksheet, 'raise Exception()', sentinel.private_key)
+        self.assertEquals(worksheet._dirty_locations, None)
+
+
     @patch('sheet.calculate.urllib2')
     def test_run_worksheet_should_return_worksheet_with_calculated_values_only(self, mock_urllib2):
         self.maxDiff = None
@@ -8,13 +8,79 @@ try:
     import unittest2 as unittest
 except ImportError:
     import unittest
-from mock import Mock, patch, sentinel
-
-from sheet.cell import Cell, undefined
+from mock import call, Mock, patch, sentinel
+
+from sheet.cell import (
+    Cell, formula_parse_cache, parse_formula, parse_formulae, reset_parse_locks,
+    undefined
+)
+from sheet.parser import parser
+from sheet.utils.lru_cache import LRUCache
 from sheet.worksheet import Worksheet
 from dirigible.test_utils import ResolverTestCase
 
 
+class TestParseFormulae(ResolverTestCase):
+
+    @patch('sheet.cell.parse_formula')
+    def test_parses_each_distinct_formula_once_and_skips_constants(self, mock_parse_formula):
+        mock_parse_formula.side_effect = lambda formula: (((1, 1),), formula.lower())
+
+        parsed = parse_formulae(['=A1', 'A1', '=B2', '=A1', u'=C3', None, ''])
+
+        self.assertEquals(
+            sorted(mock_parse_formula.call_args_list),
+            [call('=A1'), call('=B2'), call(u'=C3')]
+        )
+        self.assertEquals(parsed, {
+            '=A1': (((1, 1),), '=a1'),
+            '=B2': (((1, 1),), '=b2'),
+            u'=C3': (((1, 1),), u'=c3'),
+        })
+
+
+    @patch('sheet.cell.PARALLEL_PARSE_MINIMUM', 3)
+    @patch('sheet.cell.Pool')
+    def test_fans_out_to_processes_only_if_asked_and_enough_formulae(self, mock_pool_class):
+        mock_pool = mock_pool_class.return_value
+        mock_pool.map.side_effect = lambda function, formulae, chunksize: map(function, formulae)
+
+        self.assertEquals(
+            parse_formulae(['=1', '=2', '=3'], processes=None),
+            parse_formulae(['=1', '=2', '=3'], processes=1),
+        )
+        parse_formulae(['=1', '=2'], processes=2)
+        self.assertFalse(mock_pool_class.called)
+
+        parsed = parse_formulae(['=1', '=2', '=3'], processes=2)
+
+        self.assertCalledOnce(mock_pool_class, 2, reset_parse_locks)
+        function, formulae, _ = mock_pool.map.call_args[0]
+        self.assertEquals(function, parse_formula)
+        self.assertEquals(sorted(formulae), ['=1', '=2', '=3'])
+        self.assertEquals(parsed['=2'], ((), '2'))
+        self.assertTrue(mock_pool.terminate.called)
+        self.assertTrue(mock_pool.join.called)
+
+
+    def test_reset_parse_locks_replaces_locks_held_at_a_fork(self):
+        formula_parse_cache._lock.acquire()
+        parser._build_lock.acquire()
+
+        reset_parse_locks()
+
+        self.assertFalse(formula_parse_cache._lock.locked())
+        self.assertFalse(parser._build_lock.locked())
+
+
+    def test_parses_for_real_in_worker_processes(self):
+        formulae = ['=A%d + 1' % (row,) for row in range(1, 11)]
+        with patch('sheet.cell.PARALLEL_PARSE_MINIMUM', 1):
+            parsed = parse_formulae(formulae, processes=2)
+        self.assertEquals(parsed, dict((formula, parse_formula(formula)) for formula in formulae))
+
+
+
 class TestUndefined(unittest.TestCase):
 
     def test_repr(self):
@@ -75,15 +141,50 @@ class TestCell(ResolverTestCase):
 
     def test_setting_value_to_undefined_sets_formatted_value_to_empty_string(self):
         cell = Cell()
-        cell._set_formatted_value = Mock()
+        cell.formatted_value = 'wibble'
         cell.value = undefined
-        self.assertCalledOnce(cell._set_formatted_value, u'')
+        self.assertEquals(cell.formatted_value, u'')
+
 
     def test_setting_value_sets_formatted_value_to_unicode_version(self):
         cell = Cell()
-        cell._set_formatted_value = Mock()
         cell.value = sentinel.value
-        self.assertCalledOnce(cell._set_formatted_value, unicode(sentinel.value))
+        self.assertEquals(cell.formatted_value, unicode(sentinel.value))
+
+
+    def test_formatted_value_of_simple_values_is_only_worked_out_when_needed(self):
+        cell = Cell()
+        for value in [1, 2L, 1.5, True, u'text', None]:
+            cell.value = value
+            self.assertEquals(cell._formatted_value, None)
+            self.assertEquals(cell.formatted_value, unicode(value))
+            self.assertEquals(cell._formatted_value, unicode(value))
+
+
+    def test_formatted_value_of_other_values_is_worked_out_straight_away(self):
+        class Unprintable(object):
+            def __unicode__(self):
+                raise ValueError('no')
+        cell = Cell()
+        with self.assertRaises(ValueError):
+            cell.value = Unprintable()
+
+        value = [1]
+        cell.value = value
+        value.append(2)
+        self.assertEquals(cell.formatted_value, u'[1]')
+
+
+    def test_clear_value_keeps_formatted_value_it_has_not_worked_out_yet(self):
+        cell = Cell()
+        cell.value = 29
+        cell.clear_value()
+        self.assertEquals(cell.value, undefined)
+        self.assertEquals(cell.formatted_value, u'29')
+
+
+    def test_has_no_instance_dict(self):
+        self.assertFalse(hasattr(Cell(), '__dict__'))
 
 
     def test_setting_formatted_value_to_string_passes_through(self):
@@ -152,6 +253,8 @@ class TestCell(ResolverTestCase):
     @patch('sheet.cell.get_dependencies_from_parse_tree')
     @patch('sheet.cell.get_python_formula_from_parse_tree')
     @patch('sheet.cell.parser')
+    @patch('sheet.cell.parse_simple_formula', Mock(return_value=None))
+    @patch('sheet.cell.formula_parse_cache', LRUCache(10))
     def test_setting_formula_parses_formula_sets_dependencies_then_sets_python_formula(
             self, mock_parser, mock_get_python_formula_from_parse_tree, mock_get_dependencies_from_parse_tree
     ):
@@ -162,7 +265,7 @@ class TestCell(ResolverTestCase):
                 return return_value
             return add_call
         mock_get_python_formula_from_parse_tree.side_effect = get_add_call('formula', sentinel.formula)
-        mock_get_dependencies_from_parse_tree.side_effect = get_add_call('dependencies', sentinel.dependencies)
+        mock_get_dependencies_from_parse_tree.side_effect = get_add_call('dependencies', [(1, 2)])
 
         cell = Cell()
         cell.python_formula = '=something'
@@ -184,12 +287,77 @@ class TestCell(ResolverTestCase):
         )
         self.assertEquals(
             cell.dependencies,
-            sentinel.dependencies
+            [(1, 2)]
         )
 
         self.assertEquals(call_order, ['dependencies', 'formula'])
 
 
+    @patch('sheet.cell.parser')
+    @patch('sheet.cell.parse_simple_formula', Mock(return_value=None))
+    @patch('sheet.cell.formula_parse_cache', LRUCache(2))
+    def test_setting_formula_reuses_parse_of_recently_seen_formulae(self, mock_parser):
+        mock_parser.parse.side_effect = parser.parse
+
+        for formula in ['=A1 + 1', '=B2', '=A1 + 1']:
+            Cell().formula = formula
+        self.assertEquals(
+            mock_parser.parse.call_args_list,
+            [call('=A1 + 1'), call('=B2')]
+        )
+
+        first, second = Cell(), Cell()
+        first.formula = second.formula = '=B2'
+        self.assertEquals(first.python_formula, 'worksheet[(2,2)].value ')
+        self.assertEquals(first.dependencies, [(2, 2)])
+        self.assertFalse(first.dependencies is second.dependencies)
+
+        Cell().formula = '=C3'
+        Cell().formula = '=A1 + 1'
+        self.assertEquals(len(mock_parser.parse.call_args_list), 4)
+
+
+    @patch('sheet.cell.parse_simple_formula')
+    @patch('sheet.cell.parser')
+    @patch('sheet.cell.formula_parse_cache', LRUCache(10))
+    def test_setting_formula_uses_simple_formula_fast_path_if_it_can(
+            self, mock_parser, mock_parse_simple_formula
+    ):
+        mock_parse_simple_formula.return_value = ([(1, 2)], sentinel.formula)
+
+        cell = Cell()
+        cell.formula = '=A2'
+
+        self.assertCalledOnce(mock_parse_simple_formula, '=A2')
+        self.assertFalse(mock_parser.parse.called)
+        self.assertEquals(cell.python_formula, sentinel.formula)
+        self.assertEquals(cell.dependencies, [(1, 2)])
+
+        Cell().formula = '=A2'
+        self.assertEquals(len(mock_parse_simple_formula.call_args_list), 1)
+
+
+    @patch('sheet.cell.parse_formula')
+    def test_set_formula_uses_given_parse_instead_of_parsing(self, mock_parse_formula):
+        cell = Cell()
+        cell._set_formula('=A2', (((1, 2),), 'a2'))
+
+        self.assertFalse(mock_parse_formula.called)
+        self.assertEquals(cell.formula, '=A2')
+        self.assertEquals(cell.python_formula, 'a2')
+        self.assertEquals(cell.dependencies, [(1, 2)])
+
+
+    @patch('sheet.cell.formula_parse_cache', LRUCache(10))
+    def test_setting_formula_with_syntax_error_caches_raise(self):
+        first, second = Cell(), Cell()
+        first.formula = '=#NULL!'
+        second.formula = '=#NULL!'
+
+        self.assertEquals(second.python_formula, first.python_formula)
+        self.assertEquals(second.dependencies, [])
+
+
     def test_setting_formula_with_syntax_error_sets_appropriate_raise_in_python_formula_and_clears_dependencies(self):
         cell = Cell()
 
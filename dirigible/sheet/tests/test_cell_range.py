@@ -9,7 +9,7 @@ try:
 except ImportError:
     import unittest
 
-from mock import Mock
+from mock import patch
 
 from sheet.cell import Cell, undefined
 from sheet.worksheet import Worksheet
@@ -180,11 +180,25 @@ class TestCellRanges(ResolverTestCase):
 
     def test_clear_should_call_clear_on_member_cells(self):
         cell_range = CellRange(self.ws, (1, 2), (2, 3))
-        for cell in cell_range.cells:
-            cell.clear = Mock()
+        cells = list(cell_range.cells)
+        cleared = []
+        def record_clear(cell):
+            cleared.append(cell)
+        with patch.object(Cell, 'clear', record_clear):
+            cell_range.clear()
+        # (cleared also has the spare Cells Worksheet.__getitem__ makes)
+        for cell in cells:
+            self.assertEquals(map(id, cleared).count(id(cell)), 1)
+
+
+    def test_clear_should_mark_member_locations_dirty(self):
+        self.ws._dirty_locations = set()
+        cell_range = CellRange(self.ws, (1, 2), (2, 3))
         cell_range.clear()
-        for cell in cell_range.cells:
-            self.assertCalledOnce(cell.clear)
+        self.assertEquals(
+            self.ws._dirty_locations,
+            set([(1, 2), (2, 2), (1, 3), (2, 3)])
+        )
 
 
 
@@ -0,0 +1,273 @@
+# Copyright (c) 2010 Resolver Systems Ltd, PythonAnywhere LLP
+# See LICENSE.md
+#
+
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+
+from mock import patch, sentinel
+
+from dirigible.test_utils import ResolverTestCase
+
+from sheet.calculate import calculate, load_constants
+from sheet.cell import Cell, undefined
+from sheet.cell_range import CellRange
+from sheet.columnar_worksheet import (
+    ARRAY_GROWTH_MINIMUM, ColumnarWorksheet, number_from_formula, worksheet_class,
+)
+from sheet.dependency_graph import get_dependency_index
+from sheet.eval_constant import eval_constant
+from sheet.worksheet import Worksheet, worksheet_from_json, worksheet_to_json
+
+
+USERCODE = 'load_constants(worksheet)\nevaluate_formulae(worksheet)\n'
+
+
+def make_worksheets(formulae):
+    worksheets = Worksheet(), ColumnarWorksheet()
+    for worksheet in worksheets:
+        worksheet.set_cell_formulae(formulae)
+    return worksheets
+
+
+
+class TestNumberFromFormula(ResolverTestCase):
+
+    def test_returns_numbers_only_for_formulae_that_are_just_the_number(self):
+        self.assertEquals(number_from_formula('3'), 3)
+        self.assertEquals(type(number_from_formula(u'-3')), int)
+        self.assertEquals(number_from_formula('1.5'), 1.5)
+        for formula in [
+            None, '', '=3', '03', '3.00', '1.50', ' 3', 'abc', 'True',
+            str(2 ** 53 + 1), '3.14159265358979',
+        ]:
+            self.assertIsNone(number_from_formula(formula), formula)
+
+
+
+class TestColumnarWorksheet(ResolverTestCase):
+
+    def test_keeps_plain_numbers_in_arrays_and_everything_else_in_the_dict(self):
+        worksheet = ColumnarWorksheet()
+        worksheet.set_cell_formulae([
+            ((1, 1), '1'), ((1, 2), '2.5'), ((2, 1), '=A1 + 1'), ((2, 2), 'text'),
+            ((2, 3), '3.00'),
+        ])
+
+        self.assertEquals(sorted(dict.keys(worksheet)), [(2, 1), (2, 2), (2, 3)])
+        self.assertEquals(len(worksheet), 5)
+        self.assertEquals(
+            sorted(worksheet.keys()), [(1, 1), (1, 2), (2, 1), (2, 2), (2, 3)]
+        )
+        self.assertTrue((1, 2) in worksheet)
+        self.assertFalse((1, 3) in worksheet)
+        self.assertEquals(worksheet.A2.formula, '2.5')
+        self.assertEquals(worksheet[1, 1].value, undefined)
+        self.assertTrue(isinstance(worksheet['A1'], Cell))
+        self.assertEquals(worksheet.bounds, (1, 1, 2, 3))
+
+
+    def test_behaves_like_a_worksheet_through_a_recalc(self):
+        formulae = [
+            ((1, row), str(row)) for row in range(1, 11)
+        ] + [
+            ((2, 1), '=sum(A1:A10)'), ((2, 2), '=A3 * 2'), ((2, 3), '1.5'),
+            ((2, 4), '=B3 / 2'),
+        ]
+        worksheet, columnar = make_worksheets(formulae)
+
+        calculate(worksheet, USERCODE, sentinel.private_key)
+        calculate(columnar, USERCODE, sentinel.private_key)
+
+        self.assertEquals(columnar, worksheet)
+        self.assertEquals(worksheet, columnar)
+        self.assertEquals(columnar.B1.value, 55)
+        self.assertEquals(columnar.B2.value, 6)
+        self.assertEquals(columnar.B4.value, 0.75)
+        self.assertEquals(columnar.A1.formatted_value, '1')
+        self.assertEquals(len(dict.keys(columnar)), 3)
+
+
+    def test_compares_every_cell_with_a_worksheet(self):
+        worksheet, columnar = make_worksheets([
+            ((1, 1), '1'), ((1, 2), '2.5'), ((2, 1), '=A1 + 1'), ((2, 2), 'text'),
+        ])
+
+        self.assertEquals(dict(columnar.iteritems()), dict(worksheet.iteritems()))
+        self.assertTrue(columnar == worksheet)
+        self.assertTrue(worksheet == columnar)
+        self.assertFalse(worksheet != columnar)
+
+        columnar.set_cell_formula(1, 2, '3')
+        self.assertNotEquals(dict(columnar.iteritems()), dict(worksheet.iteritems()))
+        self.assertFalse(columnar == worksheet)
+        self.assertFalse(worksheet == columnar)
+        self.assertTrue(worksheet != columnar)
+
+        worksheet.set_cell_formula(1, 2, '3')
+        del columnar[1, 1]
+        self.assertFalse(worksheet == columnar)
+        self.assertFalse(columnar == worksheet)
+
+
+    def test_load_constants_loads_numbers_in_the_arrays_without_evaluating_them(self):
+        worksheet, columnar = make_worksheets([
+            ((1, 1), '1'), ((1, 2), '2.5'), ((2, 1), '=A1 + 1'), ((2, 2), 'text'),
+        ])
+
+        with patch('sheet.calculate.eval_constant', wraps=eval_constant) as mock_eval_constant:
+            load_constants(columnar)
+
+        self.assertEquals(
+            [args for args, _ in mock_eval_constant.call_args_list], [('text',)]
+        )
+        load_constants(worksheet)
+        self.assertEquals(columnar, worksheet)
+        self.assertEquals(columnar.A1.value, 1)
+        self.assertEquals(columnar.A2.value, 2.5)
+        self.assertEquals(columnar.B1.value, undefined)
+        self.assertEquals(sorted(dict.keys(columnar)), [(2, 1), (2, 2)])
+
+
+    def test_constants_have_no_value_until_loaded(self):
+        worksheet, columnar = make_worksheets([((1, 1), '3')])
+
+        calculate(worksheet, '', sentinel.private_key)
+        calculate(columnar, '', sentinel.private_key)
+
+        self.assertEquals(columnar, worksheet)
+        self.assertEquals(columnar.A1.value, undefined)
+        self.assertEquals(columnar.A1.formatted_value, u'')
+
+
+    def test_clear_values_unloads_numbers(self):
+        columnar = ColumnarWorksheet()
+        columnar.set_cell_formulae([((1, 1), '3'), ((1, 2), '4')])
+        columnar.A1.value = 3
+        columnar.A2.value = 4
+
+        columnar.clear_values([(1, 1)])
+        self.assertEquals(columnar.A1.value, undefined)
+        self.assertEquals(columnar.A2.value, 4)
+
+        columnar.clear_values()
+        self.assertEquals(columnar.A2.value, undefined)
+        self.assertEquals(dict.keys(columnar), [])
+
+
+    def test_changing_a_number_cell_into_something_else_moves_it_to_the_dict(self):
+        columnar = ColumnarWorksheet()
+        columnar.set_cell_formulae([((1, 1), '3'), ((1, 2), '4'), ((1, 3), '5')])
+
+        cell = columnar.A1
+        cell.formula = '=A2'
+        cell.error = 'Oops'
+        self.assertEquals(dict.keys(columnar), [(1, 1)])
+        self.assertTrue(columnar.A1 is cell._cell)
+        self.assertEquals(columnar.A1.python_formula, 'worksheet[(1,2)].value ')
+        self.assertEquals(cell.error, 'Oops')
+
+        columnar.A2.value = 'not four'
+        self.assertEquals(columnar.A2.value, 'not four')
+        self.assertEquals(columnar.A2.formula, '4')
+
+        columnar.A3.formula = '6'
+        self.assertEquals(columnar.A3.formula, '6')
+        self.assertEquals(sorted(dict.keys(columnar)), [(1, 1), (1, 2)])
+
+
+    def test_setting_and_deleting_cells(self):
+        columnar = ColumnarWorksheet()
+        columnar.set_cell_formulae([((1, 1), '3'), ((1, 2), '4')])
+
+        cell = Cell()
+        cell.formula = '7'
+        columnar.A1 = cell
+        self.assertTrue(columnar.A1 is cell)
+        self.assertEquals(len(columnar), 2)
+
+        del columnar[1, 2]
+        self.assertEquals(len(columnar), 1)
+        self.assertFalse((1, 2) in columnar)
+
+        columnar.set_cell_formula(1, 3, '8')
+        self.assertEquals(columnar.A3.formula, '8')
+        columnar.set_cell_formula(1, 3, '')
+        self.assertEquals(columnar.keys(), [(1, 1)])
+
+
+    def test_set_cell_formulae_lets_later_formulae_for_a_location_win(self):
+        columnar = ColumnarWorksheet()
+        columnar.set_cell_formulae([((1, 1), '=2'), ((1, 1), '3')])
+        self.assertEquals(columnar.keys(), [(1, 1)])
+        self.assertEquals(columnar.A1.formula, '3')
+
+        columnar.set_cell_formulae([((1, 1), '3'), ((1, 1), '=2')])
+        self.assertEquals(columnar.keys(), [(1, 1)])
+        self.assertEquals(columnar.A1.formula, '=2')
+
+
+    def test_marks_cells_dirty_and_keeps_dependency_index_up_to_date(self):
+        columnar = ColumnarWorksheet()
+        columnar._dirty_locations = set()
+        index = get_dependency_index(columnar)
+        columnar.set_cell_formulae([((1, 1), '3'), ((1, 2), '=A1')])
+
+        self.assertEquals(columnar._dirty_locations, set([(1, 1), (1, 2)]))
+        self.assertEquals(index.dependents((1, 1)), set([(1, 2)]))
+
+
+    def test_far_away_rows_go_in_the_dict(self):
+        columnar = ColumnarWorksheet()
+        far_row = ARRAY_GROWTH_MINIMUM + 1
+        columnar.set_cell_formulae([((1, far_row), '1'), ((2, 1), '2')])
+        self.assertEquals(dict.keys(columnar), [(1, far_row)])
+
+        columnar.set_cell_formulae([((2, ARRAY_GROWTH_MINIMUM + 2), '3')])
+        self.assertEquals(dict.keys(columnar), [(1, far_row)])
+
+
+    def test_cell_ranges_iterate_over_values(self):
+        worksheet, columnar = make_worksheets([
+            ((1, 1), '1'), ((1, 2), '2.5'), ((2, 1), 'x'),
+        ])
+        for sheet in worksheet, columnar:
+            sheet.clear_values()
+            calculate(sheet, USERCODE, sentinel.private_key)
+
+        self.assertEquals(
+            list(CellRange(columnar, (1, 1), (2, 3))),
+            list(CellRange(worksheet, (1, 1), (2, 3))),
+        )
+        self.assertEquals(
+            list(CellRange(columnar, (1, 1), (2, 3))),
+            [1, 'x', 2.5, undefined, undefined, undefined]
+        )
+
+
+    def test_json_round_trip(self):
+        worksheet, columnar = make_worksheets([
+            ((1, 1), '1'), ((1, 2), '2.5'), ((1, 3), '=A1 + A2'), ((1, 4), 'x'),
+        ])
+        calculate(columnar, USERCODE, sentinel.private_key)
+        columnar.A5.formula = '3'
+
+        loaded = worksheet_from_json(worksheet_to_json(columnar), ColumnarWorksheet)
+
+        self.assertEquals(loaded, columnar)
+        self.assertEquals(loaded.A5.value, undefined)
+        self.assertEquals(sorted(dict.keys(loaded)), [(1, 3), (1, 4)])
+        self.assertEquals(
+            worksheet_from_json(worksheet_to_json(columnar)), loaded
+        )
+
+
+    def test_worksheet_class_comes_from_settings(self):
+        with patch('sheet.columnar_worksheet.settings') as mock_settings:
+            mock_settings.COLUMNAR_WORKSHEETS = False
+            self.assertEquals(worksheet_class(), Worksheet)
+            mock_settings.COLUMNAR_WORKSHEETS = True
+            self.assertEquals(worksheet_class(), ColumnarWorksheet)
+
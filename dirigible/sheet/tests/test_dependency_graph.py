@@ -2,6 +2,7 @@
 # See LICENSE.md
 #
 
+import sys
 
 from mock import call, Mock, patch, sentinel
 
@@ -9,14 +10,30 @@ from dirigible.test_utils import die, ResolverTestCase
 
 from sheet.cell import Cell
 from sheet.dependency_graph import (
-    _add_location_dependencies, build_dependency_graph,
-    _generate_cell_subgraph, Node)
+    _add_location_dependencies, build_dependency_graph, DependencyIndex,
+    find_dependents, get_dependency_index, Node, partition_dependency_graph, _report_cycle,
+    _strongly_connected_components,
+    topological_levels, topologically_sorted)
 from sheet.errors import (
     CycleError, report_cell_error,
 )
+from sheet.location_index import is_range_dependency
 from sheet.worksheet import Worksheet
 
 
+def formula_cells_below(index, node):
+    # The formula cells a node depends on, directly or through range blocks
+    cells = set()
+    to_visit = list(index.node_children(node))
+    while to_visit:
+        child = to_visit.pop()
+        if is_range_dependency(child):
+            to_visit.extend(index.node_children(child))
+        else:
+            cells.add(child)
+    return cells
+
+
 class TestBuildDependencyGraph(ResolverTestCase):
 
     def test_returns_graph_and_leaf_nodes(self):
@@ -119,6 +136,90 @@ class TestBuildDependencyGraph(ResolverTestCase):
         self.assertEquals(leaves, [(1, 1)])
 
 
+    def test_does_not_create_cells_the_index_thinks_are_formulae(self):
+        worksheet = Worksheet()
+        worksheet.A1.formula = '=A2'
+        worksheet.A2.formula = '=1'
+        get_dependency_index(worksheet)
+        # deleted behind the index's back, while only dirty cells are checked
+        dict.__delitem__(worksheet, (1, 2))
+        worksheet._dirty_locations = set()
+
+        build_dependency_graph(worksheet)
+
+        self.assertEquals(worksheet.keys(), [(1, 1)])
+
+
+    def test_expands_range_dependencies_only_to_formula_cells_in_range(self):
+        worksheet = Worksheet()
+        worksheet[1, 1].formula = '=SUM(A2:A100000)'
+        worksheet[1, 2].formula = '3'
+        worksheet[1, 5].formula = '=B1'
+        worksheet[2, 1].formula = '=1'
+
+        graph, leaves = build_dependency_graph(worksheet)
+
+        self.assertEquals(
+            graph,
+            {
+                (1, 1): Node((1, 1), children=set([(1, 5)]), parents=set()),
+                (1, 5): Node((1, 5), children=set([(2, 1)]), parents=set([(1, 1)])),
+                (2, 1): Node((2, 1), children=set(), parents=set([(1, 5)])),
+            }
+        )
+        self.assertEquals(leaves, [(2, 1)])
+        self.assertEquals(len(worksheet), 4)
+
+
+    def test_ranges_over_several_formula_cells_go_through_shared_blocks(self):
+        worksheet = Worksheet()
+        worksheet.A1.formula = '=SUM(B1:B4)'
+        worksheet.A2.formula = '=SUM(B1:B3)'
+        for row in range(1, 5):
+            worksheet[2, row].formula = '=%d' % (row,)
+
+        graph, leaves = build_dependency_graph(worksheet)
+
+        # B1:B4 is one block; B1:B3 is the block B1:B2 and the cell B3
+        self.assertEquals(graph[1, 1].children, set([(2, 1, 2, 4)]))
+        self.assertEquals(graph[1, 2].children, set([(2, 1, 2, 2), (2, 3)]))
+        self.assertEquals(graph[2, 1, 2, 4].children, set([(2, 1, 2, 2), (2, 3, 2, 4)]))
+        self.assertEquals(graph[2, 1, 2, 2].children, set([(2, 1), (2, 2)]))
+        self.assertEquals(graph[2, 1, 2, 2].parents, set([(1, 2), (2, 1, 2, 4)]))
+        self.assertEquals(sorted(leaves), [(2, 1), (2, 2), (2, 3), (2, 4)])
+
+
+    def test_edges_grow_with_the_number_of_formulae_not_the_area_of_ranges(self):
+        rows = 1024
+        worksheet = Worksheet()
+        worksheet.set_cell_formulae(
+            [((1, row), '=%d' % (row,)) for row in range(1, rows + 1)] +
+            [((2, row), '=SUM(A1:A%d)' % (row,)) for row in range(1, rows + 1)]
+        )
+
+        graph, _ = build_dependency_graph(worksheet)
+
+        edges = sum(len(node.children) for node in graph.itervalues())
+        # Each running total refers to at most one block of each size
+        self.assertTrue(edges <= rows * 12, edges)
+        index = worksheet._dependency_index
+        self.assertEquals(
+            formula_cells_below(index, (2, 700)), set((1, row) for row in range(1, 701))
+        )
+
+
+    def test_finds_cycles_through_ranges(self):
+        worksheet = Worksheet()
+        worksheet[1, 1].formula = '=SUM(A2:A3)'
+        worksheet[1, 3].formula = '=A1'
+
+        graph, leaves = build_dependency_graph(worksheet)
+
+        self.assertEquals(graph, {})
+        self.assertEquals(worksheet[1, 1].error, 'CycleError: A3 -> A1 -> A3')
+        self.assertEquals(worksheet[1, 3].error, 'CycleError: A3 -> A1 -> A3')
+
+
     @patch('sheet.dependency_graph.report_cell_error')
     def test_puts_errors_on_cells_in_cycles_and_omits_them_from_graph(self, mock_report_cell_error):
         mock_report_cell_error.side_effect = report_cell_error
@@ -149,267 +250,450 @@ class TestBuildDependencyGraph(ResolverTestCase):
         )
 
 
-class TestGenerateCellSubgraph(ResolverTestCase):
+    def test_does_not_put_errors_on_cells_that_depend_on_cycles(self):
+        worksheet = Worksheet()
+        worksheet[1, 1].formula = '=A2'
+        worksheet[1, 2].formula = '=A1'
+        worksheet[1, 3].formula = '=A1'
 
-    @patch('sheet.dependency_graph._generate_cell_subgraph')
-    @patch('sheet.dependency_graph._add_location_dependencies')
-    def test_should_recursively_call_itself_on_dependencies_before_adding_dependencies_to_graph(
-        self, mock_add_location_dependencies, mock_generate_cell_subgraph
-    ):
-        mock_generate_cell_subgraph.copied_call_args_list = []
+        graph, leaves = build_dependency_graph(worksheet)
 
-        def mock_recalc_recursive_call(worksheet, context, loc, visited, path):
-            self.assertFalse(mock_add_location_dependencies.called)
-            mock_generate_cell_subgraph.copied_call_args_list.append((worksheet, context, loc, set(visited), list(path)))
+        self.assertEquals(graph, {(1, 3): Node((1, 3))})
+        self.assertEquals(worksheet[1, 3].error, None)
+        self.assertEquals(worksheet[1, 1].error, worksheet[1, 2].error)
 
 
-        mock_generate_cell_subgraph.side_effect = mock_recalc_recursive_call
-        mock_generate_cell_subgraph_was_called_before_add_location_dependencies = []
+    def test_puts_errors_on_every_cell_in_a_cycle_and_reports_each_once(self):
+        worksheet = Worksheet()
+        worksheet[1, 1].formula = '=A2 + A3'
+        worksheet[1, 2].formula = '=A1'
+        worksheet[1, 3].formula = '=A3 + A1'
+
+        graph, leaves = build_dependency_graph(worksheet)
 
-        def add_location_dependencies_side_effect(*_):
-            mock_generate_cell_subgraph_was_called_before_add_location_dependencies.append(mock_generate_cell_subgraph.called)
-        mock_add_location_dependencies.side_effect = add_location_dependencies_side_effect
+        self.assertEquals(graph, {})
+        for row in (1, 2, 3):
+            self.assertTrue(worksheet[1, row].error.startswith('CycleError: '))
+        self.assertEquals(worksheet._console_text.count('CycleError'), 3)
 
+
+    def test_handles_chains_deeper_than_the_recursion_limit(self):
+        depth = sys.getrecursionlimit() * 10
         worksheet = Worksheet()
-        worksheet[1, 11].formula = '=formula'
-        worksheet[1, 11].dependencies = [(2, 22), (3, 33)]
-        context = sentinel.context
+        worksheet[1, 1].formula = '1'
+        for row in range(2, depth):
+            worksheet[1, row].python_formula = 'worksheet[(1, %d)].value + 1' % (row - 1,)
+            worksheet[1, row].dependencies = [(1, row - 1)]
 
-        _generate_cell_subgraph(worksheet, context, (1, 11), set(), [])
+        graph, leaves = build_dependency_graph(worksheet)
 
-        self.assertTrue(mock_add_location_dependencies.called)
-        self.assertTrue(mock_generate_cell_subgraph_was_called_before_add_location_dependencies[0])
-        self.assertItemsEqual(
-            mock_generate_cell_subgraph.copied_call_args_list,
-            [
-                (worksheet, context, (2, 22), set(), [(1, 11)]),
-                (worksheet, context, (3, 33), set(), [(1, 11)]),
-            ]
-        )
+        self.assertEquals(len(graph), depth - 2)
+        self.assertEquals(leaves, [(1, 2)])
+        self.assertEquals(graph[(1, 3)], Node((1, 3), children=set([(1, 2)]), parents=set([(1, 4)])))
 
 
-    @patch('sheet.dependency_graph._add_location_dependencies')
-    def test_should_add_dependencies_to_graph(
-        self, mock_add_location_dependencies
-    ):
+    def test_can_be_limited_to_some_locations(self):
         worksheet = Worksheet()
-        worksheet[99, 98].formula = '=foobar'
-        worksheet[1, 11].formula = '=foo'
-        worksheet[1, 11].dependencies = [(99, 98)]
-        graph = sentinel.graph
+        worksheet[1, 1].formula = '=A2'
+        worksheet[1, 2].formula = '=A3'
+        worksheet[1, 3].formula = '=1'
 
-        _generate_cell_subgraph(worksheet, graph, (1, 11), set(), [])
+        graph, leaves = build_dependency_graph(worksheet, set([(1, 1), (1, 2)]))
 
-        self.assertEqual(
-            mock_add_location_dependencies.call_args,
-            ((graph, (1, 11), set([(99, 98)])), {}),
+        self.assertEquals(
+            graph,
+            {
+                (1, 1): Node((1, 1), children=set([(1, 2)])),
+                (1, 2): Node((1, 2), parents=set([(1, 1)])),
+            }
         )
+        self.assertEquals(leaves, [(1, 2)])
 
 
-    @patch('sheet.dependency_graph._add_location_dependencies')
-    def test_should_remove_dependencies_with_errors_and_empty_cells(
-        self, mock_add_location_dependencies
-    ):
+    def test_keeps_range_blocks_leading_to_the_locations_it_is_limited_to(self):
         worksheet = Worksheet()
-        worksheet[1, 1].formula = '1'
-        worksheet[1, 2].error = CycleError([])
-        worksheet[1, 3].error = SyntaxError('')
-        worksheet[1, 11].formula = '=foo'
-        worksheet[1, 11].dependencies = [(1, 1), (1, 2), (1, 3), (1, 4)]
-        graph = sentinel.graph
+        worksheet[1, 1].formula = '=SUM(B1:B2)'
+        worksheet[1, 2].formula = '=SUM(B3:B4)'
+        for row in range(1, 5):
+            worksheet[2, row].formula = '=1'
 
-        _generate_cell_subgraph(worksheet, graph, (1, 11), set(), [])
+        graph, leaves = build_dependency_graph(worksheet, set([(1, 1), (2, 2)]))
 
-        self.assertCalledOnce(mock_add_location_dependencies,
-                              graph, (1, 11), set())
+        self.assertEquals(
+            graph,
+            {
+                (1, 1): Node((1, 1), children=set([(2, 1, 2, 2)])),
+                (2, 1, 2, 2): Node((2, 1, 2, 2), children=set([(2, 2)]), parents=set([(1, 1)])),
+                (2, 2): Node((2, 2), parents=set([(2, 1, 2, 2)])),
+            }
+        )
+        self.assertEquals(leaves, [(2, 2)])
 
 
-    @patch('sheet.dependency_graph._generate_cell_subgraph', die(CycleError([])))
-    @patch('sheet.dependency_graph._add_location_dependencies')
-    @patch('sheet.dependency_graph.report_cell_error')
-    def test_should_report_cell_error_and_not_add_location_on_recursive_call_raising_cycle_error_if_location_is_not_in_cycle_path(
-        self, mock_report_cell_error, mock_add_location_dependencies
-    ):
+
+class TestDependencyIndex(ResolverTestCase):
+
+    def test_from_worksheet_records_formula_dependencies_of_formula_cells(self):
         worksheet = Worksheet()
-        worksheet[1, 11].formula = '=A12'
-        worksheet[1, 11].dependencies = [(1, 12)]
+        worksheet.A1.formula = '=SUM(A2:A100000) + C1 + D1'
+        worksheet.A5.formula = '=C1'
+        worksheet.A7.formula = '7'
+        worksheet.C1.formula = '=1'
 
-        _generate_cell_subgraph(worksheet, sentinel.graph, (1, 11), set(), [])
+        index = DependencyIndex.from_worksheet(worksheet)
 
-        self.assertCalledOnce(mock_add_location_dependencies, sentinel.graph, (1, 11), set())
-        self.assertCalledOnce(mock_report_cell_error, worksheet, (1, 11), CycleError([]))
+        self.assertEquals(
+            index.children,
+            {(1, 1): set([(3, 1)]), (1, 5): set([(3, 1)]), (3, 1): set()}
+        )
+        self.assertEquals(index.node_children((1, 1)), set([(1, 5), (3, 1)]))
+        self.assertEquals(index.dependents((1, 7)), set([(1, 1)]))
+        self.assertEquals(index.dependents((3, 1)), set([(1, 1), (1, 5)]))
+        self.assertEquals(index.dependents((4, 1)), set([(1, 1)]))
+        self.assertEquals(index.dependents((2, 2)), set())
 
 
-    @patch('sheet.dependency_graph._add_location_dependencies')
-    def test_should_add_cell_to_graph_if_formula_not_set_but_python_formula_is(
-        self, mock_add_location_dependencies
-    ):
+    def test_update_patches_edges_of_dependents_when_cells_gain_or_lose_formulae(self):
         worksheet = Worksheet()
-        worksheet[1, 2].python_formula = 'blerk'
+        worksheet.A1.formula = '=SUM(B1:B10) + C1'
+        index = DependencyIndex.from_worksheet(worksheet)
 
-        _generate_cell_subgraph(worksheet, sentinel.graph, (1, 2), set(), [])
+        worksheet.B3.formula = '=C1'
+        index.update((2, 3), worksheet.B3)
+        worksheet.C1.formula = '=4'
+        index.update((3, 1), worksheet.C1)
+        self.assertEquals(
+            index.children,
+            {(1, 1): set([(3, 1)]), (2, 3): set([(3, 1)]), (3, 1): set()}
+        )
+        self.assertEquals(index.node_children((1, 1)), set([(2, 3), (3, 1)]))
 
-        self.assertCalledOnce(mock_add_location_dependencies, sentinel.graph, (1, 2), set())
+        worksheet.C1.formula = '4'
+        index.update((3, 1), worksheet.C1)
+        worksheet.B3.formula = '=SUM(A1:A2)'
+        index.update((2, 3), worksheet.B3)
+        self.assertEquals(index.children, {(1, 1): set(), (2, 3): set()})
+        self.assertEquals(index.node_children((1, 1)), set([(2, 3)]))
+        self.assertEquals(index.node_children((2, 3)), set([(1, 1)]))
 
+        del worksheet[2, 3]
+        index.update((2, 3), None)
+        self.assertEquals(index.children, {(1, 1): set()})
+        self.assertEquals(index.node_children((1, 1)), set())
+        self.assertEquals(index.dependents((2, 3)), set([(1, 1)]))
+        self.assertEquals(index.dependents((1, 1)), set())
 
-    @patch('sheet.dependency_graph._add_location_dependencies')
-    def test_should_not_reprocess_locations_already_in_visited_even_if_it_is_in_worksheet(
-        self, mock_add_location_dependencies
-    ):
-        cell = Cell()
-        cell.formula = 'constant'
+
+    def test_dependents_include_formulae_with_ranges_containing_location(self):
         worksheet = Worksheet()
-        worksheet[1, 2] = cell
+        for row in range(1, 101):
+            worksheet[2, row].formula = '=SUM(A1:A%d)' % (row,)
+        worksheet.C1.formula = '=SUM(A50:B60)'
 
-        _generate_cell_subgraph(worksheet, sentinel.graph, (1, 2), set([(1, 2)]), [])
+        index = DependencyIndex.from_worksheet(worksheet)
 
-        self.assertFalse(mock_add_location_dependencies.called)
+        self.assertEquals(
+            index.dependents((1, 60)),
+            set((2, row) for row in range(60, 101)) | set([(3, 1)])
+        )
+        self.assertEquals(index.dependents((2, 50)), set([(3, 1)]))
+        self.assertEquals(index.dependents((1, 101)), set())
 
+        worksheet.C1.formula = '=1'
+        index.update((3, 1), worksheet.C1)
+        self.assertEquals(index.dependents((2, 50)), set())
 
-    @patch('sheet.dependency_graph._generate_cell_subgraph')
-    @patch('sheet.dependency_graph._add_location_dependencies', Mock())
-    def test_should_add_location_to_visited_set_after_recursing_deps(
-        self, mock_generate_cell_subgraph
-    ):
-        visited = set()
-        visited_set_at_time_of_recursive_call = []
-        # NB: Clone visited or changes will be reflected in the one we store
-        mock_generate_cell_subgraph.side_effect = lambda *_: visited_set_at_time_of_recursive_call.append(set(visited))
 
+    def test_refresh_picks_up_cells_changed_behind_its_back(self):
         worksheet = Worksheet()
-        worksheet[1, 2].formula = '=23'
-        worksheet[1, 2].dependencies = [(3, 4)]
+        worksheet.A1.formula = '=A2'
+        worksheet.A2.formula = '=1'
+        worksheet.A3.formula = '=A2'
+        index = DependencyIndex.from_worksheet(worksheet)
 
-        _generate_cell_subgraph(worksheet, sentinel.graph, (1, 2), visited, [])
+        worksheet.A1.formula = '=A3'
+        worksheet.A2.formula = '1'
+        dict.__delitem__(worksheet, (1, 3))
+        worksheet.A4.formula = '=A1'
+        index.refresh(worksheet)
 
-        self.assertEquals(visited_set_at_time_of_recursive_call[0], set())
-        self.assertEquals(visited, set([(1, 2)]))
-        self.assertTrue(mock_generate_cell_subgraph.called)
+        self.assertEquals(index.children, DependencyIndex.from_worksheet(worksheet).children)
+        self.assertEquals(index.children, {(1, 1): set(), (1, 4): set([(1, 1)])})
+        self.assertEquals(index.dependents((1, 2)), set())
+        self.assertEquals(index.dependents((1, 3)), set([(1, 1)]))
 
 
-    def test_should_safely_handle_nonexistent_location(self):
-        empty_worksheet = {}
-        _generate_cell_subgraph(empty_worksheet, sentinel.graph, (1, 2), set(), [])
+    def test_refresh_only_checks_dirty_locations_unless_cells_changed_formulae(self):
+        worksheet = Worksheet()
+        worksheet.A1.formula = '=A2'
+        worksheet.A2.formula = '=1'
+        worksheet.A3.formula = '=1'
+        index = DependencyIndex.from_worksheet(worksheet)
+        worksheet._dirty_locations = set([(1, 1), (1, 2)])
+
+        worksheet.A1._set_formula('=A3')
+        dict.__delitem__(worksheet, (1, 2))
+        worksheet.A3._set_formula('=A1')
+        index.refresh(worksheet)
+        self.assertEquals(index.children, {(1, 1): set([(1, 3)]), (1, 3): set()})
+
+        worksheet._dirty_locations = None
+        index.refresh(worksheet)
+        self.assertEquals(index.children, {(1, 1): set([(1, 3)]), (1, 3): set()})
+
+        worksheet._dirty_locations = set()
+        worksheet.A3.formula = '=A1'
+        index.refresh(worksheet)
+        self.assertEquals(
+            index.children, {(1, 1): set([(1, 3)]), (1, 3): set([(1, 1)])}
+        )
 
 
-    @patch('sheet.dependency_graph.report_cell_error')
-    def test_should_report_then_raise_cycle_error_when_there_is_a_cycle(
-        self, mock_report_cell_error
-    ):
-        cycle_error = CycleError([(1, 2), (3, 4), (1, 2)])
+    def test_get_dependency_index_builds_index_once_then_refreshes_it(self):
         worksheet = Worksheet()
-        worksheet[1, 2].formula = "=foo"
+        worksheet.A1.formula = '=A2'
 
-        visited = set()
-        try:
-            _generate_cell_subgraph(worksheet, sentinel.graph, (1, 2), visited, [(8, 9), (1, 2), (3, 4)])
-        except Exception, e:
-            self.assertEquals(e, cycle_error)
-        else:
-            self.fail("No Exception raised")
+        index = get_dependency_index(worksheet)
+        self.assertEquals(worksheet._dependency_index, index)
 
-        self.assertCalledOnce(mock_report_cell_error, worksheet, (1, 2), cycle_error)
-        self.assertEquals(visited, set([(1, 2)]))
+        worksheet.A2.formula = '=2'
+        self.assertTrue(get_dependency_index(worksheet) is index)
+        self.assertEquals(index.children[1, 1], set([(1, 2)]))
 
 
-    def test_should_raise_any_existing_cycle_error_for_visited_locations(self):
-        cycle_error = CycleError([(1, 2), (3, 4), (1, 2)])
+    def test_references_within_finds_cells_referring_inside_bounds(self):
         worksheet = Worksheet()
-        worksheet[1, 2].error = cycle_error
+        worksheet.A1.formula = '=B2'
+        worksheet.A2.formula = '=SUM(B2:C3)'
+        worksheet.A3.formula = '=SUM(B2:C4)'
+        worksheet.A4.formula = '=D5 + $C$3'
+        worksheet.A5.formula = '=SUM(A1:B2)'
+        worksheet.A6.formula = '=E9'
+        worksheet.A7.formula = 'B2'
+        index = DependencyIndex.from_worksheet(worksheet)
 
-        try:
-            _generate_cell_subgraph(worksheet, sentinel.graph, (1, 2), set([(1, 2)]), sentinel.path)
-        except Exception, e:
-            self.assertEquals(e, cycle_error)
-        else:
-            self.fail("No Exception raised")
+        self.assertEquals(
+            index.references_within((2, 2, 3, 3)), set([(1, 1), (1, 2), (1, 4)])
+        )
+        # bigger than the number of referenced locations, so it looks through
+        # those rather than every location in the bounds
+        self.assertEquals(
+            index.references_within((1, 1, 3, 3)),
+            set([(1, 1), (1, 2), (1, 4), (1, 5)])
+        )
 
 
-    @patch('sheet.dependency_graph._generate_cell_subgraph')
-    @patch('sheet.dependency_graph.report_cell_error')
-    @patch('sheet.dependency_graph._add_location_dependencies', Mock())
-    def test_should_reraise_cycle_error_after_reporting_if_its_in_the_cycle_path(
-        self, mock_report_cell_error, mock_recursive_call
-    ):
-        cycle_error = CycleError([(1, 2), (3, 4), (1, 2)])
+
+class TestFindDependents(ResolverTestCase):
+
+    def test_returns_locations_and_their_transitive_dependents(self):
         worksheet = Worksheet()
-        worksheet[1, 2].formula = "=C4"
-        mock_recursive_call.side_effect = die(cycle_error)
-
-        visited = set()
-        try:
-            _generate_cell_subgraph(worksheet, sentinel.graph, (1, 2), visited, [])
-        except Exception, e:
-            self.assertEquals(e, cycle_error)
-        else:
-            self.fail("No Exception raised")
+        worksheet[1, 1].formula = '1'
+        worksheet[1, 2].formula = '=A1 + 1'
+        worksheet[1, 3].formula = '=A2 + B1'
+        worksheet[2, 1].formula = '2'
+        worksheet[2, 2].formula = '=B1'
 
-        self.assertCalledOnce(mock_report_cell_error, worksheet, (1, 2), cycle_error)
-        self.assertEquals(visited, set([(1, 2)]))
+        self.assertEquals(
+            find_dependents(worksheet, set([(1, 1)])),
+            set([(1, 1), (1, 2), (1, 3)])
+        )
+        self.assertEquals(
+            find_dependents(worksheet, set([(2, 1)])),
+            set([(2, 1), (1, 3), (2, 2)])
+        )
 
 
-    @patch('sheet.dependency_graph._generate_cell_subgraph')
-    @patch('sheet.dependency_graph.report_cell_error')
-    @patch('sheet.dependency_graph._add_location_dependencies', Mock())
-    def test_should_not_reraise_cycle_error_if_its_outside_the_cycle_path(
-        self, mock_report_cell_error, mock_recursive_call
-    ):
-        cycle_error = CycleError([(1, 2), (3, 4), (1, 2)])
+    def test_includes_dependents_of_deleted_cells(self):
         worksheet = Worksheet()
-        worksheet[1, 3].formula = "=foo"
-        mock_recursive_call.side_effect = die(cycle_error)
+        worksheet[1, 2].formula = '=A1 + 1'
 
-        _generate_cell_subgraph(worksheet, sentinel.graph, (1, 3), set(), []) # should not raise
+        self.assertEquals(
+            find_dependents(worksheet, set([(1, 1)])),
+            set([(1, 1), (1, 2)])
+        )
 
 
-    @patch('sheet.dependency_graph._generate_cell_subgraph')
-    def test_should_not_recurse_into_existing_cycle_errors_or_include_them_in_its_deps(
-        self, mock_recursive_call
-    ):
-        cycle_error = CycleError([(1, 2), (3, 4), (1, 2)])
+    def test_finds_dependents_through_ranges(self):
         worksheet = Worksheet()
-        worksheet[1, 2].error = cycle_error
-        worksheet[3, 4].error = cycle_error
-        worksheet[1, 3].formula = "=foo"
-        worksheet[1, 3].dependencies = [(3, 4)]
-
-        visited = set([(1, 2), (3, 4)])
-        graph = {}
-        _generate_cell_subgraph(worksheet, graph, (1, 3), visited, [])
+        worksheet[1, 1].formula = '=SUM(B1:C100000)'
+        worksheet[1, 2].formula = '=A1'
+        worksheet[1, 3].formula = '=SUM(B1:B4)'
 
-        dep_cell_calls = [c[0][2] for c in mock_recursive_call.call_args_list]
-        self.assertNotIn(dep_cell_calls, (3, 4))
-        self.assertEquals(visited, set([(1, 2), (1, 3), (3, 4)]))
-        self.assertEquals(graph, {(1, 3): Node((1, 3), set())})
+        self.assertEquals(
+            find_dependents(worksheet, set([(3, 50000)])),
+            set([(3, 50000), (1, 1), (1, 2)])
+        )
+        self.assertEquals(
+            find_dependents(worksheet, set([(2, 4)])),
+            set([(2, 4), (1, 1), (1, 2), (1, 3)])
+        )
 
 
-    def test_does_not_include_discovered_cycle_in_deps_of_current_cell(self):#
+    def test_terminates_on_cycles(self):
         worksheet = Worksheet()
         worksheet[1, 1].formula = '=A2'
         worksheet[1, 2].formula = '=A1'
-        worksheet[1, 3].formula = '=A1'
 
-        visited = set()
-        graph = {}
+        self.assertEquals(
+            find_dependents(worksheet, set([(1, 1)])),
+            set([(1, 1), (1, 2)])
+        )
 
-        _generate_cell_subgraph(worksheet, graph, (1, 3), visited, [])
-        self.assertEquals(graph, {(1, 3): Node((1, 3), set())})
-        self.assertEquals(visited, set([(1, 2), (1, 3), (1, 1)]))
 
 
-    @patch('sheet.dependency_graph.report_cell_error')
-    def test_reports_error_once_per_cell(self, mock_report_cell_error):
-        mock_report_cell_error.side_effect = report_cell_error
+class TestPartitionDependencyGraph(ResolverTestCase):
+
+    def test_splits_graph_into_connected_components_in_dependency_order(self):
         worksheet = Worksheet()
-        worksheet[1, 1].formula = '=A2'
-        worksheet[1, 2].formula = '=A1'
+        worksheet[1, 1].formula = '=A2 + A3'
+        worksheet[1, 2].formula = '=A3'
+        worksheet[1, 3].formula = '=1'
+        worksheet[2, 1].formula = '=B2'
+        worksheet[2, 2].formula = '=2'
+        worksheet[3, 1].formula = '=3'
+        graph, _ = build_dependency_graph(worksheet)
+
+        components = partition_dependency_graph(graph)
+
+        self.assertItemsEqual(
+            components,
+            [
+                [(1, 3), (1, 2), (1, 1)],
+                [(2, 2), (2, 1)],
+                [(3, 1)],
+            ]
+        )
+
+
+    def test_topologically_sorted_puts_children_before_parents(self):
+        graph = {
+            (1, 1): Node((1, 1), children=set([(1, 2), (2, 2)])),
+            (1, 2): Node((1, 2), children=set([(2, 2)]), parents=set([(1, 1)])),
+            (2, 2): Node((2, 2), parents=set([(1, 1), (1, 2)])),
+        }
+        self.assertEquals(
+            topologically_sorted(graph, set(graph)),
+            [(2, 2), (1, 2), (1, 1)]
+        )
+
+
+
+class TestTopologicalLevels(ResolverTestCase):
+
+    def test_groups_nodes_into_levels_that_only_depend_on_earlier_levels(self):
+        worksheet = Worksheet()
+        worksheet[1, 1].formula = '=A2 + B3'
+        worksheet[1, 2].formula = '=A3'
+        worksheet[1, 3].formula = '=1'
+        worksheet[2, 3].formula = '=2'
+        worksheet[3, 3].formula = '=B3'
+        graph, _ = build_dependency_graph(worksheet)
+
+        levels = topological_levels(graph)
+
+        self.assertEquals(
+            map(set, levels),
+            [
+                set([(1, 3), (2, 3)]),
+                set([(1, 2), (3, 3)]),
+                set([(1, 1)]),
+            ]
+        )
+
+
+    def test_can_be_limited_to_some_locations(self):
+        graph = {
+            (1, 1): Node((1, 1), children=set([(1, 2)])),
+            (1, 2): Node((1, 2), parents=set([(1, 1)])),
+            (2, 1): Node((2, 1)),
+        }
+        self.assertEquals(
+            topological_levels(graph, set([(1, 1), (1, 2)])),
+            [[(1, 2)], [(1, 1)]]
+        )
+
+
+
+class TestStronglyConnectedComponents(ResolverTestCase):
+
+    def test_yields_components_after_the_components_they_depend_on(self):
+        dependencies = {
+            'a': ['b', 'c'],
+            'b': ['c'],
+            'c': [],
+            'd': ['a'],
+        }
+
+        self.assertEquals(
+            list(_strongly_connected_components(['d', 'a', 'b', 'c'], dependencies)),
+            [['c'], ['b'], ['a'], ['d']]
+        )
 
-        try:
-            _generate_cell_subgraph(worksheet, {}, (1, 1), set(), [])
-        except CycleError:
-            pass
 
-        self.assertEquals(len(mock_report_cell_error.call_args_list), 2)
+    def test_groups_cycles_with_first_visited_location_first(self):
+        dependencies = {
+            'a': ['b'],
+            'b': ['c', 'e'],
+            'c': ['d'],
+            'd': ['b'],
+            'e': ['e'],
+            'f': ['a'],
+        }
+
+        self.assertEquals(
+            list(_strongly_connected_components(['a', 'b', 'c', 'd', 'e', 'f'], dependencies)),
+            [['e'], ['b', 'c', 'd'], ['a'], ['f']]
+        )
+
+
+    def test_handles_chains_deeper_than_the_recursion_limit(self):
+        depth = sys.getrecursionlimit() * 10
+        dependencies = dict((n, [n + 1]) for n in range(depth))
+        dependencies[depth] = []
+
+        components = list(_strongly_connected_components(range(depth + 1), dependencies))
+
+        self.assertEquals(components, [[n] for n in reversed(range(depth + 1))])
+
+
+
+class TestReportCycle(ResolverTestCase):
+
+    @patch('sheet.dependency_graph.report_cell_error')
+    def test_reports_shortest_cycle_from_first_location_on_every_location_in_component(
+        self, mock_report_cell_error
+    ):
+        dependencies = {
+            (1, 1): [(1, 2)],
+            (1, 2): [(1, 4), (1, 3)],
+            (1, 3): [(1, 1)],
+            (1, 4): [(1, 2)],
+        }
+
+        _report_cycle(sentinel.worksheet, [(1, 1), (1, 2), (1, 4), (1, 3)], dependencies)
+
+        cycle_error = CycleError([(1, 1), (1, 2), (1, 3), (1, 1)])
+        self.assertEquals(
+            mock_report_cell_error.call_args_list,
+            [
+                call(sentinel.worksheet, (1, 1), cycle_error),
+                call(sentinel.worksheet, (1, 3), cycle_error),
+                call(sentinel.worksheet, (1, 2), cycle_error),
+                call(sentinel.worksheet, (1, 4), cycle_error),
+            ]
+        )
+
+
+    @patch('sheet.dependency_graph.report_cell_error')
+    def test_reports_self_references(self, mock_report_cell_error):
+        _report_cycle(sentinel.worksheet, [(1, 1)], {(1, 1): [(1, 1)]})
+
+        self.assertCalledOnce(
+            mock_report_cell_error,
+            sentinel.worksheet, (1, 1), CycleError([(1, 1), (1, 1)])
+        )
+
 
 
 class TestDependencyGraphNode(ResolverTestCase):
@@ -432,11 +716,6 @@ class TestDependencyGraphNode(ResolverTestCase):
         self.assertEquals(n3.children, set())
         self.assertEquals(n3.parents, set([1, 2, 3]))
 
-    def test_nodes_should_have_a_lock(self):
-        node = Node((1, 2))
-        self.assertIsNotNone(node.lock.acquire)
-        self.assertIsNotNone(node.lock.release)
-
     def test_equality(self):
         n1 = Node((1, 2), children=set([1]))
         n1.parents = set([2])
@@ -469,50 +748,6 @@ class TestDependencyGraphNode(ResolverTestCase):
             "<Node 1,2 children={1, 2, 3} parents={}>"
         )
 
-    def test_remove_should_acquire_lock_on_parent_nodes(self):
-        parent1 = Node((1, 2))
-        parent2 = Node((2, 3))
-        node = Node((3, 4), parents=set([(1, 2), (2, 3)]))
-        parent1.children = set([(3, 4)])
-        parent2.children = set([(3, 4)])
-        leaf_queue = Mock()
-
-        parent1.lock = Mock()
-        parent1.lock.aquire.side_effect = lambda: self.assertTrue(node in parent1.children)
-        parent1.lock.release.side_effect = lambda: self.assertFalse(node in parent1.children)
-
-        parent2.lock = Mock()
-        parent2.lock.aquire.side_effect = lambda: self.assertTrue(node in parent2.children)
-        parent2.lock.release.side_effect = lambda: self.assertFalse(node in parent2.children)
-
-        node.remove_from_parents([parent1, parent2], leaf_queue)
-
-        self.assertTrue(parent1.lock.acquire.called)
-        self.assertTrue(parent1.lock.release.called)
-        self.assertTrue(parent2.lock.acquire.called)
-        self.assertTrue(parent2.lock.release.called)
-
-        self.assertEquals(
-            leaf_queue.put.call_args_list,
-            [call((1, 2)), call((2, 3))]
-        )
-
-
-    def test_remove_should_add_new_leaves_to_queue(self):
-        parent = Node((1, 2))
-        child1 = Node((2, 3), parents=set([parent.location]))
-        child2 = Node((3, 4), parents=set([parent.location]))
-        parent.children = set([child1.location, child2.location])
-        leaf_queue = Mock()
-
-        child1.remove_from_parents([parent], leaf_queue)
-
-        self.assertFalse(leaf_queue.put.called)
-
-        child2.remove_from_parents([parent], leaf_queue)
-
-        self.assertEquals(leaf_queue.put.call_args, ((parent.location,), {}))
-
 
 class TestAddLocationDependencies(ResolverTestCase):
 
@@ -0,0 +1,82 @@
+# Copyright (c) 2010 Resolver Systems Ltd, PythonAnywhere LLP
+# See LICENSE.md
+#
+
+import __future__
+
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+
+from sheet.cell import Cell
+from sheet.formula_compiler import compile_formula
+from sheet.worksheet import Worksheet
+from dirigible.test_utils import ResolverTestCase
+
+
+class TestCompileFormula(ResolverTestCase):
+
+    def test_turns_cell_references_into_arguments_in_order_of_first_use(self):
+        code, locations = compile_formula(
+            'worksheet[(2,1)].value + worksheet[(1,1)].value * worksheet[(2,1)].value'
+        )
+
+        self.assertEquals(locations, ((2, 1), (1, 1)))
+        self.assertEquals(eval(code, {})(3, 4), 15)
+
+
+    def test_formula_without_cell_references_gives_function_of_no_arguments(self):
+        code, locations = compile_formula('x + 1')
+
+        self.assertEquals(locations, ())
+        self.assertEquals(eval(code, {'x': 2})(), 3)
+
+
+    def test_uses_true_division(self):
+        code, _ = compile_formula('worksheet[(1,1)].value / 4')
+        self.assertEquals(eval(code, {})(1), 0.25)
+
+
+    def test_leaves_other_uses_of_worksheet_alone(self):
+        worksheet = Worksheet()
+        worksheet.name = 'Sheet1'
+        worksheet[1, 1].formula = 'hello '
+        code, locations = compile_formula('worksheet[(1,1)].formula + worksheet.name')
+
+        self.assertEquals(locations, ())
+        self.assertEquals(eval(code, {'worksheet': worksheet})(), 'hello Sheet1')
+
+
+    def test_references_inside_nested_lambdas_and_generators_use_the_arguments(self):
+        code, locations = compile_formula(
+            '(lambda x: x + worksheet[(1,1)].value)(sum(worksheet[(1,2)].value for _ in range(2)))'
+        )
+
+        self.assertEquals(locations, ((1, 1), (1, 2)))
+        self.assertEquals(eval(code, {})(1, 10), 21)
+
+
+    def test_matches_eval_of_python_formula_from_full_pipeline(self):
+        worksheet = Worksheet()
+        worksheet[1, 1].value = 3
+        worksheet[2, 1].value = 4
+        worksheet[1, 2].value = 5
+        for formula in [
+            '=A1 + B1 * 2', '=A1 / B1', '=SUM(A1:B2) + A2', '=[A1, B1][0] ** 2',
+            '=(lambda x -> x * A2)(B1)',
+        ]:
+            cell = Cell()
+            cell.formula = formula
+            context = {'worksheet': worksheet, 'SUM': sum, 'CellRange': lambda ws, a, b: [3, 4, 5]}
+            code, locations = compile_formula(cell.python_formula)
+            self.assertEquals(
+                eval(code, context)(*[worksheet[location].value for location in locations]),
+                eval(compile(cell.python_formula, '<string>', 'eval', __future__.division.compiler_flag, True), context),
+                'differs for %r' % (formula,)
+            )
+
+
+    def test_syntax_errors_propagate(self):
+        self.assertRaises(SyntaxError, compile_formula, '1 +')
+
@@ -0,0 +1,89 @@
+# Copyright (c) 2010 Resolver Systems Ltd, PythonAnywhere LLP
+# See LICENSE.md
+#
+
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+
+from random import Random
+
+from sheet.formula_fast_path import parse_simple_formula
+from sheet.formula_interpreter import (
+    get_dependencies_from_parse_tree, get_python_formula_from_parse_tree,
+)
+from sheet.parser.parser import parse
+from dirigible.test_utils import ResolverTestCase
+
+
+def parse_fully(formula):
+    parse_tree = parse(formula)
+    return (
+        get_dependencies_from_parse_tree(parse_tree),
+        get_python_formula_from_parse_tree(parse_tree)
+    )
+
+
+# Bits of formulae, both inside and outside the fast path's subset, for
+# stringing together at random.
+FRAGMENTS = [
+    'A1', 'b2', '$A$1', 'A$3', '$c4', 'a1:b2', 'B3:A1', 'ZZZ9', 'ZZZZ1', 'A0',
+    '1', '0', '01', '1.5', '.5', '1.', '1e3', '2E-2', '1j', '1L', '0x1',
+    '+', '-', '*', '/', '**', '//', '%', '^', '(', ')', ',', ':',
+    ' ', '  ', '\t', 'SUM', 'sum', 'f', '_x', 'x_', 'A_', '_1', 'if', 'and',
+    'lambda', 'print', 'True', 'pi', '.', '=', '"s"', 'A1(', 'f(', 'g (',
+    'Sheet1!', "'Sheet 1'!", '#Invalid!', '#Deleted!', '[', ']', '<', '==',
+]
+
+
+class TestParseSimpleFormula(ResolverTestCase):
+
+    def assert_same_as_full_parser(self, formula):
+        dependencies, python_formula = parse_simple_formula(formula)
+        self.assertEquals(
+            (dependencies, python_formula), parse_fully(formula),
+            'differs for %r' % (formula,)
+        )
+
+
+    def test_simple_formulae_match_full_parser(self):
+        for formula in [
+            '=1', '=A1', '=a1', '=$A$1', '=A$1 + $b2', '=  A1', '=A1  ',
+            '=A1+B1*2', '=A1 + B1 * 2', '=A1\t*\tB1', '=-A1', '=+-1',
+            '=(A1 + 2) / 3', '=((A1))', '=-(A1+2)**2', '=2 ** -A1 ** 3',
+            '=1.5 + .5 + 1. + 1e3 + 2.5E-2', '=0 + 10',
+            '=SUM(A1:A10)', '= sum( a1 : b2 , 3.5e3)', '=A1:B2', '=B3:A1',
+            '=A1:B2 ** 2', '=f()', '=f( )', '=f (A1, g(B2, C3:D4), 3)',
+            '=A1 + A1', '=None', '=pi * 2', '=ZZZ1',
+        ]:
+            self.assert_same_as_full_parser(formula)
+
+
+    def test_returns_none_outside_subset(self):
+        for formula in [
+            'A1', '', '=', '=  ', '=A1 +', '=(A1', '=A1)', '=f(A1,)', '=f(,)',
+            '=(1, 2)', '=A1, B1', '=A1:', '=A1:1', '=A1:B2:C3', '=A1(2)',
+            '=f(1)(2)', '=A1 A2', '=1 2', '=1L', '=1j', '=0x1', '=01',
+            '=1.5.5', '=1A', '=A1 // 2', '=A1 % 2', '=A1 ^ 2', '=A1 == 2',
+            '=A_', '=_1', '=_x', '=A$', '=if(A1, 1, 2)', '=AND(A1, B1)',
+            '=lambda', '=print', '=x.A1', '=Sheet1!A1', "='Sheet 1'!A1",
+            '=#Invalid!', '="s"', '=[A1]', '=ZZZZ1', '=A1\n', '=#Deleted!:A1',
+        ]:
+            self.assertIsNone(
+                parse_simple_formula(formula), 'accepted %r' % (formula,)
+            )
+
+
+    def test_random_formulae_match_full_parser_wherever_accepted(self):
+        random = Random(0)
+        accepted = 0
+        for _ in xrange(20000):
+            formula = '=' + ''.join(
+                random.choice(FRAGMENTS) for _ in range(random.randint(1, 7))
+            )
+            if parse_simple_formula(formula) is not None:
+                accepted += 1
+                self.assert_same_as_full_parser(formula)
+        self.assertTrue(accepted > 1000)
+
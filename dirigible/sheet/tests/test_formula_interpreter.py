@@ -251,18 +251,22 @@ class TestGetParseTreeDependencies(ResolverTestCase):
         self.assertEquals(get_dependencies_from_parse_tree(parse("=<Sheet1> + A2")), [(1, 2)])
 
 
-    def test_get_parse_tree_dependencies_should_return_cellrange_deps(self):
-        self.assertItemsEqual(
+    def test_get_parse_tree_dependencies_should_return_cellrange_deps_as_normalised_bounds(self):
+        self.assertEquals(
             get_dependencies_from_parse_tree(parse('=a2:b3')),
-            [(1, 2), (1, 3), (2, 2), (2, 3)]
+            [(1, 2, 2, 3)]
         )
-        self.assertItemsEqual(
+        self.assertEquals(
             get_dependencies_from_parse_tree(parse('=b3:a2')),
-            [(1, 2), (1, 3), (2, 2), (2, 3)]
+            [(1, 2, 2, 3)]
         )
-        self.assertItemsEqual(
+        self.assertEquals(
             get_dependencies_from_parse_tree(parse('=a3:b2')),
-            [(1, 2), (1, 3), (2, 2), (2, 3)]
+            [(1, 2, 2, 3)]
+        )
+        self.assertEquals(
+            get_dependencies_from_parse_tree(parse('=SUM(A1:A100000) + C1')),
+            [(1, 1, 1, 100000), (3, 1)]
         )
 
 
@@ -50,6 +50,22 @@ class WorksheetFromCSVTest(ResolverTestCase):
             self.assertEquals(worksheet.B5.formula, 'old')
 
 
+    @patch('sheet.importer.settings')
+    def test_sets_formulae_in_bulk_using_import_parse_processes_setting(self, mock_settings):
+        mock_settings.IMPORT_PARSE_PROCESSES = 3
+        csv = StringIO('=A1,2\n=A1,x\n')
+        csv.size = 10
+        worksheet = Mock()
+
+        worksheet_from_csv(worksheet, csv, 2, 3, True)
+
+        self.assertCalledOnce(
+            worksheet.set_cell_formulae,
+            [((2, 3), '=A1'), ((3, 3), '2'), ((2, 4), '=A1'), ((3, 4), 'x')],
+            3
+        )
+
+
     def test_excel_csv_import_recognises_accents_and_currency_symbols(self):
         excel_csv = StringIO()
         excel_csv.write(u"\xe9".encode('windows-1252'))
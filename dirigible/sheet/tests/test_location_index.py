@@ -0,0 +1,67 @@
+# Copyright (c) 2010 Resolver Systems Ltd, PythonAnywhere LLP
+# See LICENSE.md
+#
+
+from dirigible.test_utils import ResolverTestCase
+
+from sheet.location_index import is_range_dependency, LocationIndex
+
+
+class TestIsRangeDependency(ResolverTestCase):
+
+    def test_distinguishes_ranges_from_locations(self):
+        self.assertTrue(is_range_dependency((1, 2, 3, 4)))
+        self.assertFalse(is_range_dependency((1, 2)))
+
+
+
+class TestLocationIndex(ResolverTestCase):
+
+    def test_contains_and_len(self):
+        index = LocationIndex([(1, 2), (3, 4), (1, 7)])
+        self.assertEquals(len(index), 3)
+        self.assertTrue((1, 7) in index)
+        self.assertFalse((1, 3) in index)
+        self.assertFalse((2, 2) in index)
+
+
+    def test_locations_in_returns_indexed_locations_inside_bounds(self):
+        index = LocationIndex([
+            (1, 1), (1, 5), (2, 3), (2, 100000), (3, 2), (5, 5),
+        ])
+
+        self.assertEquals(
+            list(index.locations_in((1, 2, 3, 5))),
+            [(1, 5), (2, 3), (3, 2)]
+        )
+        self.assertEquals(
+            list(index.locations_in((2, 1, 2, 1000000))),
+            [(2, 3), (2, 100000)]
+        )
+        self.assertEquals(list(index.locations_in((4, 1, 4, 10))), [])
+
+
+    def test_expand_replaces_ranges_with_indexed_locations_and_keeps_single_locations(self):
+        index = LocationIndex([(1, 1), (1, 2), (2, 2)])
+
+        self.assertEquals(
+            list(index.expand([(9, 9), (1, 1, 1, 1000), (2, 2)])),
+            [(9, 9), (1, 1), (1, 2), (2, 2)]
+        )
+
+
+    def test_add_and_discard_keep_index_sorted(self):
+        index = LocationIndex([(2, 5)])
+
+        index.add((2, 1))
+        index.add((1, 9))
+        index.add((2, 1))
+        self.assertEquals(len(index), 3)
+        self.assertEquals(list(index.locations_in((1, 1, 2, 9))), [(1, 9), (2, 1), (2, 5)])
+
+        index.discard((1, 9))
+        index.discard((2, 5))
+        index.discard((7, 7))
+        self.assertEquals(len(index), 1)
+        self.assertFalse((1, 9) in index)
+        self.assertEquals(list(index.locations_in((1, 1, 2, 9))), [(2, 1)])
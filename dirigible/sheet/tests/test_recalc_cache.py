@@ -0,0 +1,126 @@
+# Copyright (c) 2010 Resolver Systems Ltd, PythonAnywhere LLP
+# See LICENSE.md
+#
+
+from mock import patch
+
+from dirigible.test_utils import ResolverTestCase
+
+from sheet.recalc_cache import (
+    DjangoRecalcCache, get_recalc_cache, MemoryRecalcCache, recalc_cache_key,
+    usercode_is_deterministic,
+)
+from sheet.worksheet import Worksheet
+
+
+class TestUsercodeIsDeterministic(ResolverTestCase):
+
+    def test_looks_for_marker_comment_on_its_own_line(self):
+        self.assertTrue(usercode_is_deterministic(
+            'load_constants(worksheet)\n# dirigible: deterministic\n'
+        ))
+        self.assertTrue(usercode_is_deterministic('  #Dirigible:Deterministic  '))
+        self.assertFalse(usercode_is_deterministic('evaluate_formulae(worksheet)'))
+        self.assertFalse(usercode_is_deterministic(
+            'x = "# dirigible: deterministic"'
+        ))
+
+
+
+class TestRecalcCacheKey(ResolverTestCase):
+
+    def test_depends_on_formulae_and_usercode(self):
+        worksheet = Worksheet()
+        worksheet.A1.formula = '=1'
+        key = recalc_cache_key(worksheet, u'evaluate_formulae(worksheet)')
+        self.assertEquals(key, recalc_cache_key(worksheet, u'evaluate_formulae(worksheet)'))
+        self.assertNotEquals(key, recalc_cache_key(worksheet, u'pass'))
+
+        moved = Worksheet()
+        moved.A2.formula = '=1'
+        self.assertNotEquals(key, recalc_cache_key(moved, u'evaluate_formulae(worksheet)'))
+        changed = Worksheet()
+        changed.A1.formula = '=2'
+        self.assertNotEquals(key, recalc_cache_key(changed, u'evaluate_formulae(worksheet)'))
+
+
+    def test_does_not_depend_on_results_of_the_last_recalc(self):
+        worksheet = Worksheet()
+        worksheet.A1.formula = '=1'
+        key = recalc_cache_key(worksheet, u'evaluate_formulae(worksheet)')
+
+        worksheet.A1.value = 1
+        worksheet.A1.formatted_value = '1'
+        worksheet.A1.error = 'oops'
+        worksheet.B1.value = 'set by usercode'
+        worksheet._console_text = 'Took 0.01s'
+        worksheet._profile = dict(cells_evaluated=1)
+
+        self.assertEquals(key, recalc_cache_key(worksheet, u'evaluate_formulae(worksheet)'))
+
+
+    @patch('sheet.recalc_cache.settings')
+    def test_depends_on_engine_and_profiling(self, mock_settings):
+        mock_settings.RECALCULATION_ENGINE = 'threads'
+        mock_settings.PROFILE_RECALCULATION = False
+        worksheet = Worksheet()
+        worksheet.A1.formula = '=1'
+        key = recalc_cache_key(worksheet, u'')
+
+        self.assertEquals(key, recalc_cache_key(worksheet, u'', 'threads'))
+        self.assertNotEquals(key, recalc_cache_key(worksheet, u'', 'levels'))
+        mock_settings.RECALCULATION_ENGINE = 'levels'
+        self.assertNotEquals(key, recalc_cache_key(worksheet, u''))
+        mock_settings.RECALCULATION_ENGINE = 'threads'
+        mock_settings.PROFILE_RECALCULATION = True
+        self.assertNotEquals(key, recalc_cache_key(worksheet, u''))
+
+
+    def test_handles_unicode(self):
+        worksheet = Worksheet()
+        worksheet.A1.formula = u'\u20ac'
+        recalc_cache_key(worksheet, u'# \xa3')
+
+
+
+class TestMemoryRecalcCache(ResolverTestCase):
+
+    def test_evicts_least_recently_used_results(self):
+        cache = MemoryRecalcCache(2)
+        cache.put('a', 'A')
+        cache.put('b', 'B')
+        cache.get('a')
+        cache.put('c', 'C')
+
+        self.assertEquals(cache.get('a'), 'A')
+        self.assertEquals(cache.get('b'), None)
+        self.assertEquals(cache.get('c'), 'C')
+
+
+
+class TestGetRecalcCache(ResolverTestCase):
+
+    @patch('sheet.recalc_cache.settings.RECALCULATION_CACHE', None)
+    def test_is_none_when_disabled(self):
+        self.assertEquals(get_recalc_cache(), None)
+
+
+    @patch('sheet.recalc_cache.settings.RECALCULATION_CACHE', 'memory')
+    @patch('sheet.recalc_cache.settings.RECALCULATION_CACHE_SIZE', 3)
+    @patch('sheet.recalc_cache._memory_recalc_cache', None)
+    def test_memory_cache_is_shared_and_sized_from_settings(self):
+        cache = get_recalc_cache()
+        self.assertTrue(isinstance(cache, MemoryRecalcCache))
+        self.assertEquals(cache._results.maxsize, 3)
+        self.assertTrue(get_recalc_cache() is cache)
+
+
+    @patch('sheet.recalc_cache.settings.RECALCULATION_CACHE', 'django')
+    @patch('sheet.recalc_cache.settings.RECALCULATION_CACHE_ALIAS', 'default')
+    def test_django_cache_uses_configured_cache(self):
+        cache = get_recalc_cache()
+        self.assertTrue(isinstance(cache, DjangoRecalcCache))
+
+        cache.put('recalc:test', '{"calculated": true}')
+        self.assertEquals(cache.get('recalc:test'), '{"calculated": true}')
+        self.assertEquals(cache.get('recalc:missing'), None)
@@ -7,9 +7,15 @@ try:
 except ImportError:
     import unittest
 
-from sheet.worksheet import Worksheet
+from mock import patch
+
+from sheet.parser import FormulaError
+from sheet.parser.parse_node import ParseNode
+from sheet.parser.parse_node_constructors import FLCellRange, FLCellReference
+from sheet.parser.parser import parse
+from sheet.worksheet import Worksheet, worksheet_from_json, worksheet_to_json
 from sheet.rewrite_formula_offset_cell_references import (
-    rewrite_formula, rewrite_source_sheet_formulae_for_cut,
+    formula_template_cache, rewrite_formula, rewrite_source_sheet_formulae_for_cut,
 )
 
 class TestRewriteFormulaOffsetCellReferences(unittest.TestCase):
@@ -256,3 +262,138 @@ class TestRewriteFormulaOffsetCellReferences(unittest.TestCase):
         self.assertEquals(worksheet.A4.formula, 'B1:B2')
         self.assertEquals(worksheet.A5.formula, '=$C$4:$C$5')
 
+
+    def test_source_sheet_only_rewrites_cells_referring_to_cut_range(self):
+        worksheet = Worksheet()
+        worksheet.A1.formula = '=B1'
+        worksheet.A2.formula = '=B3 + B1:B2'
+        worksheet.A3.formula = '=$B$1:$B$3'
+        worksheet.A4.python_formula = '1 + 1'
+
+        with patch(
+            'sheet.rewrite_formula_offset_cell_references.rewrite_formula',
+            wraps=rewrite_formula
+        ) as mock_rewrite_formula:
+            rewrite_source_sheet_formulae_for_cut(worksheet, (2, 1, 2, 2), 3, 4)
+
+        self.assertEquals(
+            sorted(args[0] for args, _ in mock_rewrite_formula.call_args_list),
+            ['=B1', '=B3 + B1:B2']
+        )
+        self.assertEquals(worksheet.A1.formula, '=C4')
+        self.assertEquals(worksheet.A2.formula, '=B3 + C4:C5')
+        self.assertEquals(worksheet.A3.formula, '=$B$1:$B$3')
+        self.assertEquals(worksheet.A4.python_formula, '1 + 1')
+        self.assertEquals(
+            worksheet._dependency_index.references_within((3, 4, 3, 5)),
+            set([(1, 1), (1, 2)])
+        )
+
+
+    def test_source_sheet_rewrites_formulae_edited_since_the_dependency_index_was_built(self):
+        worksheet = Worksheet()
+        worksheet.A1.formula = '=B1'
+        worksheet.A2.formula = '=1'
+        worksheet.A3.formula = '=2'
+        worksheet = worksheet_from_json(worksheet_to_json(worksheet))
+        rewrite_source_sheet_formulae_for_cut(worksheet, (4, 1, 4, 1), 5, 1)
+
+        worksheet.set_cell_formula(1, 1, '=1')
+        worksheet.set_cell_formula(1, 2, '=B2')
+        worksheet.A3.formula = '=sum(B1:B2)'
+        rewrite_source_sheet_formulae_for_cut(worksheet, (2, 1, 2, 2), 3, 4)
+
+        self.assertEquals(worksheet.A1.formula, '=1')
+        self.assertEquals(worksheet.A2.formula, '=C5')
+        self.assertEquals(worksheet.A3.formula, '=sum(C4:C5)')
+
+
+
+
+def rewrite_formula_by_reparsing(
+    formula, column_offset, row_offset, is_cut, orig_bounds
+):
+    # How rewrite_formula used to work, offsetting the references in a new
+    # parse tree every time, for comparison.
+    if formula is None or not formula.startswith('='):
+        return formula
+
+    def in_bounds((column, row)):
+        return (
+            orig_bounds[0] <= column <= orig_bounds[2] and
+            orig_bounds[1] <= row <= orig_bounds[3]
+        )
+
+    def rewrite(node):
+        if isinstance(node, FLCellRange):
+            first, second = node.first_cell_reference, node.second_cell_reference
+            if not is_cut or (in_bounds(first.coords) and in_bounds(second.coords)):
+                first.offset(column_offset, row_offset, move_absolute=is_cut)
+                second.offset(column_offset, row_offset, move_absolute=is_cut)
+        elif isinstance(node, FLCellReference):
+            if not is_cut or in_bounds(node.coords):
+                node.offset(column_offset, row_offset, move_absolute=is_cut)
+        elif isinstance(node, ParseNode):
+            for child in node.children:
+                rewrite(child)
+
+    try:
+        parse_tree = parse(formula)
+    except FormulaError:
+        return formula
+    rewrite(parse_tree)
+    return parse_tree.flatten()
+
+
+
+class TestRewriteFormulaUsesTemplates(unittest.TestCase):
+
+    def setUp(self):
+        formula_template_cache.clear()
+
+
+    def test_parses_each_formula_once_for_many_offsets(self):
+        with patch(
+            'sheet.rewrite_formula_offset_cell_references.parse', wraps=parse
+        ) as mock_parse:
+            results = [
+                rewrite_formula('=A1 + $B$2', column, row, False, (1, 1, 1, 1))
+                for column in range(3) for row in range(3)
+            ]
+        self.assertEquals(mock_parse.call_count, 1)
+        self.assertEquals(results[0], '=A1 + $B$2')
+        self.assertEquals(results[5], '=B3 + $B$2')
+        self.assertEquals(results[8], '=C3 + $B$2')
+
+
+    def test_caches_unparseable_formulae_too(self):
+        with patch(
+            'sheet.rewrite_formula_offset_cell_references.parse', wraps=parse
+        ) as mock_parse:
+            for _ in range(2):
+                self.assertEquals(
+                    rewrite_formula('=1 +', 1, 1, False, (1, 1, 1, 1)), '=1 +'
+                )
+        self.assertEquals(mock_parse.call_count, 1)
+
+
+    def test_matches_offsetting_reparsed_formulae(self):
+        formulae = [
+            '=A1', '=a1 + b2', '=$A1+A$1 * $a$1', '=A1  ', '=  sum(A1:B2 , $c$3 : d4)',
+            '=B2:A1', '=Sheet1!a1 + $A$1', "='my sheet'!B$2:c3", '=<Sheet1>.A1',
+            '=A1 + #Invalid!', '=#Deleted!', '=A_ + _1 + A1', '=[x for x in A1:A3]',
+            u'=u"\\u20ac" + A2', '=ZZZ1 + A1', '=foo(A1, B2:C3)[0]', '=1 +',
+            '=lambda x -> x + C3',
+        ]
+        bounds = [(1, 1, 2, 2), (2, 2, 3, 3), (1, 1, 1, 1)]
+        for formula in formulae:
+            for column_offset in (-2, -1, 0, 1, 5):
+                for row_offset in (-3, 0, 2):
+                    for is_cut in (False, True):
+                        for orig_bounds in bounds:
+                            arguments = (formula, column_offset, row_offset, is_cut, orig_bounds)
+                            self.assertEquals(
+                                rewrite_formula(*arguments),
+                                rewrite_formula_by_reparsing(*arguments),
+                                'differs for %r' % (arguments,)
+                            )
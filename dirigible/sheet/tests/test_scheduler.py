@@ -0,0 +1,137 @@
+# Copyright (c) 2010 Resolver Systems Ltd, PythonAnywhere LLP
+# See LICENSE.md
+#
+
+from threading import Event, Lock
+
+from mock import Mock
+
+from dirigible.test_utils import ResolverTestCase
+
+from sheet.dependency_graph import Node
+from sheet.scheduler import DependencyGraphRun, SchedulerMetrics, WorkerPool
+
+
+class WorkerPoolTest(ResolverTestCase):
+
+    def test_runs_submitted_tasks_on_a_persistent_thread(self):
+        pool = WorkerPool()
+        done = Event()
+        pool.submit(done.set)
+        done.wait(5)
+        self.assertTrue(done.is_set())
+
+        done.clear()
+        pool.submit(done.set)
+        done.wait(5)
+        self.assertTrue(done.is_set())
+        self.assertEquals(pool.num_threads, 1)
+
+
+    def test_starts_new_thread_only_when_all_threads_are_busy(self):
+        pool = WorkerPool()
+        blocker = Lock()
+        blocker.acquire()
+        started = Event()
+        def block():
+            started.set()
+            blocker.acquire()
+            blocker.release()
+        pool.submit(block)
+        started.wait(5)
+
+        done = Event()
+        pool.submit(done.set)
+        done.wait(5)
+        self.assertTrue(done.is_set())
+        self.assertEquals(pool.num_threads, 2)
+        blocker.release()
+
+
+    def test_survives_exceptions_in_tasks(self):
+        pool = WorkerPool()
+        pool.submit(Mock(side_effect=Exception('ohno')))
+        done = Event()
+        pool.submit(done.set)
+        done.wait(5)
+        self.assertTrue(done.is_set())
+
+
+
+class DependencyGraphRunTest(ResolverTestCase):
+
+    def test_evaluates_every_node_after_its_children_and_reports_metrics(self):
+        graph = {
+            (1, 1): Node((1, 1), children=set([(1, 2), (1, 3)])),
+            (1, 2): Node((1, 2), children=set([(1, 3)]), parents=set([(1, 1)])),
+            (1, 3): Node((1, 3), parents=set([(1, 1), (1, 2)])),
+            (2, 1): Node((2, 1)),
+        }
+        evaluated = []
+        def evaluate(location):
+            for child in graph[location].children:
+                self.assertIn(child, evaluated)
+            evaluated.append(location)
+
+        metrics = DependencyGraphRun(graph, evaluate, 2).run(WorkerPool(), [(1, 3), (2, 1)])
+
+        self.assertItemsEqual(evaluated, graph.keys())
+        self.assertEquals(type(metrics), SchedulerMetrics)
+        self.assertEquals(metrics.nodes, 4)
+        self.assertTrue(metrics.wall_time >= metrics.max_queue_wait_time)
+
+
+    def test_limits_number_of_nodes_in_pool(self):
+        graph = dict(((1, row), Node((1, row))) for row in range(1, 21))
+        in_flight = []
+        max_in_flight = []
+        lock = Lock()
+        def evaluate(location):
+            with lock:
+                in_flight.append(location)
+                max_in_flight.append(len(in_flight))
+            with lock:
+                in_flight.remove(location)
+
+        DependencyGraphRun(graph, evaluate, 3).run(WorkerPool(), graph.keys())
+
+        self.assertEquals(len(max_in_flight), 20)
+        self.assertTrue(max(max_in_flight) <= 3)
+
+
+    def test_still_finishes_when_evaluation_raises(self):
+        graph = {
+            (1, 1): Node((1, 1), children=set([(1, 2)])),
+            (1, 2): Node((1, 2), parents=set([(1, 1)])),
+        }
+        evaluate = Mock(side_effect=Exception('ohno'))
+
+        metrics = DependencyGraphRun(graph, evaluate, 2).run(WorkerPool(), [(1, 2)])
+
+        self.assertEquals(evaluate.call_count, 2)
+        self.assertEquals(metrics.nodes, 2)
+
+
+    def test_returns_immediately_for_empty_graph(self):
+        metrics = DependencyGraphRun({}, Mock(), 2).run(WorkerPool(), [])
+        self.assertEquals(metrics.nodes, 0)
+
+
+
+class SchedulerMetricsTest(ResolverTestCase):
+
+    def test_add_sums_times_and_keeps_longest_queue_wait(self):
+        metrics = SchedulerMetrics()
+        metrics.nodes, metrics.wall_time, metrics.eval_time = 2, 1.0, 0.5
+        metrics.queue_wait_time, metrics.max_queue_wait_time = 0.25, 0.125
+        other = SchedulerMetrics()
+        other.nodes, other.wall_time, other.eval_time = 3, 2.0, 1.5
+        other.queue_wait_time, other.max_queue_wait_time = 0.5, 0.0625
+
+        metrics.add(other)
+
+        self.assertEquals(
+            (metrics.nodes, metrics.wall_time, metrics.eval_time,
+             metrics.queue_wait_time, metrics.max_queue_wait_time),
+            (5, 3.0, 2.0, 0.75, 0.125)
+        )
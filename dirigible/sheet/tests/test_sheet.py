@@ -10,7 +10,10 @@ from django.contrib.auth.models import User
 
 from dirigible.test_utils import ResolverDjangoTestCase
 
+from sheet.calculate import calculate_with_timeout
 from sheet.models import copy_sheet_to_user, Sheet
+from sheet.recalc_cache import MemoryRecalcCache, recalc_cache_key
+from sheet.views import update_sheet_with_version_check
 from user.models import OneTimePad
 from sheet.worksheet import Worksheet, worksheet_to_json
 
@@ -120,25 +123,106 @@ class SheetModelTest(ResolverDjangoTestCase):
         self.assertEquals(len(OneTimePad.objects.all()), 0)
 
 
-    @patch('sheet.sheet.worksheet_from_json')
-    def test_unjsonify_worksheet_should_return_worksheet(self, mock_worksheet_from_json):
+    @patch('sheet.sheet.worksheet_class')
+    @patch('sheet.sheet.worksheet_from_contents')
+    def test_unjsonify_worksheet_should_return_worksheet(
+        self, mock_worksheet_from_contents, mock_worksheet_class
+    ):
+        mock_worksheet_class.return_value = sentinel.worksheet_class
         sheet = Sheet()
         sheet.contents_json = sentinel.contents_json
 
         worksheet = sheet.unjsonify_worksheet()
 
-        self.assertEquals(worksheet, mock_worksheet_from_json.return_value)
-        self.assertCalledOnce(mock_worksheet_from_json, sentinel.contents_json)
+        self.assertEquals(worksheet, mock_worksheet_from_contents.return_value)
+        self.assertCalledOnce(
+            mock_worksheet_from_contents, sentinel.contents_json, sentinel.worksheet_class
+        )
+
+
+    @patch('sheet.sheet.worksheet_range_from_contents')
+    def test_unjsonify_worksheet_range_should_read_range_from_contents(
+        self, mock_worksheet_range_from_contents
+    ):
+        sheet = Sheet()
+        sheet.contents_json = sentinel.contents_json
+
+        worksheet = sheet.unjsonify_worksheet_range(sentinel.range)
+
+        self.assertEquals(worksheet, mock_worksheet_range_from_contents.return_value)
+        self.assertCalledOnce(
+            mock_worksheet_range_from_contents, sentinel.contents_json, sentinel.range
+        )
+
+
+    @patch('sheet.worksheet_binary.settings')
+    def test_binary_sheets_are_kept_in_the_binary_column(self, mock_settings):
+        user = User(username='binary')
+        user.save()
+        worksheet = Worksheet()
+        worksheet.A1.formula = '=1 + 1'
+        worksheet.A2.formula = u'Sacr\xe9 bleu!'
+        mock_settings.WORKSHEET_STORAGE_FORMAT = 'binary'
+        sheet = Sheet(owner=user)
+        sheet.jsonify_worksheet(worksheet)
+        sheet.save()
+
+        sheet = Sheet.objects.get(pk=sheet.id)
+        self.assertEquals(sheet.contents_json, '')
+        self.assertEquals(sheet.unjsonify_worksheet(), worksheet)
+
+        worksheet.A3.formula = 'edited'
+        sheet.jsonify_worksheet(worksheet)
+        update_sheet_with_version_check(sheet, contents_json=sheet.contents_json)
+        self.assertEquals(Sheet.objects.get(pk=sheet.id).unjsonify_worksheet(), worksheet)
+
+        mock_settings.WORKSHEET_STORAGE_FORMAT = 'json'
+        sheet = Sheet.objects.get(pk=sheet.id)
+        sheet.jsonify_worksheet(worksheet)
+        sheet.save()
+        sheet = Sheet.objects.get(pk=sheet.id)
+        self.assertEquals(sheet.contents_binary, None)
+        self.assertEquals(sheet.contents_json, worksheet_to_json(worksheet))
+
 
+    @patch('sheet.worksheet_binary.worksheet_from_json')
+    @patch('sheet.worksheet_binary.worksheet_from_binary')
+    @patch('sheet.worksheet_binary.settings')
+    def test_unjsonify_worksheet_range_of_binary_sheet_only_loads_cells_in_range(
+        self, mock_settings, mock_worksheet_from_binary, mock_worksheet_from_json
+    ):
+        mock_settings.WORKSHEET_STORAGE_FORMAT = 'binary'
+        user = User(username='ranger')
+        user.save()
+        worksheet = Worksheet()
+        for row in range(1, 1001):
+            worksheet[1, row].formula = 'row %d' % (row,)
+            worksheet[30, row].formula = '=A%d' % (row,)
+        sheet = Sheet(owner=user)
+        sheet.jsonify_worksheet(worksheet)
+        sheet.save()
 
-    @patch('sheet.sheet.worksheet_to_json')
-    def test_jsonify_worksheet_should_write_json_to_contents_json_field(self, mock_worksheet_to_json):
+        sheet = Sheet.objects.get(pk=sheet.id)
+        from_range = sheet.unjsonify_worksheet_range((27, 501, 52, 600))
+
+        self.assertFalse(mock_worksheet_from_binary.called)
+        self.assertFalse(mock_worksheet_from_json.called)
+        self.assertEquals(
+            sorted(from_range.keys()), [(30, row) for row in range(501, 601)]
+        )
+        self.assertEquals(from_range[30, 501].formula, '=A501')
+
+
+    @patch('sheet.sheet.worksheet_to_contents')
+    def test_jsonify_worksheet_should_write_contents_to_contents_json_field(
+        self, mock_worksheet_to_contents
+    ):
         sheet = Sheet()
 
         sheet.jsonify_worksheet(sentinel.worksheet)
 
-        self.assertCalledOnce(mock_worksheet_to_json, sentinel.worksheet)
-        self.assertEquals(sheet.contents_json, mock_worksheet_to_json.return_value)
+        self.assertCalledOnce(mock_worksheet_to_contents, sentinel.worksheet)
+        self.assertEquals(sheet.contents_json, mock_worksheet_to_contents.return_value)
 
 
     @patch('sheet.sheet.json')
@@ -230,11 +314,126 @@ class SheetModelTest(ResolverDjangoTestCase):
             sheet.unjsonify_worksheet.return_value,
             sheet.usercode,
             sheet.timeout_seconds,
-            sheet.create_private_key.return_value
+            sheet.create_private_key.return_value,
+            None,
+            False
         )
         self.assertCalledOnce(sheet.jsonify_worksheet, sheet.unjsonify_worksheet.return_value)
 
 
+    @patch('sheet.sheet.calculate_with_timeout')
+    def test_calculate_passes_sheets_recalculation_engine_if_set(self, mock_calculate):
+        sheet = Sheet()
+        sheet.jsonify_worksheet = Mock()
+        sheet.unjsonify_worksheet = Mock()
+        sheet.create_private_key = Mock()
+        sheet.otp = Mock()
+        sheet.recalculation_engine = 'processes'
+
+        sheet.calculate()
+
+        self.assertEquals(mock_calculate.call_args[0][4], 'processes')
+
+
+    @patch('sheet.sheet.calculate_with_timeout')
+    def test_calculate_passes_profile_flag(self, mock_calculate):
+        sheet = Sheet()
+        sheet.jsonify_worksheet = Mock()
+        sheet.unjsonify_worksheet = Mock()
+        sheet.create_private_key = Mock()
+        sheet.otp = Mock()
+
+        sheet.calculate(profile=True)
+
+        self.assertEquals(mock_calculate.call_args[0][5], True)
+
+
+    @patch('sheet.sheet.get_recalc_cache')
+    @patch('sheet.sheet.calculate_with_timeout')
+    def test_calculate_caches_results_of_deterministic_usercode(
+        self, mock_calculate, mock_get_recalc_cache
+    ):
+        mock_get_recalc_cache.return_value = recalc_cache = MemoryRecalcCache(10)
+        mock_calculate.return_value = True
+        sheet = Sheet()
+        sheet.jsonify_worksheet = Mock()
+        sheet.unjsonify_worksheet = Mock()
+        worksheet = Worksheet()
+        worksheet.A1.formula = '=1'
+        sheet.unjsonify_worksheet.return_value = worksheet
+        sheet.create_private_key = Mock()
+        sheet.otp = Mock()
+        sheet.usercode = '# dirigible: deterministic\nevaluate_formulae(worksheet)'
+        sheet.contents_json = 'uncalculated'
+        def jsonify_worksheet(_):
+            sheet.contents_json = 'calculated'
+        sheet.jsonify_worksheet.side_effect = jsonify_worksheet
+
+        sheet.calculate()
+        self.assertEquals(
+            recalc_cache.get(recalc_cache_key(worksheet, sheet.usercode)),
+            'calculated'
+        )
+
+        sheet.contents_json = 'uncalculated'
+        sheet.calculate()
+
+        self.assertEquals(sheet.contents_json, 'calculated')
+        self.assertEquals(mock_calculate.call_count, 1)
+
+
+    @patch('sheet.sheet.get_recalc_cache')
+    def test_recalculating_an_unchanged_sheet_uses_the_cached_results(
+        self, mock_get_recalc_cache
+    ):
+        mock_get_recalc_cache.return_value = MemoryRecalcCache(10)
+        user = User(username='recalculator')
+        user.save()
+        sheet = Sheet(owner=user)
+        sheet.usercode = '# dirigible: deterministic\n' + sheet.usercode
+        worksheet = Worksheet()
+        worksheet.A1.formula = '1'
+        worksheet.A2.formula = '=A1 + 1'
+        sheet.jsonify_worksheet(worksheet)
+        sheet.save()
+
+        with patch('sheet.sheet.calculate_with_timeout', wraps=calculate_with_timeout) \
+                as mock_calculate:
+            sheet.calculate()
+            calculated_contents_json = sheet.contents_json
+            sheet.calculate()
+
+        self.assertEquals(mock_calculate.call_count, 1)
+        self.assertEquals(sheet.contents_json, calculated_contents_json)
+        self.assertEquals(sheet.unjsonify_worksheet().A2.value, 2)
+
+
+    @patch('sheet.sheet.get_recalc_cache')
+    @patch('sheet.sheet.calculate_with_timeout')
+    def test_calculate_does_not_cache_nondeterministic_or_timed_out_recalcs(
+        self, mock_calculate, mock_get_recalc_cache
+    ):
+        mock_get_recalc_cache.return_value = recalc_cache = Mock()
+        sheet = Sheet()
+        sheet.jsonify_worksheet = Mock()
+        sheet.unjsonify_worksheet = Mock()
+        sheet.unjsonify_worksheet.return_value = Worksheet()
+        sheet.create_private_key = Mock()
+        sheet.otp = Mock()
+
+        sheet.usercode = 'evaluate_formulae(worksheet)'
+        sheet.calculate()
+        self.assertFalse(recalc_cache.get.called)
+
+        sheet.usercode = '# dirigible: deterministic\nevaluate_formulae(worksheet)'
+        recalc_cache.get.return_value = None
+        mock_calculate.return_value = False
+        sheet.calculate()
+        self.assertTrue(recalc_cache.get.called)
+        self.assertFalse(recalc_cache.put.called)
+        self.assertEquals(mock_calculate.call_count, 2)
+
+
     @patch('sheet.sheet.calculate_with_timeout')
     def test_calculate_always_deletes_private_key_in_finally_block(
         self, mock_calculate
@@ -0,0 +1,299 @@
+# Copyright (c) 2010 Resolver Systems Ltd, PythonAnywhere LLP
+# See LICENSE.md
+#
+
+import simplejson as json
+from mock import patch
+
+from django.contrib.auth.models import User
+
+from dirigible.test_utils import ResolverDjangoTestCase, ResolverTestCase
+
+from sheet.dependency_graph import get_dependency_index
+from sheet.models import Sheet, SheetTile, copy_sheet_to_user
+from sheet.recalc_cache import MemoryRecalcCache
+from sheet.tiled_storage import (
+    worksheet_from_tiles, worksheet_range_from_tiles, worksheet_to_tiles,
+)
+from sheet.views import update_sheet_with_version_check
+from sheet.worksheet_binary import MAGIC, worksheet_range_from_contents
+from sheet.worksheet import Worksheet
+
+
+def make_worksheet():
+    worksheet = Worksheet()
+    worksheet.set_cell_formulae([
+        ((1, 1), '1'), ((1, 2), '=A1 + 1'), ((26, 100), 'corner'),
+        ((27, 1), '=A1 * 2'), ((1, 101), '=sum(A1:A2)'), ((60, 250), 'far'),
+    ])
+    worksheet.A1.value = 1
+    worksheet.A2.value = 2
+    worksheet._console_text = 'output'
+    worksheet._dirty_locations = set([(1, 2)])
+    get_dependency_index(worksheet)
+    return worksheet
+
+
+
+class TestWorksheetTiles(ResolverTestCase):
+
+    @patch('sheet.dependency_graph.settings.PERSIST_DEPENDENCY_INDEX', True, create=True)
+    def test_splits_cells_into_tiles_and_attributes(self):
+        worksheet = make_worksheet()
+
+        contents_json, tile_contents = worksheet_to_tiles(worksheet)
+
+        self.assertEquals(
+            sorted(tile_contents.keys()), [(0, 0), (0, 1), (1, 0), (2, 2)]
+        )
+        attributes = json.loads(contents_json)
+        self.assertEquals(attributes['_console_text'], 'output')
+        self.assertEquals(attributes['_dirty_locations'], [[1, 2]])
+        self.assertTrue('1,2' in attributes['_dependency_index'])
+
+
+    @patch('sheet.dependency_graph.settings.PERSIST_DEPENDENCY_INDEX', True, create=True)
+    def test_round_trip(self):
+        worksheet = make_worksheet()
+        contents_json, tile_contents = worksheet_to_tiles(worksheet)
+
+        loaded = worksheet_from_tiles(contents_json, tile_contents.values())
+
+        self.assertEquals(loaded, worksheet)
+        self.assertEquals(loaded._console_text, 'output')
+        self.assertEquals(loaded._dirty_locations, set([(1, 2)]))
+        self.assertEquals(loaded.A1.value, 1)
+        self.assertEquals(
+            loaded._dependency_index.children, worksheet._dependency_index.children
+        )
+        self.assertEquals(
+            loaded._dependency_index.dependents((1, 1)), set([(1, 2), (1, 101), (27, 1)])
+        )
+
+
+    def test_empty_worksheet(self):
+        contents_json, tile_contents = worksheet_to_tiles(Worksheet())
+        self.assertEquals(tile_contents, {})
+        self.assertEquals(worksheet_from_tiles(contents_json, []), Worksheet())
+
+
+    def test_range_reads_cells_of_given_tiles_in_range(self):
+        worksheet = make_worksheet()
+        _, tile_contents = worksheet_to_tiles(worksheet)
+
+        loaded = worksheet_range_from_tiles([tile_contents[0, 0]], (1, 2, 26, 100))
+
+        self.assertEquals(sorted(loaded.keys()), [(1, 2), (26, 100)])
+        self.assertEquals(loaded.A2, worksheet.A2)
+
+
+
+class TestTiledSheetStorage(ResolverDjangoTestCase):
+
+    def setUp(self):
+        self.user = User(username='tiler')
+        self.user.save()
+        patcher = patch('sheet.tiled_storage.settings')
+        self.mock_settings = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.mock_settings.TILED_SHEET_STORAGE = True
+
+
+    def saved_tiles(self, sheet):
+        return dict(
+            ((tile.tile_col, tile.tile_row), tile)
+            for tile in SheetTile.objects.filter(sheet=sheet)
+        )
+
+
+    def test_keeps_cells_in_tiles_and_reads_them_back(self):
+        sheet = Sheet(owner=self.user)
+        sheet.jsonify_worksheet(make_worksheet())
+        sheet.save()
+
+        self.assertTrue(sheet.is_tiled)
+        self.assertEquals(
+            sorted(self.saved_tiles(sheet).keys()), [(0, 0), (0, 1), (1, 0), (2, 2)]
+        )
+        self.assertFalse('corner' in sheet.contents_json)
+        sheet_in_db = Sheet.objects.get(pk=sheet.id)
+        self.assertTrue(sheet_in_db.is_tiled)
+        self.assertEquals(sheet_in_db.unjsonify_worksheet(), make_worksheet())
+
+
+    @patch('sheet.worksheet_binary.settings')
+    def test_binary_tiles_are_kept_in_the_binary_column(self, mock_worksheet_binary_settings):
+        mock_worksheet_binary_settings.WORKSHEET_STORAGE_FORMAT = 'binary'
+        sheet = Sheet(owner=self.user)
+        sheet.jsonify_worksheet(make_worksheet())
+        sheet.save()
+
+        for tile in self.saved_tiles(sheet).itervalues():
+            self.assertEquals(tile.contents, '')
+            self.assertTrue(bytes(tile.contents_binary).startswith(MAGIC))
+        sheet_in_db = Sheet.objects.get(pk=sheet.id)
+        self.assertEquals(sheet_in_db.unjsonify_worksheet(), make_worksheet())
+        sheet_in_db = Sheet.objects.get(pk=sheet.id)
+        worksheet = sheet_in_db.unjsonify_worksheet_range((27, 1, 52, 100))
+        self.assertEquals(worksheet.keys(), [(27, 1)])
+        self.assertEquals(worksheet[27, 1].formula, '=A1 * 2')
+
+
+    def test_edits_only_write_the_tiles_that_changed(self):
+        sheet = Sheet(owner=self.user)
+        sheet.jsonify_worksheet(make_worksheet())
+        sheet.save()
+        tiles_before = self.saved_tiles(sheet)
+
+        sheet = Sheet.objects.get(pk=sheet.id)
+        worksheet = sheet.unjsonify_worksheet()
+        worksheet.set_cell_formula(26, 100, 'new corner')
+        worksheet.set_cell_formula(60, 250, '')
+        sheet.jsonify_worksheet(worksheet)
+        # The version check's update, then one tile updated and one deleted
+        with self.assertNumQueries(3):
+            self.assertTrue(
+                update_sheet_with_version_check(sheet, contents_json=sheet.contents_json)
+            )
+
+        tiles_after = self.saved_tiles(sheet)
+        self.assertEquals(sorted(tiles_after.keys()), [(0, 0), (0, 1), (1, 0)])
+        for tile in [(0, 1), (1, 0)]:
+            self.assertEquals(tiles_after[tile].contents, tiles_before[tile].contents)
+        self.assertEquals(
+            Sheet.objects.get(pk=sheet.id).unjsonify_worksheet().Z100.formula,
+            'new corner'
+        )
+
+
+    def test_failed_version_check_writes_no_tiles(self):
+        sheet = Sheet(owner=self.user)
+        sheet.jsonify_worksheet(make_worksheet())
+        sheet.save()
+        tiles_before = self.saved_tiles(sheet)
+        Sheet.objects.filter(pk=sheet.id).update(version=sheet.version + 1)
+
+        worksheet = sheet.unjsonify_worksheet()
+        worksheet.A1.formula = '2'
+        sheet.jsonify_worksheet(worksheet)
+
+        self.assertFalse(
+            update_sheet_with_version_check(sheet, contents_json=sheet.contents_json)
+        )
+        self.assertEquals(
+            self.saved_tiles(sheet)[0, 0].contents, tiles_before[0, 0].contents
+        )
+
+
+    def test_reading_a_range_only_fetches_the_tiles_it_overlaps(self):
+        sheet = Sheet(owner=self.user)
+        sheet.jsonify_worksheet(make_worksheet())
+        sheet.save()
+        sheet = Sheet.objects.get(pk=sheet.id)
+
+        with self.assertNumQueries(1):
+            worksheet = sheet.unjsonify_worksheet_range((27, 1, 52, 100))
+
+        self.assertEquals(worksheet.keys(), [(27, 1)])
+        self.assertEquals(worksheet[27, 1].formula, '=A1 * 2')
+
+
+    def test_reading_a_range_only_loads_the_tiles_it_overlaps(self):
+        sheet = Sheet(owner=self.user)
+        sheet.jsonify_worksheet(make_worksheet())
+        sheet.save()
+        tiles = self.saved_tiles(sheet)
+        sheet = Sheet.objects.get(pk=sheet.id)
+
+        with patch(
+            'sheet.tiled_storage.worksheet_range_from_contents',
+            wraps=worksheet_range_from_contents
+        ) as mock_range_from_contents:
+            with patch('sheet.sheet.worksheet_from_tiles') as mock_worksheet_from_tiles:
+                sheet.unjsonify_worksheet_range((27, 1, 52, 100))
+
+        self.assertFalse(mock_worksheet_from_tiles.called)
+        self.assertEquals(
+            [args[0] for args, _ in mock_range_from_contents.call_args_list],
+            [tiles[1, 0].contents]
+        )
+
+
+    def test_reading_a_range_uses_loaded_tiles(self):
+        sheet = Sheet(owner=self.user)
+        worksheet = make_worksheet()
+        sheet.jsonify_worksheet(worksheet)
+
+        with self.assertNumQueries(0):
+            from_range = sheet.unjsonify_worksheet_range((1, 1, 26, 100))
+
+        self.assertEquals(sorted(from_range.keys()), [(1, 1), (1, 2), (26, 100)])
+
+
+    def test_sheets_move_out_of_tiles_when_tiled_storage_is_turned_off(self):
+        sheet = Sheet(owner=self.user)
+        sheet.jsonify_worksheet(make_worksheet())
+        sheet.save()
+
+        self.mock_settings.TILED_SHEET_STORAGE = False
+        sheet = Sheet.objects.get(pk=sheet.id)
+        sheet.jsonify_worksheet(sheet.unjsonify_worksheet())
+        self.assertTrue(
+            update_sheet_with_version_check(sheet, contents_json=sheet.contents_json)
+        )
+
+        sheet_in_db = Sheet.objects.get(pk=sheet.id)
+        self.assertFalse(sheet_in_db.is_tiled)
+        self.assertEquals(self.saved_tiles(sheet), {})
+        self.assertEquals(sheet_in_db.unjsonify_worksheet(), make_worksheet())
+
+
+    def test_untiled_sheets_move_into_tiles_when_saved(self):
+        self.mock_settings.TILED_SHEET_STORAGE = False
+        sheet = Sheet(owner=self.user)
+        sheet.jsonify_worksheet(make_worksheet())
+        sheet.save()
+        self.assertEquals(self.saved_tiles(sheet), {})
+
+        self.mock_settings.TILED_SHEET_STORAGE = True
+        sheet = Sheet.objects.get(pk=sheet.id)
+        sheet.jsonify_worksheet(sheet.unjsonify_worksheet())
+        sheet.save()
+
+        self.assertEquals(len(self.saved_tiles(sheet)), 4)
+        self.assertEquals(Sheet.objects.get(pk=sheet.id).unjsonify_worksheet(), make_worksheet())
+
+
+    def test_copying_a_sheet_copies_its_tiles(self):
+        sheet = Sheet(owner=self.user)
+        sheet.jsonify_worksheet(make_worksheet())
+        sheet.save()
+        original_id = sheet.id
+        other_user = User(username='copier')
+        other_user.save()
+
+        copied = copy_sheet_to_user(Sheet.objects.get(pk=original_id), other_user)
+
+        self.assertNotEquals(copied.id, original_id)
+        self.assertEquals(len(self.saved_tiles(copied)), 4)
+        self.assertEquals(len(SheetTile.objects.filter(sheet_id=original_id)), 4)
+        self.assertEquals(
+            Sheet.objects.get(pk=copied.id).unjsonify_worksheet(), make_worksheet()
+        )
+
+
+    @patch('sheet.sheet.calculate_with_timeout')
+    @patch('sheet.sheet.get_recalc_cache')
+    def test_calculate_does_not_use_the_recalc_cache(
+        self, mock_get_recalc_cache, mock_calculate_with_timeout
+    ):
+        mock_get_recalc_cache.return_value = recalc_cache = MemoryRecalcCache(10)
+        mock_calculate_with_timeout.return_value = True
+        sheet = Sheet(owner=self.user)
+        sheet.jsonify_worksheet(make_worksheet())
+        sheet.save()
+
+        sheet.calculate()
+
+        self.assertTrue(mock_calculate_with_timeout.called)
+        self.assertEquals(len(recalc_cache._results), 0)
@@ -1303,8 +1303,10 @@ class GetJsonGridDataForUITest(SheetViewTestCase):
         self.assertFalse(mock_sheet.calculate.called)
         self.assertCalledOnce(
             mock_sheet_to_ui_json_grid_data,
-            mock_sheet.unjsonify_worksheet.return_value, (1, 2, 3, 4)
+            mock_sheet.unjsonify_worksheet_range.return_value, (1, 2, 3, 4)
         )
+        self.assertCalledOnce(mock_sheet.unjsonify_worksheet_range, (1, 2, 3, 4))
+        self.assertFalse(mock_sheet.unjsonify_worksheet.called)
         self.assertEquals(response.content, mock_sheet_to_ui_json_grid_data.return_value)
 
 
@@ -13,6 +13,7 @@ from django.db import transaction
 from django.http import Http404, HttpResponse, HttpResponseForbidden
 from django.test.testcases import disable_transaction_methods, restore_transaction_methods
 
+from sheet.calculate import api_json_to_worksheet
 from sheet.models import Sheet
 from sheet.worksheet import Worksheet
 from sheet.tests.test_views import set_up_view_test
@@ -154,11 +155,32 @@ class CalculateAndGetJsonForApiViewTest(
 
         self.assertEquals(
             mock_sheet.calculate.call_args_list,
-            [((), {})]
+            [((), {'profile': False})]
         )
         self.assertCalledOnce(mock_transaction.commit)
 
 
+    @patch('sheet.views_api_0_1.get_object_or_404')
+    def test_profiles_calculation_if_asked_to(self, mock_get_object):
+        calculation_result = Worksheet()
+        calculation_result._profile = {'cells_evaluated': 0}
+        mock_sheet = mock_get_object.return_value
+        mock_sheet.owner = self.user
+        mock_sheet.unjsonify_worksheet.return_value = calculation_result
+        mock_sheet.name = 'mock sheet'
+        mock_sheet.allow_json_api_access = True
+        self.request.method = 'POST'
+        self.request.POST['api_key'] = mock_sheet.api_key = 'key'
+        self.request.POST['profile'] = '1'
+
+        response = calculate_and_get_json_for_api(self.request, self.user.username, self.sheet.id)
+
+        self.assertEquals(mock_sheet.calculate.call_args, ((), {'profile': True}))
+        self.assertEquals(
+            json.loads(response.content)['profile'], {'cells_evaluated': 0}
+        )
+
+
     @patch('sheet.views_api_0_1.get_object_or_404')
     def test_rolls_back_and_reraises_if_get_object_raises_with_uncommitted_changes(
         self, mock_get_object_or_404
@@ -268,7 +290,7 @@ class CalculateAndGetJsonForApiViewTest(
         self.assertEquals(actual.content, json.dumps(expected_json))
 
 
-    def die(*_):
+    def die(*_, **__):
         raise AssertionError('should not be called')
 
 
@@ -397,6 +419,19 @@ class TestSheetToValueOnlyJson(unittest.TestCase):
         self.assertEquals(json.loads(result), expected_json_contents)
 
 
+    def test_sheet_to_value_only_json_of_profiled_sheet_round_trips(self):
+        worksheet = Worksheet()
+        worksheet.A1.value = 1
+        worksheet[2, 3].value = 'two, three'
+        worksheet._profile = {'cells_evaluated': 2, 'slowest_cells': [[1, 1, 0.5]]}
+
+        result = api_json_to_worksheet(_sheet_to_value_only_json("Sheet name", worksheet))
+
+        self.assertEquals(sorted(result.keys()), [(1, 1), (2, 3)])
+        self.assertEquals(result.A1.value, 1)
+        self.assertEquals(result[2, 3].value, 'two, three')
+
+
     def test_sheet_to_value_only_json_does_not_include_errors(self):
         self.maxDiff = None
 
@@ -439,3 +474,14 @@ class TestSheetToValueOnlyJson(unittest.TestCase):
         result = _sheet_to_value_only_json("Sheet name", worksheet)
         self.assertEquals(json.loads(result), expected_json_contents)
 
+
+    def test_sheet_to_value_only_json_includes_profile_if_there_is_one(self):
+        worksheet = Worksheet()
+        worksheet._profile = {'cells_evaluated': 3}
+
+        result = _sheet_to_value_only_json("Sheet name", worksheet)
+
+        self.assertEquals(
+            json.loads(result),
+            {'name': "Sheet name", 'profile': {'cells_evaluated': 3}}
+        )
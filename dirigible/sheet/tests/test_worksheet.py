@@ -19,6 +19,8 @@ from threading import Thread
 from dirigible.test_utils import ResolverTestCase
 
 from sheet.cell import Cell, undefined
+from sheet.dependency_graph import get_dependency_index
+from sheet.tests.test_dependency_graph import formula_cells_below
 
 from sheet.worksheet import (
     Bounds, InvalidKeyError, Worksheet, worksheet_to_csv,
@@ -366,6 +368,91 @@ class WorksheetJSONificationTest(ResolverTestCase):
         self.assertIsNotNone(worksheet._console_lock)
 
 
+    def test_dirty_locations_and_usercode_hash_roundtrip_through_json(self):
+        worksheet = Worksheet()
+        worksheet._dirty_locations = set([(1, 2), (3, 4)])
+        worksheet._usercode_hash = 'abc123'
+
+        roundtripped = worksheet_from_json(worksheet_to_json(worksheet))
+
+        self.assertEquals(roundtripped._dirty_locations, set([(1, 2), (3, 4)]))
+        self.assertEquals(roundtripped._usercode_hash, 'abc123')
+
+
+    @patch('sheet.calculate.settings.INCREMENTAL_RECALCULATION', True, create=True)
+    def test_loading_from_json_does_not_mark_cells_dirty(self):
+        from mock import sentinel
+        from sheet.calculate import calculate
+        worksheet = Worksheet()
+        worksheet.set_cell_formulae([
+            ((1, row), str(row)) for row in range(1, 50)
+        ] + [
+            ((2, row), '=A%d * 2' % (row,)) for row in range(1, 50)
+        ])
+        usercode = 'load_constants(worksheet)\nevaluate_formulae(worksheet)\n'
+        calculate(worksheet, usercode, sentinel.private_key)
+        self.assertEquals(worksheet._dirty_locations, set())
+
+        roundtripped = worksheet_from_json(worksheet_to_json(worksheet))
+
+        self.assertEquals(roundtripped._dirty_locations, set())
+        self.assertEquals(roundtripped._usercode_hash, worksheet._usercode_hash)
+
+
+    def test_dependency_index_is_not_saved_by_default_but_rebuilt_when_needed(self):
+        worksheet = Worksheet()
+        worksheet.A1.formula = '=SUM(A2:A5) + B1'
+        worksheet.A3.formula = '=B1'
+        worksheet.B1.formula = '=1'
+        get_dependency_index(worksheet)
+
+        worksheet_json = worksheet_to_json(worksheet)
+        roundtripped = worksheet_from_json(worksheet_json)
+
+        self.assertFalse('_dependency_index' in json.loads(worksheet_json))
+        self.assertIsNone(roundtripped._dependency_index)
+        index = get_dependency_index(roundtripped)
+        self.assertEquals(
+            index.children,
+            {(1, 1): set([(2, 1)]), (1, 3): set([(2, 1)]), (2, 1): set()}
+        )
+        self.assertEquals(index.node_children((1, 1)), set([(1, 3), (2, 1)]))
+
+
+    @patch('sheet.dependency_graph.settings.PERSIST_DEPENDENCY_INDEX', True, create=True)
+    def test_dependency_index_roundtrips_through_json(self):
+        worksheet = Worksheet()
+        worksheet.A1.formula = '=SUM(A2:A5) + B1'
+        worksheet.A3.formula = '=B1'
+        worksheet.B1.formula = '=1'
+        get_dependency_index(worksheet)
+
+        roundtripped = worksheet_from_json(worksheet_to_json(worksheet))
+
+        self.assertEquals(
+            roundtripped._dependency_index.children,
+            {(1, 1): set([(2, 1)]), (1, 3): set([(2, 1)]), (2, 1): set()}
+        )
+        self.assertEquals(
+            roundtripped._dependency_index.node_children((1, 1)), set([(1, 3), (2, 1)])
+        )
+        self.assertEquals(roundtripped._dependency_index.dependents((1, 4)), set([(1, 1)]))
+
+
+    @patch('sheet.dependency_graph.settings.PERSIST_DEPENDENCY_INDEX', True, create=True)
+    def test_worksheet_to_json_saves_dependency_index_refreshed_with_any_direct_cell_edits(self):
+        worksheet = Worksheet()
+        worksheet.A1.formula = '=A2'
+        worksheet.A2.formula = '=1'
+        get_dependency_index(worksheet)
+        worksheet.A1.formula = '=A3'
+        worksheet.A3.formula = '=1'
+
+        roundtripped = worksheet_from_json(worksheet_to_json(worksheet))
+
+        self.assertEquals(roundtripped._dependency_index.children[1, 1], set([(1, 3)]))
+
+
     @patch('sheet.worksheet.json')
     def test_worksheet_from_json_uses_json(self, mock_json):
         mock_json.loads.return_value = {}
@@ -382,6 +469,8 @@ class WorksheetTest(unittest.TestCase):
         self.assertEquals(ws._console_text, '')
         self.assertEquals(ws._usercode_error, None)
         self.assertEquals(ws.name, None)
+        self.assertEquals(ws._dirty_locations, None)
+        self.assertEquals(ws._usercode_hash, None)
 
 
     def test_repr(self):
@@ -596,6 +685,52 @@ class WorksheetTest(unittest.TestCase):
         self.assertFalse((1, 2) in ws)
 
 
+    @patch('sheet.worksheet.parse_formulae')
+    def test_set_cell_formulae_parses_distinct_formulae_together_and_marks_cells_dirty(self, mock_parse_formulae):
+        mock_parse_formulae.return_value = {
+            '=A2': (((1, 2),), 'a2'), '=B2': (((2, 2),), 'b2')
+        }
+        ws = Worksheet()
+        ws[3, 3].formula = 'old'
+        ws._dirty_locations = set()
+
+        ws.set_cell_formulae(
+            [((1, 1), '=A2'), ((2, 1), '=A2'), ('C3', 'constant'), ((1, 1), '=B2')],
+            processes=4
+        )
+
+        formulae, processes = mock_parse_formulae.call_args[0]
+        self.assertEquals(sorted(formulae), ['=A2', '=B2', 'constant'])
+        self.assertEquals(processes, 4)
+        self.assertEquals(ws[1, 1].formula, '=B2')
+        self.assertEquals(ws[1, 1].python_formula, 'b2')
+        self.assertEquals(ws[1, 1].dependencies, [(2, 2)])
+        self.assertEquals(ws[2, 1].python_formula, 'a2')
+        self.assertEquals(ws[3, 3].formula, 'constant')
+        self.assertEquals(ws[3, 3].python_formula, None)
+        self.assertEquals(ws._dirty_locations, set([(1, 1), (2, 1), (3, 3)]))
+
+
+    def test_set_cell_formulae_gives_same_cells_as_setting_formulae_one_by_one(self):
+        formulae = [((1, 1), '=A2 + 1'), ((1, 2), '5'), ((2, 1), '=SUM(A1:A2)'), ((2, 2), '=1 +')]
+        expected = Worksheet()
+        for location, formula in formulae:
+            expected[location].formula = formula
+
+        ws = Worksheet()
+        ws.set_cell_formulae(formulae)
+
+        self.assertEquals(ws, expected)
+        for location, _ in formulae:
+            self.assertEquals(ws[location].python_formula, expected[location].python_formula)
+            self.assertEquals(ws[location].dependencies, expected[location].dependencies)
+
+
+    def test_set_cell_formulae_raises_on_invalid_locations(self):
+        ws = Worksheet()
+        self.assertRaises(InvalidKeyError, ws.set_cell_formulae, [('A0', '=1')])
+
+
     def test_clear_values_clears_values_and_formatted_values_and_errors(self):
         ws = Worksheet()
         ws[1, 2].formula = "=1"
@@ -617,6 +752,66 @@ class WorksheetTest(unittest.TestCase):
         self.assertEquals(ws[2, 2].python_formula, '1 + 1')
 
 
+    def test_clear_values_with_locations_only_clears_those_locations(self):
+        ws = Worksheet()
+        ws[1, 1].formula = "=1"
+        ws[1, 1].value = 1
+        ws[1, 2].formula = "=2"
+        ws[1, 2].value = 2
+        ws[1, 3].value = "no formula"
+
+        ws.clear_values(set([(1, 2), (1, 3), (1, 4)]))
+
+        self.assertEquals(ws[1, 1].value, 1)
+        self.assertEquals(ws[1, 2].value, undefined)
+        self.assertFalse((1, 3) in ws)
+        self.assertFalse((1, 4) in ws)
+
+
+    def test_mark_dirty_only_tracks_once_dirty_locations_are_being_tracked(self):
+        ws = Worksheet()
+        ws.mark_dirty((1, 2))
+        self.assertEquals(ws._dirty_locations, None)
+
+        ws._dirty_locations = set()
+        ws.mark_dirty((1, 2))
+        self.assertEquals(ws._dirty_locations, set([(1, 2)]))
+
+
+    def test_edits_mark_locations_dirty(self):
+        ws = Worksheet()
+        ws[3, 3].formula = '=1'
+        ws._dirty_locations = set()
+
+        ws.set_cell_formula(1, 1, '=2')
+        ws[1, 2] = Cell()
+        del ws[3, 3]
+
+        self.assertEquals(ws._dirty_locations, set([(1, 1), (1, 2), (3, 3)]))
+
+
+    def test_edits_patch_dependency_index(self):
+        ws = Worksheet()
+        ws.set_cell_formula(1, 1, '=SUM(B1:B10)')
+        ws.set_cell_formula(2, 2, '=1')
+        ws.set_cell_formula(3, 1, '=B2 + C2')
+        index = get_dependency_index(ws)
+        self.assertEquals(index.node_children((1, 1)), set([(2, 2)]))
+        self.assertEquals(index.children[3, 1], set([(2, 2)]))
+
+        ws.set_cell_formula(2, 5, '=A1')
+        ws[2, 7] = Cell()
+        ws[2, 7].formula = '=2'
+        ws.mark_dirty((2, 7))
+        ws.set_cell_formula(3, 2, '=3')
+        del ws[2, 2]
+
+        self.assertEquals(formula_cells_below(index, (1, 1)), set([(2, 5), (2, 7)]))
+        self.assertEquals(index.children[2, 5], set([(1, 1)]))
+        self.assertEquals(index.children[3, 1], set([(3, 2)]))
+        self.assertEquals(index.dependents((1, 1)), set([(2, 5)]))
+
+
     def test_clear_values_deletes_cells_with_no_formula(self):
         ws = Worksheet()
         ws[1, 2].formula = None
@@ -0,0 +1,298 @@
+# Copyright (c) 2010 Resolver Systems Ltd, PythonAnywhere LLP
+# See LICENSE.md
+#
+
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+
+from base64 import b64decode, b64encode
+from mock import patch
+import random
+
+from dirigible.test_utils import ResolverTestCase
+
+from sheet.cell import undefined
+from sheet.columnar_worksheet import ColumnarWorksheet
+from sheet.dependency_graph import get_dependency_index
+from sheet.dirigible_datetime import DateTime
+from sheet.worksheet import Worksheet, worksheet_from_json, worksheet_to_json
+from sheet.worksheet_binary import (
+    CELL, contents_columns, CONTENTS_PREFIX, INDEX_OFFSETS, MAGIC, RECORD_HEADER,
+    stored_contents, TILE_COLUMNS, TILE_ROWS, worksheet_from_binary,
+    worksheet_from_contents, worksheet_range_from_binary,
+    worksheet_range_from_contents, worksheet_to_binary, worksheet_to_contents,
+)
+
+
+def make_worksheet():
+    worksheet = Worksheet()
+    worksheet.set_cell_formulae([
+        ((1, 1), '1'), ((1, 2), '=A1 + 1'), ((1, 3), '=sum(A1:B2)'),
+        ((2, 1), 'text'), ((2, 2), u'Sacr\xe9 bleu!'), ((2, 3), '=A1 + 1'),
+    ])
+    values = [
+        1, 2 ** 70, -1.5, float('nan'), True, False, None, u'\xe9t\xe9', 'bytes',
+        [1, u'two', [3.5]], {u'key': 1}, (1, 2), DateTime(2010, 1, 2), object(),
+        2 ** 63 - 1, -2 ** 63,
+    ]
+    for row, value in enumerate(values, 1):
+        worksheet[3, row].formula = '=%d' % (row,)
+        worksheet[3, row].value = value
+    worksheet.A2.error = 'NameError: oops'
+    worksheet.A3.python_formula = 'rewritten by usercode'
+    worksheet.B1.formatted_value = 'formatted by usercode'
+    worksheet._console_text = '<span>output</span>'
+    worksheet._usercode_error = dict(message='oops', line=3)
+    worksheet._dirty_locations = set([(1, 1), (2, 3)])
+    worksheet._usercode_hash = 'abc123'
+    worksheet._profile = dict(cells_evaluated=3)
+    get_dependency_index(worksheet)
+    return worksheet
+
+
+def make_big_worksheet():
+    worksheet = Worksheet()
+    random.seed(0)
+    locations = set(
+        (random.randint(1, 3 * TILE_COLUMNS), random.randint(1, 4 * TILE_ROWS))
+        for _ in range(1000)
+    )
+    worksheet.set_cell_formulae(
+        [(location, '=%d + A1' % (location[1] % 7,)) for location in locations]
+    )
+    for location in locations:
+        worksheet[location].value = location[0] * 0.5
+    return worksheet
+
+
+def cells_in(worksheet, (left, top, right, bottom)):
+    return dict(
+        (location, cell) for location, cell in worksheet.iteritems()
+        if left <= location[0] <= right and top <= location[1] <= bottom
+    )
+
+
+def value_type(value):
+    # simplejson gives back str for ASCII strings, the binary format unicode
+    return basestring if isinstance(value, basestring) else type(value)
+
+
+def assert_worksheets_equal(test, actual, expected):
+    test.assertEquals(actual, expected)
+    test.assertEquals(sorted(actual.keys()), sorted(expected.keys()))
+    for location, cell in expected.iteritems():
+        actual_cell = actual[location]
+        test.assertEquals(actual_cell.python_formula, cell.python_formula)
+        test.assertEquals(actual_cell.dependencies, cell.dependencies)
+        test.assertEquals(value_type(actual_cell.value), value_type(cell.value))
+    for attribute in [
+        '_console_text', '_usercode_error', '_usercode_hash', '_profile',
+    ]:
+        test.assertEquals(getattr(actual, attribute), getattr(expected, attribute))
+    if expected._dependency_index is None:
+        test.assertIsNone(actual._dependency_index)
+    else:
+        test.assertEquals(
+            actual._dependency_index.children, expected._dependency_index.children
+        )
+
+
+
+class TestWorksheetBinary(ResolverTestCase):
+
+    def test_round_trip_gives_same_worksheet_as_through_json(self):
+        worksheet = make_worksheet()
+
+        from_binary = worksheet_from_binary(worksheet_to_binary(worksheet))
+
+        assert_worksheets_equal(
+            self, from_binary, worksheet_from_json(worksheet_to_json(worksheet))
+        )
+        self.assertEquals(from_binary[3, 2].value, 2 ** 70)
+        self.assertEquals(from_binary[3, 4].value, undefined)
+        self.assertEquals(from_binary[3, 12].value, [1, 2])
+        self.assertEquals(from_binary[3, 14].value, undefined)
+        self.assertEquals(from_binary[3, 15].value, 2 ** 63 - 1)
+        self.assertEquals(from_binary.A3.dependencies, [(1, 1, 2, 2)])
+        self.assertEquals(from_binary._dirty_locations, set([(1, 1), (2, 3)]))
+
+
+    def test_round_trip_of_empty_worksheet(self):
+        worksheet = worksheet_from_binary(worksheet_to_binary(Worksheet()))
+        assert_worksheets_equal(
+            self, worksheet, worksheet_from_json(worksheet_to_json(Worksheet()))
+        )
+
+
+    def test_stores_each_distinct_string_once(self):
+        worksheet = Worksheet()
+        worksheet.set_cell_formulae(
+            [((1, row), '=sum([1, 2, 3]) * 42') for row in range(1, 101)]
+        )
+        for row in range(1, 101):
+            worksheet[1, row].value = u'the same result'
+
+        data = worksheet_to_binary(worksheet)
+
+        self.assertEquals(data.count('=sum([1, 2, 3]) * 42'), 1)
+        self.assertEquals(data.count('the same result'), 1)
+        self.assertTrue(len(data) < len(worksheet_to_json(worksheet)) / 3)
+
+
+    def test_skips_records_of_unknown_kinds(self):
+        worksheet = make_worksheet()
+        data = worksheet_to_binary(worksheet)
+        unknown = RECORD_HEADER.pack(CELL + 10, 3) + 'abc'
+
+        from_binary = worksheet_from_binary(
+            data[:len(MAGIC)] + unknown + data[len(MAGIC):] + unknown
+        )
+
+        self.assertEquals(from_binary, worksheet_from_binary(data))
+
+
+    def test_rejects_data_without_magic(self):
+        with self.assertRaises(ValueError):
+            worksheet_from_binary('{}')
+
+
+    def test_loads_into_given_worksheet_class(self):
+        worksheet = make_worksheet()
+        from_binary = worksheet_from_binary(
+            worksheet_to_binary(worksheet), ColumnarWorksheet
+        )
+        self.assertEquals(type(from_binary), ColumnarWorksheet)
+        self.assertEquals(from_binary, worksheet_from_binary(worksheet_to_binary(worksheet)))
+
+
+
+class TestWorksheetRangeFromBinary(ResolverTestCase):
+
+    def test_reads_only_the_cells_in_the_range(self):
+        worksheet = make_big_worksheet()
+        data = worksheet_to_binary(worksheet)
+        for rnge in [
+            (1, 1, TILE_COLUMNS, TILE_ROWS),
+            (TILE_COLUMNS - 1, TILE_ROWS - 1, 2 * TILE_COLUMNS + 1, 3 * TILE_ROWS + 1),
+            (5, 30, 5, 30),
+            (200, 1, 300, 10),
+        ]:
+            from_binary = worksheet_range_from_binary(data, rnge)
+
+            expected = cells_in(worksheet, rnge)
+            self.assertEquals(dict(from_binary), expected, rnge)
+            for location, cell in expected.iteritems():
+                self.assertEquals(from_binary[location].dependencies, cell.dependencies)
+                self.assertEquals(from_binary[location].value, cell.value)
+
+
+    def test_reads_every_kind_of_cell_as_the_whole_worksheet_does(self):
+        data = worksheet_to_binary(make_worksheet())
+
+        from_binary = worksheet_range_from_binary(data, (1, 1, 2, 3))
+
+        self.assertEquals(
+            dict(from_binary), cells_in(worksheet_from_binary(data), (1, 1, 2, 3))
+        )
+
+
+    def test_reads_whole_worksheet_from_data_without_an_index(self):
+        worksheet = make_worksheet()
+        data = worksheet_to_binary(worksheet)
+        without_index = (
+            data[:len(MAGIC)] + data[len(MAGIC) + RECORD_HEADER.size + INDEX_OFFSETS.size:]
+        )
+
+        self.assertEquals(
+            worksheet_range_from_binary(without_index, (1, 1, 1, 1)),
+            worksheet_from_binary(data)
+        )
+
+
+    def test_empty_worksheet(self):
+        self.assertEquals(
+            worksheet_range_from_binary(worksheet_to_binary(Worksheet()), (1, 1, 26, 100)),
+            Worksheet()
+        )
+
+
+
+class TestWorksheetContents(ResolverTestCase):
+
+    @patch('sheet.worksheet_binary.settings')
+    def test_writes_format_from_settings(self, mock_settings):
+        worksheet = make_worksheet()
+
+        mock_settings.WORKSHEET_STORAGE_FORMAT = 'json'
+        self.assertEquals(worksheet_to_contents(worksheet), worksheet_to_json(worksheet))
+
+        mock_settings.WORKSHEET_STORAGE_FORMAT = 'binary'
+        self.assertEquals(worksheet_to_contents(worksheet), worksheet_to_binary(worksheet))
+
+
+    def test_binary_contents_go_in_the_binary_column(self):
+        worksheet = make_worksheet()
+        binary = worksheet_to_binary(worksheet)
+        json = worksheet_to_json(worksheet)
+
+        self.assertEquals(contents_columns(binary), ('', binary))
+        self.assertEquals(contents_columns(json), (json, None))
+        self.assertEquals(contents_columns(unicode(json)), (json, None))
+        self.assertEquals(stored_contents('', buffer(binary)), binary)
+        self.assertEquals(stored_contents(json, None), json)
+
+
+    def test_reads_any_format(self):
+        worksheet = make_worksheet()
+        expected = worksheet_from_json(worksheet_to_json(worksheet))
+        for contents in [
+            worksheet_to_json(worksheet),
+            worksheet_to_binary(worksheet),
+            CONTENTS_PREFIX + b64encode(worksheet_to_binary(worksheet)),
+        ]:
+            assert_worksheets_equal(self, worksheet_from_contents(contents), expected)
+            self.assertEquals(
+                type(worksheet_from_contents(contents, ColumnarWorksheet)),
+                ColumnarWorksheet
+            )
+
+
+    @patch('sheet.worksheet_binary.worksheet_from_binary')
+    def test_reads_range_of_binary_contents(self, mock_worksheet_from_binary):
+        worksheet = make_big_worksheet()
+        rnge = (TILE_COLUMNS + 1, 1, 2 * TILE_COLUMNS, TILE_ROWS)
+
+        from_contents = worksheet_range_from_contents(worksheet_to_binary(worksheet), rnge)
+
+        self.assertEquals(dict(from_contents), cells_in(worksheet, rnge))
+        self.assertFalse(mock_worksheet_from_binary.called)
+
+
+    def test_reads_range_of_base64_contents_decoding_only_what_it_needs(self):
+        worksheet = make_big_worksheet()
+        contents = unicode(CONTENTS_PREFIX + b64encode(worksheet_to_binary(worksheet)))
+        rnge = (TILE_COLUMNS + 1, 1, 2 * TILE_COLUMNS, TILE_ROWS)
+        decoded = []
+
+        def recording_b64decode(encoded):
+            decoded.append(encoded)
+            return b64decode(encoded)
+
+        with patch('sheet.worksheet_binary.b64decode', recording_b64decode):
+            from_contents = worksheet_range_from_contents(contents, rnge)
+
+        self.assertEquals(dict(from_contents), cells_in(worksheet, rnge))
+        self.assertTrue(sum(map(len, decoded)) < len(contents) / 4)
+
+
+    @patch('sheet.worksheet_binary.settings')
+    def test_reads_json_contents_whole(self, mock_settings):
+        mock_settings.WORKSHEET_STORAGE_FORMAT = 'json'
+        worksheet = make_worksheet()
+
+        self.assertEquals(
+            worksheet_range_from_contents(worksheet_to_contents(worksheet), (1, 1, 1, 1)),
+            worksheet_from_json(worksheet_to_json(worksheet))
+        )
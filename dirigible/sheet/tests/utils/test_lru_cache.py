@@ -0,0 +1,64 @@
+# Copyright (c) 2010 Resolver Systems Ltd, PythonAnywhere LLP
+# See LICENSE.md
+#
+
+from mock import sentinel
+
+from dirigible.test_utils import ResolverTestCase
+
+from sheet.utils.lru_cache import LRUCache
+
+
+class LRUCacheTest(ResolverTestCase):
+
+    def test_get_returns_stored_values_and_default_for_missing_keys(self):
+        cache = LRUCache(10)
+        cache.put('key', sentinel.value)
+        self.assertEquals(cache.get('key'), sentinel.value)
+        self.assertEquals(cache.get('other key'), None)
+        self.assertEquals(cache.get('other key', sentinel.default), sentinel.default)
+
+
+    def test_counts_hits_and_misses(self):
+        cache = LRUCache(10)
+        self.assertEquals(cache.hit_rate, 0.0)
+        cache.put('key', sentinel.value)
+        cache.get('key')
+        cache.get('key')
+        cache.get('missing')
+        cache.get('key')
+        self.assertEquals((cache.hits, cache.misses), (3, 1))
+        self.assertEquals(cache.hit_rate, 0.75)
+
+
+    def test_evicts_least_recently_used_entry_when_full(self):
+        cache = LRUCache(2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        cache.get('a')
+        cache.put('c', 3)
+
+        self.assertEquals(len(cache), 2)
+        self.assertTrue('a' in cache)
+        self.assertFalse('b' in cache)
+        self.assertTrue('c' in cache)
+
+
+    def test_clear_empties_cache_and_resets_counters(self):
+        cache = LRUCache(2)
+        cache.put('a', 1)
+        cache.get('a')
+        cache.get('b')
+        cache.clear()
+        self.assertEquals(len(cache), 0)
+        self.assertEquals((cache.hits, cache.misses), (0, 0))
+
+
+    def test_reset_lock_replaces_a_held_lock_and_keeps_entries(self):
+        cache = LRUCache(2)
+        cache.put('a', 1)
+        cache._lock.acquire()
+
+        cache.reset_lock()
+
+        self.assertEquals(cache.get('a'), 1)
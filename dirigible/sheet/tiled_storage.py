@@ -0,0 +1,72 @@
+# Copyright (c) 2010 Resolver Systems Ltd, PythonAnywhere LLP
+# See LICENSE.md
+#
+
+import simplejson as json
+
+from django.conf import settings
+from django.db import models
+
+from .worksheet import Worksheet
+from .worksheet_binary import (
+    set_worksheet_attributes, tile_of, worksheet_attributes,
+    worksheet_from_contents, worksheet_range_from_contents, worksheet_to_contents,
+)
+
+
+# With TILED_SHEET_STORAGE on, a sheet's cells are kept a tile of
+# TILE_COLUMNS x TILE_ROWS (the grid's patch size) to a SheetTile row, and
+# Sheet.contents_json only has the worksheet's other attributes.  Saving a
+# sheet then only writes the tiles that changed, and the grid only reads the
+# tiles it shows.
+
+def tiled_storage_enabled():
+    return getattr(settings, 'TILED_SHEET_STORAGE', False)
+
+
+class SheetTile(models.Model):
+    sheet = models.ForeignKey('Sheet', related_name='tiles')
+    tile_col = models.IntegerField()
+    tile_row = models.IntegerField()
+    # As for Sheet.contents_json and Sheet.contents_binary
+    contents = models.TextField()
+    contents_binary = models.BinaryField(null=True)
+
+    class Meta:
+        unique_together = ('sheet', 'tile_col', 'tile_row')
+
+
+def worksheet_to_tiles(worksheet):
+    # The JSON for Sheet.contents_json, and a dict of (tile_col, tile_row)
+    # to the contents of each tile with any cells in it.
+    tiles = {}
+    for location, cell in worksheet.iteritems():
+        tile = tiles.get(tile_of(location))
+        if tile is None:
+            tile = tiles[tile_of(location)] = Worksheet()
+        tile._adopt_cell(location, cell)
+    return (
+        json.dumps(worksheet_attributes(worksheet)),
+        dict((key, worksheet_to_contents(tile)) for key, tile in tiles.iteritems())
+    )
+
+
+def worksheet_from_tiles(contents_json, tile_contents, worksheet_class=None):
+    worksheet = (worksheet_class or Worksheet)()
+    for contents in tile_contents:
+        for location, cell in worksheet_from_contents(contents).iteritems():
+            worksheet._adopt_cell(location, cell)
+    # Only now the cells are in, so that adopting them doesn't mark them dirty
+    set_worksheet_attributes(worksheet, json.loads(contents_json))
+    return worksheet
+
+
+def worksheet_range_from_tiles(tile_contents, rnge):
+    # Just the cells in rnge for the grid, from the tiles that overlap it
+    left, top, right, bottom = rnge
+    worksheet = Worksheet()
+    for contents in tile_contents:
+        for (col, row), cell in worksheet_range_from_contents(contents, rnge).iteritems():
+            if left <= col <= right and top <= row <= bottom:
+                worksheet._adopt_cell((col, row), cell)
+    return worksheet
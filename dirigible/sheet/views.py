@@ -78,8 +78,13 @@ def rollback_on_exception(view):
 
 
 def update_sheet_with_version_check(sheet, **kwargs):
+    if 'contents_json' in kwargs:
+        kwargs['contents_binary'] = sheet.contents_binary
+        kwargs['is_tiled'] = sheet.is_tiled
     query = Q(id=sheet.id) & Q(version=sheet.version)
     sheets_updated = Sheet.objects.filter(query).update(version=sheet.version + 1, **kwargs)
+    if sheets_updated and 'contents_json' in kwargs:
+        sheet.save_tiles()
     return sheets_updated != 0
 
 
@@ -305,7 +310,9 @@ def set_sheet_security_settings(request, sheet):
 @fetch_users_or_public_sheet
 def get_json_grid_data_for_ui(request, sheet):
     rnge = tuple(map(int, request.GET['range'].split(',')))
-    return HttpResponse(sheet_to_ui_json_grid_data(sheet.unjsonify_worksheet(), rnge))
+    return HttpResponse(
+        sheet_to_ui_json_grid_data(sheet.unjsonify_worksheet_range(rnge), rnge)
+    )
 
 
 @fetch_users_or_public_sheet
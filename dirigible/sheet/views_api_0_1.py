@@ -56,7 +56,7 @@ def calculate_and_get_json_for_api(request, username, sheet_id):
     sheet.jsonify_worksheet(worksheet)
 
     try:
-        sheet.calculate()
+        sheet.calculate(profile='profile' in params)
         worksheet = sheet.unjsonify_worksheet()
         if worksheet._usercode_error:
             return HttpResponse(json.dumps({
@@ -81,4 +81,6 @@ def _sheet_to_value_only_json(sheet_name, worksheet):
         col_dict = result.setdefault(col, {})
         if cell.value is not undefined:
             col_dict[row] = cell.value
+    if worksheet._profile is not None:
+        result['profile'] = worksheet._profile
     return json.dumps(result, default=unicode)
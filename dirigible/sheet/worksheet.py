@@ -10,8 +10,9 @@ from StringIO import StringIO
 from threading import Lock
 from xlrd import error_text_from_code, xldate_as_tuple, XL_CELL_DATE, XL_CELL_ERROR
 
-from .cell import Cell, undefined
+from .cell import Cell, parse_formulae, undefined
 from .cell_range import CellRange
+from .dependency_graph import DependencyIndex, persist_dependency_index
 from .utils.cell_name_utils import (
     cell_name_to_coordinates, column_name_to_index,
     cell_range_as_string_to_coordinates
@@ -57,6 +58,20 @@ def worksheet_to_json(worksheet):
 
     stream.write('"_console_text": %s, ' % (json.dumps(worksheet._console_text),))
     stream.write('"_usercode_error": %s ' % (json.dumps(worksheet._usercode_error),))
+    if worksheet._dirty_locations is not None:
+        stream.write(', "_dirty_locations": %s ' % (
+            json.dumps(map(list, worksheet._dirty_locations)),)
+        )
+    if worksheet._usercode_hash is not None:
+        stream.write(', "_usercode_hash": %s ' % (json.dumps(worksheet._usercode_hash),))
+    if worksheet._profile is not None:
+        stream.write(', "_profile": %s ' % (json.dumps(worksheet._profile),))
+    if worksheet._dependency_index is not None and persist_dependency_index():
+        worksheet._dependency_index.refresh(worksheet)
+        stream.write(', "_dependency_index": %s ' % (json.dumps(dict(
+            ('%s,%s' % loc, map(list, children))
+            for loc, children in worksheet._dependency_index.children.iteritems()
+        )),))
 
     for (col, row), cell in worksheet.iteritems():
         stream.write(',')
@@ -68,16 +83,27 @@ def worksheet_to_json(worksheet):
     return result
 
 
-def worksheet_from_json(json_string):
+def worksheet_from_json(json_string, worksheet_class=None):
     #use json for read ops because of better performance
     #keep simplejson for write ops as it's more robust
     worksheet_dict = json.loads(json_string)
-    worksheet = Worksheet()
+    worksheet = (worksheet_class or Worksheet)()
+    dependency_index = None
+    dirty_locations = None
+    usercode_hash = None
     for (key, value) in worksheet_dict.iteritems():
         if key == "_console_text":
             worksheet._console_text = value
         elif key == "_usercode_error":
             worksheet._usercode_error = value
+        elif key == "_dirty_locations":
+            dirty_locations = value
+        elif key == "_usercode_hash":
+            usercode_hash = value
+        elif key == "_profile":
+            worksheet._profile = value
+        elif key == "_dependency_index":
+            dependency_index = value
         else:
             col_str, row_str = key.split(",")
             cell = Cell()
@@ -87,7 +113,19 @@ def worksheet_from_json(json_string):
             cell.error = value.get("error")
             cell._value = value.get("value", undefined)
             cell.formatted_value = value["formatted_value"]
-            worksheet[int(col_str), int(row_str)] = cell
+            worksheet._adopt_cell((int(col_str), int(row_str)), cell)
+    # Only now the cells are in, so that adopting them doesn't mark them dirty
+    if dirty_locations is not None:
+        worksheet._dirty_locations = set(map(tuple, dirty_locations))
+    worksheet._usercode_hash = usercode_hash
+    if dependency_index is not None:
+        worksheet._dependency_index = DependencyIndex.from_children(
+            worksheet,
+            dict(
+                (tuple(map(int, key.split(","))), map(tuple, children))
+                for key, children in dependency_index.iteritems()
+            )
+        )
     return worksheet
 
 
@@ -117,6 +155,7 @@ def worksheet_to_csv(worksheet, encoding):
 
 def worksheet_from_excel(excel_sheet):
     worksheet = Worksheet()
+    formulae = []
     for col in range(excel_sheet.ncols):
         for row in range(excel_sheet.nrows):
             cell = excel_sheet.cell(row, col)
@@ -127,7 +166,8 @@ def worksheet_from_excel(excel_sheet):
                     cell.value, excel_sheet.book.datemode)
             else:
                 formula = unicode(excel_sheet.cell(row, col).value)
-            worksheet[col + 1, row + 1].formula = formula
+            formulae.append(((col + 1, row + 1), formula))
+    worksheet.set_cell_formulae(formulae)
     return worksheet
 
 
@@ -138,6 +178,13 @@ class Worksheet(dict):
         self._console_text = ''
         self._usercode_error = None
         self._console_lock = Lock()
+        self._dirty_locations = None
+        self._usercode_hash = None
+        self._recalc_locations = None
+        self._dependency_index = None
+        self._values_lost_in_storage = set()
+        self._profiler = None
+        self._profile = None
 
 
     def __getitem__(self, key):
@@ -157,6 +204,29 @@ class Worksheet(dict):
             raise TypeError("Worksheet locations must be Cell objects")
 
         dict.__setitem__(self, location, item)
+        self.mark_dirty(location)
+
+
+    def _adopt_cell(self, location, cell):
+        # For new cells that nothing else refers to, which subclasses may
+        # store however suits them.  Saved sheets can't hold every value a
+        # formula gives, so loaded ones come back undefined, or with tuples
+        # turned into lists, and need recalculating before they're used.
+        if cell.python_formula and not cell.error and (
+            cell.value is undefined or type(cell.value) in (list, dict)
+        ):
+            self._values_lost_in_storage.add(location)
+        dict.__setitem__(self, location, cell)
+        self.mark_dirty(location)
+
+
+    def __delitem__(self, key):
+        location = self.to_location(key)
+        if not location:
+            raise InvalidKeyError("%r is not a valid cell location" % (key,))
+
+        dict.__delitem__(self, location)
+        self.mark_dirty(location)
 
 
     def __getattr__(self, name):
@@ -185,7 +255,7 @@ class Worksheet(dict):
     def __eq__(self, other):
         return (
             isinstance(other, Worksheet) and
-            dict(self) == dict(other) and
+            dict(self.iteritems()) == dict(other.iteritems()) and
             self.name == other.name
         )
 
@@ -207,6 +277,17 @@ class Worksheet(dict):
         return None
 
 
+    def _load_constants_in_bulk(self):
+        # For subclasses that can load some constants without evaluating
+        # them one at a time; gives the locations of the rest.
+        return self.iterkeys()
+
+
+    def _cell_values(self, locations):
+        for location in locations:
+            yield self[location].value
+
+
     def add_console_text(self, error_text, log_type='error'):
         self._console_lock.acquire()
         self._console_text += '<span class="console_%s_text">%s</span>' \
@@ -214,24 +295,57 @@ class Worksheet(dict):
         self._console_lock.release()
 
 
+    def mark_dirty(self, location):
+        if self._dirty_locations is not None:
+            self._dirty_locations.add(location)
+        if self._dependency_index is not None:
+            self._dependency_index.update(location, dict.get(self, location))
+
+
     def set_cell_formula(self, col, row, formula):
         if not formula:
             if (col, row) in self:
                 del self[col, row]
         else:
-            self[col, row].formula = formula
-
-
-    def clear_values(self):
+            self[col, row]._set_formula(formula)
+            self.mark_dirty((col, row))
+
+
+    def set_cell_formulae(self, formulae, processes=None):
+        # Like setting each cell's formula and marking it dirty, but for many
+        # (location, formula) pairs at once, parsing each distinct formula
+        # only once.  Later pairs for a location win over earlier ones.
+        by_location = {}
+        for key, formula in formulae:
+            location = self.to_location(key)
+            if not location:
+                raise InvalidKeyError("%r is not a valid cell location" % (key,))
+            by_location[location] = formula
+        parsed = parse_formulae(by_location.itervalues(), processes)
+        for location, formula in by_location.iteritems():
+            cell = dict.get(self, location)
+            if cell is None:
+                cell = Cell()
+                dict.__setitem__(self, location, cell)
+            cell._set_formula(formula, parsed.get(formula))
+            self.mark_dirty(location)
+
+
+    def clear_values(self, locations=None):
+        if locations is None:
+            locations = self.keys()
         to_delete = []
-        for location, cell in self.items():
+        for location in locations:
+            if location not in self:
+                continue
+            cell = dict.__getitem__(self, location)
             if cell.formula or cell.python_formula:
                 cell.value = undefined
                 cell.error = None
             else:
                 to_delete.append(location)
         for location in to_delete:
-            del self[location]
+            dict.__delitem__(self, location)
 
 
     #--methods intended for public user consumption--
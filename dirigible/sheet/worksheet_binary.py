@@ -0,0 +1,445 @@
+# Copyright (c) 2010 Resolver Systems Ltd, PythonAnywhere LLP
+# See LICENSE.md
+#
+
+from base64 import b64decode, b64encode
+import simplejson as json
+from struct import Struct
+
+from django.conf import settings
+
+from .cell import Cell, undefined
+from .dependency_graph import DependencyIndex, persist_dependency_index
+from .worksheet import Worksheet, worksheet_from_json, worksheet_to_json
+
+
+# A more compact alternative to worksheet_to_json.  After a magic string,
+# a worksheet is a series of records, each a kind byte and a payload length
+# followed by the payload:
+#
+#   STRING     utf-8 text, which later records refer to by its index among
+#              the STRING records -- so each distinct formula, python
+#              formula, formatted value or error is only stored once
+#   ATTRIBUTES JSON for the worksheet's own attributes (console text etc.)
+#   CELL       col, row, the string indices of the formula, python formula,
+#              formatted value and error (NO_STRING for None), the
+#              dependencies, then the value: a type byte and, depending on
+#              it, an int64, a double, a string index or some JSON.
+#
+# Values that can't go in JSON are left out, just as they are from JSON.
+#
+# So that the grid can show part of a big sheet without reading all of it,
+# cells are written a tile of TILE_COLUMNS x TILE_ROWS (the grid's patch
+# size) at a time, and there is an index:
+#
+#   INDEX         straight after the magic string, the offsets of the
+#                 STRING_OFFSETS and TILES records
+#   STRING_OFFSETS the offset of each STRING record, by string index
+#   TILES         for each tile, its col and row and the offsets at which
+#                 its records start and end, sorted by tile
+
+MAGIC = 'DWB\x01'
+
+STRING, ATTRIBUTES, CELL, INDEX, STRING_OFFSETS, TILES = range(6)
+
+(
+    VALUE_UNDEFINED, VALUE_NONE, VALUE_TRUE, VALUE_FALSE,
+    VALUE_INT, VALUE_FLOAT, VALUE_STRING, VALUE_JSON,
+) = range(8)
+
+NO_STRING = -1
+
+RECORD_HEADER = Struct('<BI')
+CELL_HEADER = Struct('<iiiiiiI')
+LOCATION = Struct('<ii')
+RANGE = Struct('<iiii')
+DEPENDENCY_SIZE = Struct('<B')
+VALUE_TYPE = Struct('<B')
+INT = Struct('<q')
+FLOAT = Struct('<d')
+STRING_INDEX = Struct('<i')
+LENGTH = Struct('<I')
+INDEX_OFFSETS = Struct('<II')
+OFFSET = Struct('<I')
+TILE = Struct('<iiII')
+
+TILE_COLUMNS = 26
+TILE_ROWS = 100
+
+MIN_INT = -2 ** 63
+MAX_INT = 2 ** 63 - 1
+INF = float('inf')
+
+# Binary contents are kept as they are in a binary column next to the text
+# one JSON contents go in (see contents_columns).  They used to be kept in the
+# text column, base64 encoded behind this prefix, and are still read from
+# there.  JSON contents always start with '{'.
+CONTENTS_PREFIX = 'dirigible-binary:'
+
+
+def _pack_value(value, string_index):
+    if value is undefined:
+        return VALUE_TYPE.pack(VALUE_UNDEFINED)
+    if value is None:
+        return VALUE_TYPE.pack(VALUE_NONE)
+    if value is True:
+        return VALUE_TYPE.pack(VALUE_TRUE)
+    if value is False:
+        return VALUE_TYPE.pack(VALUE_FALSE)
+    if isinstance(value, (int, long)) and MIN_INT <= value <= MAX_INT:
+        return VALUE_TYPE.pack(VALUE_INT) + INT.pack(value)
+    if isinstance(value, float):
+        if value != value or value in (INF, -INF):
+            # Not JSONifiable
+            return VALUE_TYPE.pack(VALUE_UNDEFINED)
+        return VALUE_TYPE.pack(VALUE_FLOAT) + FLOAT.pack(value)
+    if isinstance(value, basestring):
+        try:
+            return VALUE_TYPE.pack(VALUE_STRING) + STRING_INDEX.pack(
+                string_index(unicode(value) if isinstance(value, unicode) else value)
+            )
+        except UnicodeDecodeError:
+            return VALUE_TYPE.pack(VALUE_UNDEFINED)
+    try:
+        encoded = json.dumps(value, allow_nan=False).encode('utf-8')
+    except (TypeError, ValueError):
+        # Not JSONifiable
+        return VALUE_TYPE.pack(VALUE_UNDEFINED)
+    return VALUE_TYPE.pack(VALUE_JSON) + LENGTH.pack(len(encoded)) + encoded
+
+
+def worksheet_attributes(worksheet):
+    # Everything but the cells, as JSON for worksheet_to_json would have it
+    attributes = dict(
+        _console_text=worksheet._console_text,
+        _usercode_error=worksheet._usercode_error,
+    )
+    if worksheet._dirty_locations is not None:
+        attributes['_dirty_locations'] = map(list, worksheet._dirty_locations)
+    if worksheet._usercode_hash is not None:
+        attributes['_usercode_hash'] = worksheet._usercode_hash
+    if worksheet._profile is not None:
+        attributes['_profile'] = worksheet._profile
+    if worksheet._dependency_index is not None and persist_dependency_index():
+        worksheet._dependency_index.refresh(worksheet)
+        attributes['_dependency_index'] = dict(
+            ('%s,%s' % loc, map(list, children))
+            for loc, children in worksheet._dependency_index.children.iteritems()
+        )
+    return attributes
+
+
+def set_worksheet_attributes(worksheet, attributes):
+    # The other way round; the worksheet should have its cells already.
+    worksheet._console_text = attributes.get('_console_text', worksheet._console_text)
+    worksheet._usercode_error = attributes.get('_usercode_error')
+    if '_dirty_locations' in attributes:
+        worksheet._dirty_locations = set(map(tuple, attributes['_dirty_locations']))
+    worksheet._usercode_hash = attributes.get('_usercode_hash')
+    worksheet._profile = attributes.get('_profile')
+    dependency_index = attributes.get('_dependency_index')
+    if dependency_index is not None:
+        worksheet._dependency_index = DependencyIndex.from_children(
+            worksheet,
+            dict(
+                (tuple(map(int, key.split(","))), map(tuple, children))
+                for key, children in dependency_index.iteritems()
+            )
+        )
+
+
+def tile_of((col, row)):
+    return (col - 1) // TILE_COLUMNS, (row - 1) // TILE_ROWS
+
+
+def tile_bounds((left, top, right, bottom)):
+    # The left, top, right and bottom tiles that a range overlaps
+    return (
+        tile_of((max(left, 1), max(top, 1))) + tile_of((max(right, 1), max(bottom, 1)))
+    )
+
+
+def worksheet_to_binary(worksheet):
+    chunks = [MAGIC, RECORD_HEADER.pack(INDEX, INDEX_OFFSETS.size), None]
+    strings = {}
+    string_offsets = []
+    # The offset the next chunk will go at
+    position = [len(MAGIC) + RECORD_HEADER.size + INDEX_OFFSETS.size]
+
+    def append(chunk):
+        chunks.append(chunk)
+        position[0] += len(chunk)
+
+    def string_index(string):
+        if string is None:
+            return NO_STRING
+        if not isinstance(string, unicode):
+            string = string.decode('utf-8')
+        index = strings.get(string)
+        if index is None:
+            index = strings[string] = len(strings)
+            encoded = string.encode('utf-8')
+            string_offsets.append(position[0])
+            append(RECORD_HEADER.pack(STRING, len(encoded)))
+            append(encoded)
+        return index
+
+    encoded = json.dumps(worksheet_attributes(worksheet)).encode('utf-8')
+    append(RECORD_HEADER.pack(ATTRIBUTES, len(encoded)))
+    append(encoded)
+
+    tiles = []
+    for (col, row), cell in sorted(
+        worksheet.iteritems(), key=lambda (location, cell): tile_of(location)
+    ):
+        tile = tile_of((col, row))
+        if not tiles or tiles[-1][0] != tile:
+            tiles.append([tile, position[0], None])
+        dependencies = cell.dependencies
+        payload = [CELL_HEADER.pack(
+            col, row,
+            string_index(cell.formula),
+            string_index(cell.python_formula or None),
+            string_index(cell.formatted_value),
+            string_index(cell.error or None),
+            len(dependencies),
+        )]
+        for dependency in dependencies:
+            payload.append(DEPENDENCY_SIZE.pack(len(dependency)))
+            payload.append((LOCATION if len(dependency) == 2 else RANGE).pack(*dependency))
+        payload.append(_pack_value(cell.value, string_index))
+        payload = ''.join(payload)
+        append(RECORD_HEADER.pack(CELL, len(payload)))
+        append(payload)
+        tiles[-1][2] = position[0]
+
+    string_offsets_offset = position[0]
+    append(RECORD_HEADER.pack(STRING_OFFSETS, OFFSET.size * len(string_offsets)))
+    append(''.join(OFFSET.pack(offset) for offset in string_offsets))
+    tiles_offset = position[0]
+    append(RECORD_HEADER.pack(TILES, TILE.size * len(tiles)))
+    append(''.join(
+        TILE.pack(tile_col, tile_row, start, end)
+        for (tile_col, tile_row), start, end in tiles
+    ))
+    chunks[2] = INDEX_OFFSETS.pack(string_offsets_offset, tiles_offset)
+
+    return ''.join(chunks)
+
+
+def _unpack_value(data, offset, strings):
+    value_type, = VALUE_TYPE.unpack_from(data, offset)
+    offset += VALUE_TYPE.size
+    if value_type == VALUE_INT:
+        return INT.unpack_from(data, offset)[0]
+    if value_type == VALUE_FLOAT:
+        return FLOAT.unpack_from(data, offset)[0]
+    if value_type == VALUE_STRING:
+        return strings[STRING_INDEX.unpack_from(data, offset)[0]]
+    if value_type == VALUE_NONE:
+        return None
+    if value_type == VALUE_TRUE:
+        return True
+    if value_type == VALUE_FALSE:
+        return False
+    if value_type == VALUE_JSON:
+        length, = LENGTH.unpack_from(data, offset)
+        offset += LENGTH.size
+        return json.loads(data[offset:offset + length].decode('utf-8'))
+    return undefined
+
+
+def _unpack_cell(data, offset, strings):
+    (
+        col, row, formula, python_formula, formatted_value, error,
+        num_dependencies
+    ) = CELL_HEADER.unpack_from(data, offset)
+    position = offset + CELL_HEADER.size
+    dependencies = []
+    for _ in xrange(num_dependencies):
+        size, = DEPENDENCY_SIZE.unpack_from(data, position)
+        position += DEPENDENCY_SIZE.size
+        dependency_struct = LOCATION if size == 2 else RANGE
+        dependencies.append(dependency_struct.unpack_from(data, position))
+        position += dependency_struct.size
+    cell = Cell()
+    cell._formula = strings[formula] if formula != NO_STRING else None
+    if python_formula != NO_STRING:
+        cell._python_formula = strings[python_formula]
+    cell.dependencies = dependencies
+    if error != NO_STRING:
+        cell.error = strings[error]
+    cell._value = _unpack_value(data, position, strings)
+    cell.formatted_value = (
+        strings[formatted_value] if formatted_value != NO_STRING else None
+    )
+    return (col, row), cell
+
+
+def worksheet_from_binary(data, worksheet_class=None):
+    if not data.startswith(MAGIC):
+        raise ValueError('Not a binary worksheet')
+    worksheet = (worksheet_class or Worksheet)()
+    strings = []
+    attributes = {}
+    offset = len(MAGIC)
+    end = len(data)
+    record_header_size = RECORD_HEADER.size
+    unpack_record_header = RECORD_HEADER.unpack_from
+    while offset < end:
+        kind, length = unpack_record_header(data, offset)
+        offset += record_header_size
+        record_end = offset + length
+        if kind == STRING:
+            strings.append(data[offset:record_end].decode('utf-8'))
+        elif kind == CELL:
+            location, cell = _unpack_cell(data, offset, strings)
+            worksheet._adopt_cell(location, cell)
+        elif kind == ATTRIBUTES:
+            attributes = json.loads(data[offset:record_end].decode('utf-8'))
+        offset = record_end
+    # Only now the cells are in, so that adopting them doesn't mark them dirty
+    set_worksheet_attributes(worksheet, attributes)
+    return worksheet
+
+
+class _StringTable(object):
+    # Looks strings up through the STRING_OFFSETS record as they're needed.
+
+    def __init__(self, read, string_offsets_offset):
+        self._read = read
+        self._start = string_offsets_offset + RECORD_HEADER.size
+        self._strings = {}
+
+
+    def __getitem__(self, index):
+        string = self._strings.get(index)
+        if string is None:
+            offset, = OFFSET.unpack(
+                self._read(self._start + index * OFFSET.size, OFFSET.size)
+            )
+            _, length = RECORD_HEADER.unpack(self._read(offset, RECORD_HEADER.size))
+            string = self._strings[index] = self._read(
+                offset + RECORD_HEADER.size, length
+            ).decode('utf-8')
+        return string
+
+
+
+def _read_worksheet_range(read, rnge, worksheet_class):
+    # Reads just the tiles that overlap the range, given a read(offset,
+    # length) for the binary data, or returns None if it has no index.
+    kind, _ = RECORD_HEADER.unpack(read(len(MAGIC), RECORD_HEADER.size))
+    if kind != INDEX:
+        return None
+    string_offsets_offset, tiles_offset = INDEX_OFFSETS.unpack(
+        read(len(MAGIC) + RECORD_HEADER.size, INDEX_OFFSETS.size)
+    )
+    strings = _StringTable(read, string_offsets_offset)
+    _, length = RECORD_HEADER.unpack(read(tiles_offset, RECORD_HEADER.size))
+    tiles = read(tiles_offset + RECORD_HEADER.size, length)
+
+    worksheet = (worksheet_class or Worksheet)()
+    left, top, right, bottom = rnge
+    left_tile, top_tile, right_tile, bottom_tile = tile_bounds(rnge)
+    for tile_col in xrange(left_tile, right_tile + 1):
+        # Tiles are sorted, so the first one in this column is found by
+        # bisection
+        low, high = 0, len(tiles) // TILE.size
+        while low < high:
+            middle = (low + high) // 2
+            if TILE.unpack_from(tiles, middle * TILE.size)[:2] < (tile_col, top_tile):
+                low = middle + 1
+            else:
+                high = middle
+        for index in xrange(low, len(tiles) // TILE.size):
+            this_tile_col, tile_row, start, end = TILE.unpack_from(tiles, index * TILE.size)
+            if this_tile_col != tile_col or tile_row > bottom_tile:
+                break
+            data = read(start, end - start)
+            offset = 0
+            while offset < len(data):
+                kind, length = RECORD_HEADER.unpack_from(data, offset)
+                offset += RECORD_HEADER.size
+                if kind == CELL:
+                    col, row = LOCATION.unpack_from(data, offset)
+                    if left <= col <= right and top <= row <= bottom:
+                        location, cell = _unpack_cell(data, offset, strings)
+                        worksheet._adopt_cell(location, cell)
+                offset += length
+    return worksheet
+
+
+def worksheet_range_from_binary(data, rnge, worksheet_class=None):
+    # A worksheet with the cells in rnge, (left, top, right, bottom) -- and
+    # all the others too, if the data has no index.
+    if not data.startswith(MAGIC):
+        raise ValueError('Not a binary worksheet')
+    worksheet = _read_worksheet_range(
+        lambda offset, length: data[offset:offset + length], rnge, worksheet_class
+    )
+    if worksheet is None:
+        worksheet = worksheet_from_binary(data, worksheet_class)
+    return worksheet
+
+
+def worksheet_to_contents(worksheet):
+    # What to keep for a sheet, in the WORKSHEET_STORAGE_FORMAT.
+    if getattr(settings, 'WORKSHEET_STORAGE_FORMAT', 'json') == 'binary':
+        return worksheet_to_binary(worksheet)
+    return worksheet_to_json(worksheet)
+
+
+def contents_columns(contents):
+    # The (text, binary) column values to store contents in: binary contents
+    # go in the binary column, with the text one left empty.
+    if isinstance(contents, bytes) and contents.startswith(MAGIC):
+        return '', contents
+    return contents, None
+
+
+def stored_contents(text, binary):
+    # The contents kept in a (text, binary) pair of columns.  Databases give
+    # binary columns back as buffers.
+    if binary is not None:
+        return bytes(binary)
+    return text
+
+
+def worksheet_from_contents(contents, worksheet_class=None):
+    # Reads any format, so that sheets saved as JSON keep loading, and are
+    # saved in the binary format next time if that's what's configured.
+    if contents.startswith(MAGIC):
+        return worksheet_from_binary(contents, worksheet_class)
+    if contents.startswith(CONTENTS_PREFIX):
+        return worksheet_from_binary(
+            b64decode(contents[len(CONTENTS_PREFIX):]), worksheet_class
+        )
+    return worksheet_from_json(contents, worksheet_class)
+
+
+def worksheet_range_from_contents(contents, rnge, worksheet_class=None):
+    # For the grid, which asks for a patch of cells at a time.  Binary
+    # contents are only read (or, for those saved as base64, decoded) where
+    # the tiles overlapping rnge and the strings they use are, so how long
+    # this takes doesn't depend on the size of the sheet.  JSON contents, and
+    # binary contents saved before there was an index, are read whole, cells
+    # outside rnge and all.
+    if contents.startswith(MAGIC):
+        return worksheet_range_from_binary(contents, rnge, worksheet_class)
+    if contents.startswith(CONTENTS_PREFIX):
+        start = len(CONTENTS_PREFIX)
+
+        def read(offset, length):
+            # Every 3 bytes are 4 characters of base64
+            first = offset // 3
+            last = (offset + length + 2) // 3
+            decoded = b64decode(contents[start + first * 4:start + last * 4])
+            skip = offset - first * 3
+            return decoded[skip:skip + length]
+
+        if read(0, len(MAGIC)) == MAGIC:
+            worksheet = _read_worksheet_range(read, rnge, worksheet_class)
+            if worksheet is not None:
+                return worksheet
+    return worksheet_from_contents(contents, worksheet_class)